@@ -0,0 +1,104 @@
+#Compares allocations and conversion cost per request with and without the modbusMsg pool.
+#Requests are converted in bursts like a bus worker does; responses are kept (as if still waiting to be
+#published) and so are unpooled modbus messages, so every block that is not recycled shows up in the count.
+#
+#   python -m benchmarks.bench_alloc [--json]
+
+import json
+import sys
+import timeit
+import tracemalloc
+from mqtt2modbus import mqtt2modbus
+
+
+BURST = 32
+
+
+#modbusMsg before it used __slots__
+class dictModbusMsg:
+    def __init__(self,regAdd: int,regCount: int, modFunc: int, devAdd: int,opType: int, regDataArr,valid : bool):
+        self.devAdd = devAdd
+        self.regAdd = regAdd
+        self.regCount = regCount
+        self.modfunc = modFunc
+        self.regData = regDataArr
+        self.valid   = valid
+        self.transactionType = opType
+
+
+def sampleRequest(index: int) -> dict:
+    return {
+                "cmdName"   :"read_power",
+                "uuid"      :f"req-{index}",
+                "devId"     :"meter-01",
+                "devProfile":"sdm630",
+                "modfunc"   :3,
+                "devAdd"    :1 + index % 8,
+                "regAdd"    :index % 100,
+                "regCount"  :2,
+                "regData"   :[],
+           }
+
+
+def convertBursts(requests: list,pool: mqtt2modbus.modbusMsgPool,keep: list):
+    for start in range(0,len(requests),BURST):
+        for modbusMsg, mqttResponse in mqtt2modbus.mqttMsgs2ModbusMsgs(requests[start:start + BURST],pool):
+            keep.append(mqttResponse)
+            if pool.capacity > 0:
+                pool.release(modbusMsg)
+            else:
+                keep.append(modbusMsg)
+
+
+def benchPool(capacity: int,number: int) -> dict:
+    pool = mqtt2modbus.modbusMsgPool(capacity)
+    requests = [sampleRequest(index) for index in range(number)]
+
+    #Warm the pool up so only the steady state is measured
+    convertBursts(requests[:BURST],pool,[])
+
+    keep = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    convertBursts(requests,pool,keep)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = [stat for stat in after.compare_to(before,"filename") if stat.size_diff > 0]
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+
+    seconds = timeit.timeit(lambda: convertBursts(requests,pool,[]),number=5) / (5 * number)
+
+    return {"pool": capacity,"blocks_per_request": blocks / number,"bytes_per_request": size / number,"convert_us": seconds * 1e6}
+
+
+def messageSize(cls) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    msgs = [cls(0,2,3,1,0,[],True) for _ in range(1000)]
+    size = (tracemalloc.get_traced_memory()[0] - before) / len(msgs)
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    number = 20000
+    results = {
+                "requests"       : [benchPool(0,number),benchPool(mqtt2modbus.MODBUS_MSG_POOL_SIZE,number)],
+                "modbusMsg_bytes": {"slots": messageSize(mqtt2modbus.modbusMsg),"dict": messageSize(dictModbusMsg)},
+              }
+
+    if "--json" in sys.argv:
+        print(json.dumps(results,indent=2))
+        return
+
+    print(f"{'pool':>6}{'blocks/req':>12}{'bytes/req':>12}{'convert us':>12}")
+    for result in results["requests"]:
+        print(f"{result['pool']:>6}{result['blocks_per_request']:>12.2f}{result['bytes_per_request']:>12.1f}{result['convert_us']:>12.2f}")
+
+    print(f"modbusMsg bytes: {results['modbusMsg_bytes']['slots']:.0f} with __slots__, {results['modbusMsg_bytes']['dict']:.0f} with __dict__")
+
+
+if __name__ == "__main__":
+    main()
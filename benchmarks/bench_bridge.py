@@ -0,0 +1,204 @@
+#End-to-end benchmark of the real bridge code against simulated RTU slaves (see rtusim.py) on a pty and an
+#in-process MQTT stand-in (see mqttstub.py). Nothing leaves the machine.
+#
+#Every scenario runs in a fresh process: a closed loop load generator keeps "window" requests outstanding,
+#injecting them through on_message and timing them until their response is published. The simulator runs in
+#its own process, so CPU and memory figures cover the bridge and the load generator only.
+#
+#   python -m benchmarks.bench_bridge [--scenario NAME ...] [--duration S] [--transport minimalmodbus|asyncio]
+#                                     [--baudrate N] [--json] [--out FILE]
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+
+#devices => slaves on the bus, window => outstanding requests, writes => share of writes,
+#dead => how many of the slaves never answer
+SCENARIOS = {
+    "flood"        : {"devices": 1, "window": 32,"writes": 0.0,"dead": 0},
+    "many_devices" : {"devices": 32,"window": 64,"writes": 0.0,"dead": 0},
+    "mixed"        : {"devices": 8, "window": 32,"writes": 0.3,"dead": 0},
+    "dead_slave"   : {"devices": 8, "window": 32,"writes": 0.0,"dead": 1},
+}
+
+#Seconds run before measuring
+WARMUP = 1.0
+
+
+def makeRequest(rng: random.Random,index: int,devices: int,writes: float) -> dict:
+    request = {
+                "cmdName"   :"bench",
+                "uuid"      :str(index),
+                "devId"     :"",
+                "devProfile":"",
+                "devAdd"    :rng.randint(1,devices),
+                "regAdd"    :rng.randrange(0,100),
+              }
+
+    if rng.random() >= writes:
+        return request | {"modfunc": 3,"regCount": 2,"regData": []}
+    if rng.random() < 0.5:
+        return request | {"modfunc": 6,"regCount": 1,"regData": [index & 0xFFFF]}
+    return request | {"modfunc": 16,"regCount": 4,"regData": [(index + i) & 0xFFFF for i in range(4)]}
+
+
+def percentile(samples: list,q: float) -> float:
+    if len(samples) == 0:
+        return 0
+    return samples[min(int(q * len(samples)),len(samples) - 1)]
+
+
+def runScenario(name: str,duration: float,transport: str,baudrate: int,busTimeout: float,delay: float) -> dict:
+    from benchmarks import rtusim
+    from benchmarks import mqttstub
+
+    config = SCENARIOS[name]
+
+    #Start the slaves before any thread exists => the simulator gets a clean fork
+    slaves = [rtusim.rtuSlave(devAdd,delay,dead=devAdd <= config["dead"]) for devAdd in range(1,config["devices"] + 1)]
+    simulator = rtusim.rtuSlaveSimulator(slaves,baudrate)
+    port = simulator.open()
+    simulatorProcess = multiprocessing.get_context("fork").Process(target=simulator.serve,daemon=True)
+    simulatorProcess.start()
+
+    import pyRTOS
+    import mqtt_modbus_bridge as bridge
+
+    #Per message debug logs would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sent = {}
+    latencies = []
+    results = collections.Counter()
+    slots = threading.Semaphore(config["window"])
+    measuring = False
+
+    def onPublish(topic,payload,now):
+        if not topic.startswith(bridge.MODBUS_RESP_TOPIC):
+            return
+        response = json.loads(payload)
+        start = sent.pop(response.get("uuid"),None)
+        if start == None:
+            return
+        if measuring:
+            latencies.append(now - start)
+            results[response.get("result")] += 1
+        slots.release()
+
+    client = mqttstub.stubMqttClient(onPublish)
+    bridge.setup(client,[{"name": "sim","port": port,"baudrate": baudrate,"timeout": busTimeout,"transport": transport,"rs485": False}])
+    bridge.start()
+    threading.Thread(target=pyRTOS.start,args=(pyRTOS.EventScheduler(),),daemon=True).start()
+
+    rng = random.Random(1)
+    lost = 0
+    index = 0
+    warmupEnd = time.monotonic() + WARMUP
+    end = warmupEnd + duration
+
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+
+        if not measuring and now >= warmupEnd:
+            measuring = True
+            latencies.clear()
+            results.clear()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            measureStart = now
+
+        #A request whose response never came (dropped) gives its slot back after a while
+        if not slots.acquire(timeout=2):
+            lost += 1
+
+        request = makeRequest(rng,index,config["devices"],config["writes"])
+        index += 1
+        sent[request["uuid"]] = time.monotonic()
+        client.inject(bridge.MODBUS_CMD_TOPIC,json.dumps(request).encode())
+
+    elapsed = time.monotonic() - measureStart
+    usageEnd = resource.getrusage(resource.RUSAGE_SELF)
+    simulatorProcess.terminate()
+
+    latencies.sort()
+    cpu = (usageEnd.ru_utime - usage.ru_utime) + (usageEnd.ru_stime - usage.ru_stime)
+    resultNames = {status.value: status.name for status in bridge.mqtt2modbus.mqtt2Modbus_ErrorStatus}
+
+    return {
+                "scenario"   : name,
+                "transport"  : transport,
+                "baudrate"   : baudrate,
+                "duration"   : elapsed,
+                "responses"  : len(latencies),
+                "req_per_s"  : len(latencies) / elapsed,
+                "p50_ms"     : percentile(latencies,0.5) * 1000,
+                "p99_ms"     : percentile(latencies,0.99) * 1000,
+                "max_ms"     : (latencies[-1] if latencies else 0) * 1000,
+                "results"    : {resultNames.get(result,str(result)): count for result, count in results.items()},
+                "lost"       : lost,
+                "cpu_percent": 100 * cpu / elapsed,
+                "max_rss_kb" : usageEnd.ru_maxrss,
+           }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end bridge benchmark against simulated RTU slaves")
+    parser.add_argument("--scenario",action="append",choices=list(SCENARIOS),help="scenario to run (default: all)")
+    parser.add_argument("--duration",type=float,default=5,help="measured seconds per scenario")
+    parser.add_argument("--transport",default="minimalmodbus",choices=["minimalmodbus","asyncio"])
+    parser.add_argument("--baudrate",type=int,default=38400)
+    parser.add_argument("--timeout",type=float,default=1.0,help="bus timeout in seconds")
+    parser.add_argument("--delay",type=float,default=0.002,help="slave response delay in seconds")
+    parser.add_argument("--json",action="store_true",help="print results as json")
+    parser.add_argument("--out",help="also write the json results to this file")
+    parser.add_argument("--child",help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child != None:
+        result = runScenario(args.child,args.duration,args.transport,args.baudrate,args.timeout,args.delay)
+        print(json.dumps(result),flush=True)
+        #Bridge threads never return
+        os._exit(0)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        command = [sys.executable,"-m","benchmarks.bench_bridge","--child",name,"--duration",str(args.duration),
+                   "--transport",args.transport,"--baudrate",str(args.baudrate),"--timeout",str(args.timeout),
+                   "--delay",str(args.delay)]
+        child = subprocess.run(command,cwd=root,capture_output=True,text=True,timeout=args.duration + WARMUP + 60)
+        if child.returncode != 0 or not child.stdout.strip():
+            results.append({"scenario": name,"error": child.stderr.strip().splitlines()[-1:] or [f"exit code {child.returncode}"]})
+            continue
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    if args.out != None:
+        with open(args.out,"w") as outFile:
+            json.dump(results,outFile,indent=2)
+
+    if args.json:
+        print(json.dumps(results,indent=2))
+        return
+
+    print(f"{'scenario':<14}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'cpu %':>8}{'rss MB':>8}  results")
+    for result in results:
+        if "error" in result:
+            print(f"{result['scenario']:<14}  failed: {result['error']}")
+            continue
+        print(f"{result['scenario']:<14}{result['req_per_s']:>9.1f}{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+              f"{result['cpu_percent']:>8.1f}{result['max_rss_kb'] / 1024:>8.1f}  {result['results']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#Compares encode/decode cost and payload size of the payload codecs for typical request and response shapes.
+#
+#   python -m benchmarks.bench_codec [--json]
+
+import json
+import sys
+import timeit
+from mqtt2modbus import codec
+
+
+def sampleMessages() -> dict:
+    request = {
+                "cmdName"   :"read_power",
+                "uuid"      :"6f1c2a4e-8d0b-4c55-9a3e-2f7d1b9c0e11",
+                "devId"     :"meter-01",
+                "devProfile":"sdm630",
+                "modfunc"   :3,
+                "devAdd"    :1,
+                "regAdd"    :0,
+                "regCount"  :2,
+                "regData"   :[],
+              }
+
+    smallResponse = request | {"regData": [17221,12288],"result": 8}
+    largeResponse = request | {"regCount": 120,"regData": [(i * 2654435761) & 0xFFFF for i in range(120)],"result": 8}
+
+    return {"request": request,"response_2_regs": smallResponse,"response_120_regs": largeResponse}
+
+
+def benchCodec(payloadCodec,msg: dict,number: int) -> dict:
+    payload = payloadCodec.encode(msg)
+    encode = timeit.timeit(lambda: payloadCodec.encode(msg),number=number) / number
+    decode = timeit.timeit(lambda: payloadCodec.decode(payload),number=number) / number
+
+    return {"bytes": len(payload),"encode_us": encode * 1e6,"decode_us": decode * 1e6}
+
+
+def main():
+    number = 20000
+    results = []
+
+    for shape, msg in sampleMessages().items():
+        for name, payloadCodec in codec.payloadCodecs.items():
+            results.append({"codec": name,"shape": shape} | benchCodec(payloadCodec,msg,number))
+
+    if "--json" in sys.argv:
+        print(json.dumps(results,indent=2))
+        return
+
+    print(f"{'shape':<20}{'codec':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for result in results:
+        print(f"{result['shape']:<20}{result['codec']:<10}{result['bytes']:>8}{result['encode_us']:>12.2f}{result['decode_us']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#In-process stand-in for the paho client => drives the real bridge callbacks without a broker.
+#inject() delivers a message to on_message like the paho network thread would, publish() hands every
+#published message to the onPublish callback and acknowledges it right away (on_publish).
+
+import itertools
+import time
+
+
+class stubMessage:
+    def __init__(self,topic: str,payload: bytes):
+        self.topic = topic
+        self.payload = payload
+        self.properties = None
+
+
+class stubReasonCode:
+    is_failure = False
+
+
+class stubPublishInfo:
+    def __init__(self,mid: int):
+        self.mid = mid
+        self.rc = 0
+
+    def is_published(self) -> bool:
+        return True
+
+
+class stubMqttClient:
+    def __init__(self,onPublish=None):
+        self.onPublish = onPublish
+        self.subscriptions = []
+        self.mids = itertools.count(1)
+
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+        self.on_publish = None
+
+    def connect(self,host,port=1883,keepalive=60):
+        return 0
+
+    def loop_start(self):
+        self.on_connect(self,None,None,0,None)
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self,topic,qos=0):
+        self.subscriptions.append(topic)
+
+    def publish(self,topic,payload=None,qos=0,retain=False,properties=None):
+        if self.onPublish != None:
+            self.onPublish(topic,payload,time.monotonic())
+        info = stubPublishInfo(next(self.mids))
+        if self.on_publish != None:
+            self.on_publish(self,None,info.mid,stubReasonCode(),None)
+        return info
+
+    def inject(self,topic: str,payload: bytes):
+        self.on_message(self,None,stubMessage(topic,payload))
@@ -0,0 +1,124 @@
+#Simulated Modbus RTU slaves on a pty pair.
+#The bridge opens the pty's slave end like a serial port, the simulator answers on the master end.
+#Every answer is delayed by the wire time of request and response at the simulated baud rate (11 bits per
+#character) plus the slave's response delay, so the simulated bus is as slow as a real one.
+
+import os
+import pty
+import struct
+import time
+import tty
+from mqtt2modbus import asyncrtu
+
+
+class rtuSlave:
+    def __init__(self,devAdd: int,delay: float = 0.002,dead: bool = False):
+        self.devAdd = devAdd
+        self.delay = delay
+        self.dead = dead
+        self.registers = {}
+        self.coils = {}
+
+    def register(self,regAdd: int) -> int:
+        return self.registers.get(regAdd,(self.devAdd * 1000 + regAdd) & 0xFFFF)
+
+    def coil(self,regAdd: int) -> int:
+        return self.coils.get(regAdd,regAdd & 1)
+
+    #Response PDU (function code onwards) for a request PDU
+    def handle(self,pdu: bytes) -> bytes:
+        modfunc = pdu[0]
+
+        match modfunc:
+            case 1 | 2:
+                regAdd, count = struct.unpack_from(">HH",pdu,1)
+                bits = bytearray((count + 7) // 8)
+                for i in range(count):
+                    if self.coil(regAdd + i):
+                        bits[i // 8] |= 1 << (i % 8)
+                return bytes([modfunc,len(bits)]) + bits
+
+            case 3 | 4:
+                regAdd, count = struct.unpack_from(">HH",pdu,1)
+                return bytes([modfunc,2 * count]) + struct.pack(f">{count}H",*(self.register(regAdd + i) for i in range(count)))
+
+            case 5:
+                regAdd, value = struct.unpack_from(">HH",pdu,1)
+                self.coils[regAdd] = 1 if value == 0xFF00 else 0
+                return pdu
+
+            case 6:
+                regAdd, value = struct.unpack_from(">HH",pdu,1)
+                self.registers[regAdd] = value
+                return pdu
+
+            case 15:
+                regAdd, count = struct.unpack_from(">HH",pdu,1)
+                for i in range(count):
+                    self.coils[regAdd + i] = (pdu[6 + i // 8] >> (i % 8)) & 1
+                return pdu[:5]
+
+            case 16:
+                regAdd, count = struct.unpack_from(">HH",pdu,1)
+                for i, value in enumerate(struct.unpack_from(f">{count}H",pdu,6)):
+                    self.registers[regAdd + i] = value
+                return pdu[:5]
+
+        #Illegal function
+        return bytes([modfunc | 0x80,1])
+
+
+class rtuSlaveSimulator:
+    def __init__(self,slaves: list,baudrate: int):
+        self.slaves = {slave.devAdd: slave for slave in slaves}
+        self.baudrate = baudrate
+        self.master = None
+        self.port = None
+        self.requests = 0
+
+    #Create the pty pair => returns the port the bridge has to open
+    def open(self) -> str:
+        self.master, slaveFd = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slaveFd)
+        self.port = os.ttyname(slaveFd)
+        return self.port
+
+    @staticmethod
+    def frameLength(buffer: bytes) -> int | None:
+        if len(buffer) < 2:
+            return None
+        if buffer[1] in (15,16):
+            return 9 + buffer[6] if len(buffer) >= 7 else None
+        return 8
+
+    def serve(self):
+        buffer = b""
+
+        while True:
+            buffer += os.read(self.master,512)
+
+            while True:
+                length = self.frameLength(buffer)
+                if length == None or len(buffer) < length:
+                    break
+
+                frame, buffer = buffer[:length], buffer[length:]
+                if asyncrtu.modbusCrc(frame[:-2]) != struct.unpack("<H",frame[-2:])[0]:
+                    #Lost sync => drop whatever is buffered
+                    buffer = b""
+                    break
+
+                self.requests += 1
+                self.answer(frame)
+
+    def answer(self,frame: bytes):
+        slave = self.slaves.get(frame[0])
+        if slave == None or slave.dead:
+            return
+
+        response = bytes([slave.devAdd]) + slave.handle(frame[1:-2])
+        response += struct.pack("<H",asyncrtu.modbusCrc(response))
+
+        time.sleep((len(frame) + len(response)) * 11 / self.baudrate + slave.delay)
+        os.write(self.master,response)
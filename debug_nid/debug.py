@@ -1,4 +1,102 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
 
-#Setting up logging module
-logging.basicConfig(format='%(asctime)s - %(message)s - %(levelname)s', datefmt='%d-%b-%y %H:%M:%S',level=logging.DEBUG)
\ No newline at end of file
+#Log level => LOG_LEVEL environment variable (level name or number)
+LOG_LEVEL = os.getenv('LOG_LEVEL','INFO')
+
+#Records waiting for the background writer. Records logged while it is full are dropped (see dropped())
+LOG_QUEUE_SIZE = 1024
+
+#At most LOG_RATE_BURST records per call site within LOG_RATE_WINDOW seconds, the rest are counted and
+#reported with the next record of that call site that gets through. 0 disables rate limiting.
+LOG_RATE_WINDOW = 10
+LOG_RATE_BURST = 20
+
+LOG_FORMAT = '%(asctime)s - %(message)s - %(levelname)s'
+LOG_DATE_FORMAT = '%d-%b-%y %H:%M:%S'
+
+
+#Limits how often the same call site (file, line, level) may log
+class rateLimitFilter(logging.Filter):
+    def __init__(self,window: float,burst: int):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        #call site -> [window start,records in window,suppressed in window]
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self,record: logging.LogRecord) -> bool:
+        key = (record.pathname,record.lineno,record.levelno)
+        now = time.monotonic()
+
+        with self.lock:
+            site = self.sites.get(key)
+            if site == None or now - site[0] >= self.window:
+                suppressed = site[2] if site != None else 0
+                self.sites[key] = [now,1,0]
+            elif site[1] < self.burst:
+                site[1] += 1
+                return True
+            else:
+                site[2] += 1
+                return False
+
+        if suppressed > 0:
+            record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+        return True
+
+
+#Hands records to the background writer without blocking => a full queue drops the record instead.
+#Messages are formatted by the writer, so only records that pass the level and rate limit cost anything
+#on the logging thread. Arguments must not be modified after they were logged.
+class boundedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self,logQueue: queue.Queue):
+        super().__init__(logQueue)
+        self.dropped = 0
+
+    def prepare(self,record: logging.LogRecord) -> logging.LogRecord:
+        #Tracebacks have to be rendered while they still exist
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self,record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def dropped() -> int:
+    return queueHandler.dropped
+
+
+def setLevel(level):
+    logging.getLogger().setLevel(level.upper() if isinstance(level,str) and not level.isdigit() else int(level))
+
+
+#Setting up logging module => records are written to stderr by a background thread
+logQueue = queue.Queue(LOG_QUEUE_SIZE)
+
+streamHandler = logging.StreamHandler()
+streamHandler.setFormatter(logging.Formatter(LOG_FORMAT,datefmt=LOG_DATE_FORMAT))
+
+queueHandler = boundedQueueHandler(logQueue)
+if LOG_RATE_WINDOW > 0:
+    queueHandler.addFilter(rateLimitFilter(LOG_RATE_WINDOW,LOG_RATE_BURST))
+
+logging.getLogger().addHandler(queueHandler)
+setLevel(LOG_LEVEL)
+
+logListener = logging.handlers.QueueListener(logQueue,streamHandler)
+logListener.start()
+
+#Flush what is still queued on exit
+atexit.register(logListener.stop)
@@ -1 +1,15 @@
+from mqtt2modbus.registerdecoder import *
+from mqtt2modbus.profiles import *
 from mqtt2modbus.mqtt2modbus import *
+from mqtt2modbus.asyncrtu import *
+from mqtt2modbus.readcache import *
+from mqtt2modbus.registerimage import *
+from mqtt2modbus.batch import *
+from mqtt2modbus.requestscheduler import *
+from mqtt2modbus.slavehealth import *
+from mqtt2modbus.stats import *
+from mqtt2modbus.modbusbus import *
+from mqtt2modbus.poller import *
+from mqtt2modbus.codec import *
+from mqtt2modbus.publisher import *
+from mqtt2modbus.tcpserver import *
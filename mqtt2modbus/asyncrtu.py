@@ -0,0 +1,291 @@
+import asyncio
+import fcntl
+import os
+import struct
+import termios
+import threading
+from mqtt2modbus import mqtt2modbus
+
+
+#Non blocking Modbus RTU transport built on asyncio.
+#
+#The end of a response frame is found from the response length each function code implies, so a
+#transaction completes as soon as the last byte is on the wire instead of when a read times out.
+#If the slave sends something unexpected the frame is closed after 3.5 character times of silence.
+#All transports share one event loop running in its own thread; asyncRtuInstrument wraps a transport
+#in the subset of the minimalmodbus.Instrument API used by modbusMsgTransact.
+
+
+#serial_rs485 flags (linux/serial.h)
+SER_RS485_ENABLED        = 1
+SER_RS485_RTS_ON_SEND    = 2
+SER_RS485_RTS_AFTER_SEND = 4
+TIOCSRS485               = 0x542F
+
+
+class modbusRtuError(IOError):
+    pass
+
+class modbusNoResponseError(modbusRtuError):
+    pass
+
+class modbusCrcError(modbusRtuError):
+    pass
+
+class modbusSlaveError(modbusRtuError):
+    def __init__(self,exceptionCode: int):
+        super().__init__(f"Slave replied with exception code {exceptionCode}")
+        self.exceptionCode = exceptionCode
+
+
+def modbusCrcTable() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+#CRC-16/MODBUS lookup table
+crcTable = modbusCrcTable()
+
+def modbusCrc(frame: bytes) -> int:
+    crc = 0xFFFF
+    for byte in frame:
+        crc = (crc >> 8) ^ crcTable[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def modbusResponseLength(pdu: bytes) -> int:
+
+    #Expected length of the whole RTU response (address + pdu + crc) to a request pdu
+    modfunc = pdu[0]
+    match modfunc:
+        case 1 | 2:
+            count = struct.unpack_from(">H",pdu,3)[0]
+            return 5 + (count + 7) // 8
+        case 3 | 4:
+            count = struct.unpack_from(">H",pdu,3)[0]
+            return 5 + 2 * count
+        case 5 | 6 | 15 | 16:
+            return 8
+
+    return 0
+
+
+#Shared event loop for every transport
+eventLoop = None
+eventLoopLock = threading.Lock()
+
+def modbusEventLoop() -> asyncio.AbstractEventLoop:
+    global eventLoop
+
+    with eventLoopLock:
+        if eventLoop == None:
+            eventLoop = asyncio.new_event_loop()
+            threading.Thread(target=eventLoop.run_forever,name="modbus_rtu_loop",daemon=True).start()
+
+    return eventLoop
+
+
+class asyncRtuTransport:
+    def __init__(self,port: str,baudrate: int,timeout: float,rs485: bool = True,loop: asyncio.AbstractEventLoop = None):
+        self.port = port
+        self.baudrate = baudrate
+        #Upper bound for a whole transaction, the frame itself ends on length or silence
+        self.timeout = timeout
+        self.rs485 = rs485
+        self.loop = loop if loop != None else modbusEventLoop()
+        self.fd = None
+        self.lock = None
+
+    #Raises IOError if the port is unavailable or does not support the baud rate
+    def open(self):
+        speed = getattr(termios,f"B{self.baudrate}",None)
+        if speed == None:
+            raise IOError(f"{self.port}: unsupported baud rate {self.baudrate}")
+
+        self.fd = os.open(self.port,os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+
+        try:
+            #Raw 8N1, reads never block
+            attrs = termios.tcgetattr(self.fd)
+            cc = attrs[6]
+            cc[termios.VMIN] = 0
+            cc[termios.VTIME] = 0
+            termios.tcsetattr(self.fd,termios.TCSANOW,[0,0,termios.CS8 | termios.CREAD | termios.CLOCAL,0,speed,speed,cc])
+
+            #Let the uart driver toggle RTS => RTS low while sending, high afterwards
+            if self.rs485:
+                fcntl.ioctl(self.fd,TIOCSRS485,struct.pack("8I",SER_RS485_ENABLED | SER_RS485_RTS_AFTER_SEND,0,0,0,0,0,0,0))
+        except:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def close(self):
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+
+    async def transact(self,slave: int,pdu: bytes) -> bytes:
+
+        #One transaction at a time per bus
+        if self.lock == None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            frame = bytes([slave]) + pdu
+            frame += struct.pack("<H",modbusCrc(frame))
+
+            #Drop anything left over from a previous, abandoned transaction
+            termios.tcflush(self.fd,termios.TCIFLUSH)
+            await self.write(frame)
+
+            #Broadcasts are never answered
+            if slave == 0:
+                return b""
+
+            response = await asyncio.wait_for(self.readFrame(modbusResponseLength(pdu)),self.timeout)
+
+        return self.checkResponse(slave,pdu[0],response)
+
+    async def write(self,frame: bytes):
+        while len(frame) > 0:
+            try:
+                written = os.write(self.fd,frame)
+                frame = frame[written:]
+            except BlockingIOError:
+                written = 0
+
+            if len(frame) > 0:
+                ready = self.loop.create_future()
+                self.loop.add_writer(self.fd,ready.set_result,None)
+                try:
+                    await ready
+                finally:
+                    self.loop.remove_writer(self.fd)
+
+    def readFrame(self,expectedLength: int) -> asyncio.Future:
+        done = self.loop.create_future()
+        buffer = bytearray()
+        silence = mqtt2modbus.modbusSilentInterval(self.baudrate)
+        silenceTimer = None
+
+        def finish():
+            self.loop.remove_reader(self.fd)
+            if silenceTimer != None:
+                silenceTimer.cancel()
+            if not done.done():
+                done.set_result(bytes(buffer))
+
+        def onSilence():
+            #Fallback for frames of unexpected length => 3.5 characters without a byte ends the frame
+            if len(buffer) >= 4:
+                finish()
+
+        def onReadable():
+            nonlocal silenceTimer, expectedLength
+
+            try:
+                buffer.extend(os.read(self.fd,256))
+            except BlockingIOError:
+                return
+
+            #Exception responses are always 5 bytes long
+            if len(buffer) >= 2 and buffer[1] & 0x80:
+                expectedLength = 5
+
+            if expectedLength and len(buffer) >= expectedLength:
+                finish()
+                return
+
+            if silenceTimer != None:
+                silenceTimer.cancel()
+            silenceTimer = self.loop.call_later(silence,onSilence)
+
+        def onCancel(future):
+            if future.cancelled():
+                self.loop.remove_reader(self.fd)
+                if silenceTimer != None:
+                    silenceTimer.cancel()
+
+        done.add_done_callback(onCancel)
+        self.loop.add_reader(self.fd,onReadable)
+        return done
+
+    def checkResponse(self,slave: int,modfunc: int,response: bytes) -> bytes:
+        if len(response) < 4:
+            raise modbusNoResponseError(f"No response from slave {slave}")
+
+        if modbusCrc(response[:-2]) != struct.unpack_from("<H",response,len(response) - 2)[0]:
+            raise modbusCrcError(f"CRC error in response from slave {slave}")
+
+        if response[0] != slave:
+            raise modbusRtuError(f"Response from slave {response[0]}, expected {slave}")
+
+        if response[1] == modfunc | 0x80:
+            raise modbusSlaveError(response[2])
+
+        if response[1] != modfunc:
+            raise modbusRtuError(f"Response to function {response[1]}, expected {modfunc}")
+
+        #Return the pdu without the function code
+        return response[2:-2]
+
+    def run(self,slave: int,pdu: bytes) -> bytes:
+        #Blocking call for threads outside the event loop
+        try:
+            return asyncio.run_coroutine_threadsafe(self.transact(slave,pdu),self.loop).result()
+        except asyncio.TimeoutError:
+            raise modbusNoResponseError(f"No response from slave {slave}")
+
+
+#Drop in for minimalmodbus.Instrument on top of an asyncRtuTransport.
+#"serial" points at the transport, so handle.serial.timeout / handle.serial.baudrate work for both.
+class asyncRtuInstrument:
+    def __init__(self,transport: asyncRtuTransport,slaveaddress: int = 0):
+        self.serial = transport
+        self.address = slaveaddress
+
+    def read_bit(self,registeraddress: int,functioncode: int = 2) -> int:
+        return self.read_bits(registeraddress,1,functioncode)[0]
+
+    def read_bits(self,registeraddress: int,number_of_bits: int,functioncode: int = 2) -> list:
+        data = self.serial.run(self.address,struct.pack(">BHH",functioncode,registeraddress,number_of_bits))
+        return [(data[1 + bit // 8] >> (bit % 8)) & 1 for bit in range(number_of_bits)]
+
+    def read_registers(self,registeraddress: int,number_of_registers: int,functioncode: int = 3) -> list:
+        data = self.serial.run(self.address,struct.pack(">BHH",functioncode,registeraddress,number_of_registers))
+        if data[0] != 2 * number_of_registers:
+            raise modbusRtuError(f"Expected {2 * number_of_registers} data bytes, got {data[0]}")
+        return list(struct.unpack_from(f">{number_of_registers}H",data,1))
+
+    def read_register(self,registeraddress: int,number_of_decimals: int = 0,functioncode: int = 3,signed: bool = False):
+        value = self.read_registers(registeraddress,1,functioncode)[0]
+        if signed and value >= 0x8000:
+            value -= 0x10000
+        return value / 10 ** number_of_decimals if number_of_decimals else value
+
+    def write_bit(self,registeraddress: int,value: int,functioncode: int = 5):
+        if functioncode == 15:
+            return self.write_bits(registeraddress,[value])
+        self.serial.run(self.address,struct.pack(">BHH",5,registeraddress,0xFF00 if value else 0))
+
+    def write_bits(self,registeraddress: int,values: list):
+        packed = bytearray((len(values) + 7) // 8)
+        for bit, value in enumerate(values):
+            if value:
+                packed[bit // 8] |= 1 << (bit % 8)
+        self.serial.run(self.address,struct.pack(">BHHB",15,registeraddress,len(values),len(packed)) + packed)
+
+    def write_register(self,registeraddress: int,value,number_of_decimals: int = 0,functioncode: int = 16,signed: bool = False):
+        value = int(round(value * 10 ** number_of_decimals)) & 0xFFFF
+        if functioncode == 6:
+            self.serial.run(self.address,struct.pack(">BHH",6,registeraddress,value))
+        else:
+            self.write_registers(registeraddress,[value])
+
+    def write_registers(self,registeraddress: int,values: list):
+        self.serial.run(self.address,struct.pack(f">BHHB{len(values)}H",16,registeraddress,len(values),2 * len(values),*values))
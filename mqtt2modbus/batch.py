@@ -0,0 +1,88 @@
+import threading
+from mqtt2modbus import mqtt2modbus
+
+
+#Batch envelopes carry many commands in one MQTT message:
+#
+#   {"batchId": "...", "commands": [{...request...}, {...request...}, ...]}
+#
+#They travel through the request queue as one unit, are split into one part per bus, and are answered with a
+#single aggregated response once every command completed:
+#
+#   {"batchId": "...", "result": <OK or the result of the first failed command>, "items": [{...response...}, ...]}
+
+#Largest number of commands accepted in one envelope
+MODBUS_MAX_BATCH = 256
+
+
+def isMqttBatch(mqttMsg: dict) -> bool:
+    return "commands" in mqttMsg
+
+
+class modbusBatch:
+    def __init__(self,envelope: dict,publish):
+        self.envelope = envelope
+        self.commands = envelope["commands"]
+        #Not validated yet => envelopes without a command list can still be rejected
+        count = len(self.commands) if isinstance(self.commands,list) else 0
+        self.items = [None] * count
+        self.remaining = count
+        self.publish = publish
+        self.lock = threading.Lock()
+
+    #Returns an error status if the envelope can not be executed
+    def validate(self) -> mqtt2modbus.mqtt2Modbus_ErrorStatus | None:
+        if not isinstance(self.commands,list) or len(self.commands) == 0 or len(self.commands) > MODBUS_MAX_BATCH:
+            return mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_PARAMETER
+        if not all(isinstance(command,dict) for command in self.commands):
+            return mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_PARAMETER
+        return None
+
+    def response(self,result: int) -> dict:
+        response = {"batchId": self.envelope.get("batchId",""),"result": result,"items": self.items}
+        mqtt2modbus.copyMsgContext(self.envelope,response)
+        return response
+
+    def reject(self,result: mqtt2modbus.mqtt2Modbus_ErrorStatus):
+        self.items = []
+        self.publish(self.response(result.value))
+
+    #Split the commands into one part per bus. route() maps a command onto its bus or None.
+    #Commands no bus serves are answered right away with INVALID_DEV_ADDRESS.
+    def split(self,route) -> list:
+        parts = {}
+
+        for index, command in enumerate(self.commands):
+            bus = route(command)
+            if bus == None:
+                self.complete(index,mqtt2modbus.mqttMsg2ErrorResponse(command,mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_DEV_ADDRESS))
+                continue
+
+            if bus not in parts:
+                parts[bus] = modbusBatchPart(self)
+            parts[bus].items.append((index,command))
+
+        return list(parts.items())
+
+    #Called from the bus workers => publishes the aggregated response with the last completed command
+    def complete(self,index: int,mqttResponse: dict):
+        with self.lock:
+            self.items[index] = mqttResponse
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+
+        ok = mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value
+        result = next((item["result"] for item in self.items if item["result"] != ok),ok)
+        self.publish(self.response(result))
+
+
+#The commands of a batch served by one bus, queued as a single entry
+class modbusBatchPart:
+    def __init__(self,batch: modbusBatch):
+        self.batch = batch
+        #(index in batch,command)
+        self.items = []
+
+    def replier(self,index: int):
+        return lambda mqttResponse: self.batch.complete(index,mqttResponse)
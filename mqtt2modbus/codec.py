@@ -0,0 +1,200 @@
+import array
+import json
+import struct
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+#Payload codecs for requests and responses.
+#Keys starting with "_" are bridge-internal request context and are never encoded.
+
+
+def publicItems(msg: dict) -> dict:
+    return {key: value for key, value in msg.items() if not key.startswith("_")}
+
+def packWords(regData) -> bytes | None:
+    #Register arrays travel as big endian 16 bit words => None if regData does not fit
+    try:
+        words = array.array("H",regData)
+    except (TypeError,OverflowError):
+        return None
+
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words.tobytes()
+
+def unpackWords(packed: bytes) -> list:
+    words = array.array("H")
+    words.frombytes(packed)
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words.tolist()
+
+
+class jsonCodec:
+    name = "json"
+    contentType = "application/json"
+
+    def encode(self,msg: dict) -> bytes:
+        return json.dumps(publicItems(msg),separators=(",",":")).encode()
+
+    def decode(self,payload: bytes):
+        return json.loads(payload)
+
+
+#Compact fixed layout for the standard request/response fields:
+#
+#   B version | B flags | B modfunc | B devAdd | H regAdd | H regCount | B result (0xFF => none)
+#   4 x (B length + utf-8)          => cmdName, uuid, devId, devProfile
+#   H word count + words            => regData as big endian 16 bit words
+#   H length + json                 => any other field (only when FLAG_EXTRA is set)
+#
+#All integers are big endian. Fields that do not fit the layout (missing register layout, values that are
+#not 16 bit words, extra keys) fall back to the json extension, so every message round trips.
+class packedCodec:
+    name = "packed"
+    contentType = "application/vnd.modbus-mqtt.packed"
+
+    VERSION        = 1
+    FLAG_SCALAR    = 0x01      #regData was a single value rather than a list
+    FLAG_NO_LAYOUT = 0x02      #modfunc/regAdd/regCount absent (profile command)
+    FLAG_EXTRA     = 0x04      #json extension follows
+    FLAG_NO_DATA   = 0x08      #regData absent
+
+    header = struct.Struct(">BBBBHHB")
+    strings = ("cmdName","uuid","devId","devProfile")
+    fixed = ("cmdName","uuid","devId","devProfile","modfunc","devAdd","regAdd","regCount","regData","result")
+
+    def encode(self,msg: dict) -> bytes:
+        flags = 0
+        extra = {key: value for key, value in msg.items() if not key.startswith("_") and key not in self.fixed}
+
+        if "modfunc" in msg and "regAdd" in msg and "regCount" in msg:
+            layout = (msg["modfunc"],msg["devAdd"],msg["regAdd"],msg["regCount"])
+        else:
+            flags |= self.FLAG_NO_LAYOUT
+            layout = (0,msg.get("devAdd",0),0,0)
+
+        regData = msg.get("regData")
+        if "regData" not in msg:
+            flags |= self.FLAG_NO_DATA
+            packed = b""
+        else:
+            if isinstance(regData,int) and not isinstance(regData,bool):
+                flags |= self.FLAG_SCALAR
+                regData = [regData]
+            packed = packWords(regData) if isinstance(regData,list) else None
+            if packed == None:
+                flags |= self.FLAG_NO_DATA
+                extra["regData"] = msg["regData"]
+                packed = b""
+
+        result = msg.get("result",0xFF)
+
+        try:
+            self.header.pack(self.VERSION,flags,*layout,result)
+        except struct.error:
+            #Layout does not fit the header => carry it in the extension
+            flags |= self.FLAG_NO_LAYOUT
+            for key in ("modfunc","devAdd","regAdd","regCount","result"):
+                if key in msg:
+                    extra[key] = msg[key]
+            layout = (0,0,0,0)
+            result = 0xFF
+
+        parts = [None]
+        for key in self.strings:
+            value = msg.get(key,"")
+            encoded = value.encode() if isinstance(value,str) else None
+            if encoded == None or len(encoded) > 255:
+                extra[key] = value
+                encoded = b""
+            parts.append(struct.pack(">B",len(encoded)) + encoded)
+
+        parts.append(struct.pack(">H",len(packed) // 2) + packed)
+
+        if extra:
+            flags |= self.FLAG_EXTRA
+            extension = json.dumps(extra,separators=(",",":")).encode()
+            parts.append(struct.pack(">H",len(extension)) + extension)
+
+        parts[0] = self.header.pack(self.VERSION,flags,*layout,result)
+
+        return b"".join(parts)
+
+    #Raises ValueError for truncated or malformed payloads
+    def decode(self,payload: bytes) -> dict:
+        try:
+            return self.unpack(payload)
+        except (struct.error,IndexError) as e:
+            raise ValueError(f"Malformed packed payload: {e}")
+
+    def unpack(self,payload: bytes) -> dict:
+        version, flags, modfunc, devAdd, regAdd, regCount, result = self.header.unpack_from(payload,0)
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported packed payload version {version}")
+
+        msg = {}
+        offset = self.header.size
+        for key in self.strings:
+            length = payload[offset]
+            msg[key] = payload[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+
+        msg["devAdd"] = devAdd
+        if not flags & self.FLAG_NO_LAYOUT:
+            msg["modfunc"] = modfunc
+            msg["regAdd"] = regAdd
+            msg["regCount"] = regCount
+
+        words = struct.unpack_from(">H",payload,offset)[0]
+        offset += 2
+        if not flags & self.FLAG_NO_DATA:
+            regData = unpackWords(payload[offset:offset + 2 * words])
+            msg["regData"] = regData[0] if flags & self.FLAG_SCALAR else regData
+        offset += 2 * words
+
+        if result != 0xFF:
+            msg["result"] = result
+
+        if flags & self.FLAG_EXTRA:
+            length = struct.unpack_from(">H",payload,offset)[0]
+            msg.update(json.loads(payload[offset + 2:offset + 2 + length]))
+
+        return msg
+
+
+#MessagePack with register arrays carried as packed big endian 16 bit words (a bin field)
+class msgpackCodec:
+    name = "msgpack"
+    contentType = "application/msgpack"
+
+    def encode(self,msg: dict) -> bytes:
+        msg = publicItems(msg)
+        if isinstance(msg.get("regData"),list):
+            packed = packWords(msg["regData"])
+            if packed != None:
+                msg["regData"] = packed
+        return msgpack.packb(msg)
+
+    def decode(self,payload: bytes) -> dict:
+        msg = msgpack.unpackb(payload)
+        if isinstance(msg,dict) and isinstance(msg.get("regData"),bytes):
+            msg["regData"] = unpackWords(msg["regData"])
+        return msg
+
+
+payloadCodecs = {
+    jsonCodec.name   : jsonCodec(),
+    packedCodec.name : packedCodec(),
+}
+
+#Optional dependency
+if msgpack != None:
+    payloadCodecs[msgpackCodec.name] = msgpackCodec()
+
+codecsByContentType = {codec.contentType: codec for codec in payloadCodecs.values()}
@@ -0,0 +1,449 @@
+import serial.rs485
+import minimalmodbus
+import threading
+import time
+from debug_nid import debug
+from mqtt2modbus import mqtt2modbus
+from mqtt2modbus import asyncrtu
+from mqtt2modbus import batch
+from mqtt2modbus import readcache
+from mqtt2modbus import registerimage
+from mqtt2modbus import requestscheduler
+from mqtt2modbus import slavehealth
+from mqtt2modbus import stats
+
+
+#A single RS485 segment with its own modbus instrument, request queue and worker thread.
+#Every bus is served by its own thread, so transactions on different segments run in parallel
+#and the serial I/O of one bus never blocks the pyRTOS loop or the other buses.
+class modbusBus:
+    def __init__(self,name: str,port: str,baudrate: int,timeout: float,publish,slaves=(),devIds=(),
+                 queueSize: int = 256,workConserving: bool = True,interFrameGap: float = None,maxBurst: int = 32,
+                 readCoalescing: bool = True,coalesceMaxGap: int = 0,transport: str = "minimalmodbus",rs485: bool = True,
+                 cache: dict = None,health: dict = None,readDedup: bool = True,registerImage: str = None,
+                 writeCoalescing: bool = False,writeWindow: float = 0):
+        self.name = name
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.slaves = set(slaves)
+        self.devIds = set(devIds)
+
+        #"minimalmodbus" or "asyncio" (see asyncrtu.py)
+        self.transport = transport
+        self.rs485 = rs485
+
+        #Called with every response produced by this bus
+        self.publish = publish
+
+        #Priority lanes with round robin between slaves => see requestscheduler.py
+        self.queue = requestscheduler.modbusRequestScheduler(queueSize)
+        self.workConserving = workConserving
+        self.interFrameGap = interFrameGap if interFrameGap != None else mqtt2modbus.modbusSilentInterval(baudrate)
+        self.maxBurst = maxBurst
+        self.readCoalescing = readCoalescing
+        self.coalesceMaxGap = coalesceMaxGap
+
+        #Identical reads waiting at the same time share one bus transaction
+        self.readDedup = readDedup
+
+        #Superseded single writes are dropped, contiguous ones merged into FC16/FC15 (see coalesceModbusWrites).
+        #A burst with a write waits writeWindow seconds for more of them before it is served.
+        self.writeCoalescing = writeCoalescing
+        self.writeWindow = writeWindow
+
+        #Optional read cache => keyword arguments of modbusReadCache
+        self.readCache = readcache.modbusReadCache(**cache) if cache else None
+
+        #Optional shared memory image of every register read => directory of the image files, mapped in open()
+        self.registerImageDir = registerImage
+        self.registerImage = None
+        #Devices whose image could not be created or written => left out from then on
+        self.registerImageFailed = set()
+
+        #Optional adaptive timeouts and circuit breaker per slave => keyword arguments of modbusSlaveHealth
+        self.slaveHealth = slavehealth.modbusSlaveHealth(baudrate,timeout,**health) if health != None else None
+
+        self.modbusHandle = None
+        self.lastFrameEnd = 0
+        self.thread = None
+
+    @classmethod
+    def fromConfig(cls,config: dict,publish):
+        return cls(publish=publish,**config)
+
+    def open(self):
+        #Raises IOError if the image directory can not be created
+        if self.registerImageDir != None:
+            self.registerImage = registerimage.modbusRegisterImage(self.registerImageDir)
+
+        #Raises IOError if the port is unavailable
+        if self.transport == "asyncio":
+            rtuTransport = asyncrtu.asyncRtuTransport(self.port,self.baudrate,self.timeout,self.rs485)
+            rtuTransport.open()
+            self.modbusHandle = asyncrtu.asyncRtuInstrument(rtuTransport)
+            return
+
+        #Create Serial Object and configure serial port for RS485 comms
+        rs485_serial = serial.rs485.RS485(self.port,self.baudrate)
+        if self.rs485:
+            rs485_serial.rs485_mode = serial.rs485.RS485Settings(False,True)
+
+        #Create and configure a "modbus instrument"
+        self.modbusHandle = minimalmodbus.Instrument(rs485_serial, 0, 'rtu', False, False)
+        self.modbusHandle.serial.baudrate = self.baudrate
+        self.modbusHandle.serial.timeout = self.timeout
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name=f"modbus_bus_{self.name}",daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+
+            #Sleep until a request is routed to this bus
+            if not self.queue.wait():
+                continue
+
+            if self.workConserving:
+                #Send everything that is waiting back to back
+                entries = self.queue.recv_many(self.maxBurst)
+            else:
+                #One request (or batch) per 100ms tick
+                entries = self.queue.recv_many(1)
+
+            #Setpoint writers send their writes in quick succession => give the rest of them a chance to arrive
+            room = (self.maxBurst if self.workConserving else 1) - len(entries)
+            if self.writeCoalescing and self.writeWindow > 0 and room > 0 and \
+               any(isinstance(entry,dict) and requestscheduler.isModbusWrite(entry) for entry in entries):
+                time.sleep(self.writeWindow)
+                entries += self.queue.recv_many(room)
+
+            try:
+                self.serviceRequests(entries)
+            except Exception as e:
+                #Never let a bad request take the bus down (serviceRequests answers what it can itself)
+                debug.logging.error("Bus %s: %r",self.name,e)
+
+            if not self.workConserving:
+                time.sleep(0.1)
+
+    def serviceRequests(self,entries: list):
+
+        #Queue entries are single requests or parts of a batch => flatten them, remembering where each response goes
+        #and when it expires
+        mqttMsgs = []
+        replies = []
+        expiries = []
+        for entry in entries:
+            if isinstance(entry,batch.modbusBatchPart):
+                stats.traceStamp(entry.batch.envelope,"dequeued")
+                expires = entry.batch.envelope.get("_expires")
+                for index, mqttMsg in entry.items:
+                    mqttMsgs.append(mqttMsg)
+                    replies.append(entry.replier(index))
+                    expiries.append(expires)
+            else:
+                stats.traceStamp(entry,"dequeued")
+                mqttMsgs.append(entry)
+                replies.append(self.publish)
+                expiries.append(entry.get("_expires"))
+
+        #Convert mqtt requests to modbus RTU messages
+        requests = []
+        #Ids of the responses whose transaction went out
+        sent = set()
+        try:
+            requests.extend(mqtt2modbus.mqttMsgs2ModbusMsgs(mqttMsgs))
+            self.transact(requests,replies,expiries,sent)
+        except Exception as e:
+            debug.logging.error("Bus %s: %r",self.name,e)
+            self.failRequests(mqttMsgs,requests,sent)
+
+        #Publish responses in the order the requests arrived, then recycle the modbus messages
+        for reply, (modbusMsg, mqttModbusResponse) in zip(replies,requests):
+            try:
+                if "_layout" in mqttModbusResponse:
+                    self.decodeValues(mqttModbusResponse)
+                reply(mqttModbusResponse)
+            except Exception as e:
+                debug.logging.error("Bus %s: can not reply to %s: %r",self.name,mqttModbusResponse.get("uuid"),e)
+            mqtt2modbus.modbusMsgs.release(modbusMsg)
+
+    #Everything between converting and answering the requests of a burst. Requests attached on the way are
+    #appended to requests and replies.
+    def transact(self,requests: list,replies: list,expiries: list,sent: set):
+
+        #Responses of requests with a ttl/deadline => expiry
+        expiresAt = {id(request[1]): expires for request, expires in zip(requests,expiries) if expires != None}
+
+        #Identical reads in this burst are answered from the first of them
+        pending = requests
+        duplicates = {}
+        if self.readDedup:
+            pending, duplicates = mqtt2modbus.dedupModbusReads(requests)
+            if expiresAt:
+                self.shareExpiry(duplicates,expiresAt)
+
+        #Answer what we can from the cache
+        if self.readCache != None:
+            pending = self.cacheLookup(pending)
+
+        #Requests to slaves behind an open circuit breaker are answered right away
+        if self.slaveHealth != None:
+            pending = self.healthFilter(pending)
+
+        #Group the remaining requests into bus transactions
+        if self.readCoalescing:
+            transactions = mqtt2modbus.coalesceModbusReads(pending,self.coalesceMaxGap)
+        else:
+            transactions = [[request] for request in pending]
+
+        #Only the latest of several writes to a register reaches the bus, it answers for the ones it superseded
+        superseded = {}
+        if self.writeCoalescing:
+            transactions, superseded = mqtt2modbus.coalesceModbusWrites(transactions)
+            if expiresAt:
+                self.shareExpiry(superseded,expiresAt)
+
+        for transaction in transactions:
+
+            #Requests nobody waits for anymore never reach the bus
+            if expiresAt:
+                transaction = self.expiryFilter(transaction,expiresAt)
+                if len(transaction) == 0:
+                    continue
+
+            #Keep the bus silent for at least the inter-frame gap
+            gap = self.interFrameGap - (time.monotonic() - self.lastFrameEnd)
+            if gap > 0:
+                time.sleep(gap)
+
+            layout = None
+            if self.slaveHealth != None and transaction[0][0].valid:
+                layout = slavehealth.modbusSlaveHealth.layout(transaction)
+                self.modbusHandle.serial.timeout = self.slaveHealth.timeout(*layout)
+
+            #Transmit modbus RTU message and wait for response
+            errors = []
+            txStart = time.monotonic()
+            mqtt2modbus.modbusCoalescedTx(self.modbusHandle,transaction,errors,slavehealth.MODBUS_SLAVE_EXCEPTIONS)
+            self.lastFrameEnd = time.monotonic()
+            sent.update(id(mqttResponse) for modbusMsg, mqttResponse in transaction)
+
+            for modbusMsg, mqttResponse in transaction:
+                trace = mqttResponse.get("_trace")
+                if trace != None:
+                    trace["tx"] = txStart
+                    trace["rsp"] = self.lastFrameEnd
+            if errors:
+                stats.bridgeStats.recordErrors(errors)
+
+            #Broadcasts are never answered
+            if layout != None and layout[0] != 0:
+                self.slaveHealth.update(*layout,self.lastFrameEnd - txStart,errors)
+
+            if self.readCache != None:
+                self.cacheUpdate(transaction)
+
+            if self.registerImage != None:
+                self.imageUpdate(transaction)
+
+            #Identical reads routed here while this one was on the bus share its result
+            if self.readDedup:
+                self.attachQueuedReads(transaction,requests,replies,duplicates)
+
+        if duplicates:
+            self.shareResults(duplicates,"deduplicated_reads")
+        if superseded:
+            self.shareResults(superseded,"superseded_writes")
+
+    #A burst failed half way => every request still waiting for its transaction is answered with GENERAL_ERROR,
+    #so no client (or batch) waits for a response that never comes
+    def failRequests(self,mqttMsgs: list,requests: list,sent: set):
+        ok = mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value
+        failed = mqtt2modbus.mqtt2Modbus_ErrorStatus.GENERAL_ERROR
+
+        if len(requests) == 0:
+            for mqttMsg in mqttMsgs:
+                requests.append((mqtt2modbus.modbusMsgs.acquire(0,0,0,0,0,0,False),mqtt2modbus.mqttMsg2ErrorResponse(mqttMsg,failed)))
+            return
+
+        for modbusMsg, mqttResponse in requests:
+            if mqttResponse["result"] == ok and id(mqttResponse) not in sent and not mqttResponse.get("cached"):
+                mqttResponse["result"] = failed.value
+
+    def cacheLookup(self,requests: list) -> list:
+        pending = []
+
+        for request in requests:
+            modbusMsg, mqttResponse = request
+            mqttResponse["cached"] = False
+
+            if readcache.modbusReadCache.cacheable(modbusMsg):
+                regData = self.readCache.get(modbusMsg)
+                if regData != None:
+                    mqttResponse["regData"] = regData
+                    mqttResponse["cached"] = True
+                    continue
+
+            #Later reads in this burst must not be served what this write is about to change
+            elif readcache.modbusReadCache.invalidates(modbusMsg):
+                self.readCache.invalidateWrite(modbusMsg)
+
+            pending.append(request)
+
+        return pending
+
+    #A shared read (or superseding write) only expires once every request waiting for it expired
+    def shareExpiry(self,duplicates: dict,expiresAt: dict):
+        for first, followers in duplicates.values():
+            if id(first) not in expiresAt:
+                continue
+            expiries = [expiresAt.get(id(mqttResponse)) for mqttResponse in followers]
+            if None in expiries:
+                del expiresAt[id(first)]
+            else:
+                expiresAt[id(first)] = max(expiresAt[id(first)],*expiries)
+
+    def attachQueuedReads(self,transaction: list,requests: list,replies: list,duplicates: dict):
+        ok = mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value
+
+        for modbusMsg, mqttResponse in transaction:
+            key = mqtt2modbus.modbusReadKey(modbusMsg)
+            if key == None or mqttResponse["result"] != ok:
+                continue
+
+            for mqttMsg in self.queue.takeReads(modbusMsg.devAdd,lambda entry: requestscheduler.modbusRequestReadKey(entry) == key):
+                stats.traceStamp(mqttMsg,"dequeued")
+                request = mqtt2modbus.mqttMsg2ModbusRequest(mqttMsg)
+                requests.append(request)
+                replies.append(self.publish)
+                if request[0].valid:
+                    duplicates.setdefault(id(mqttResponse),(mqttResponse,[]))[1].append(request[1])
+
+    #Hand the result of every shared read (or superseding write) to the requests that waited for it
+    def shareResults(self,duplicates: dict,counter: str):
+        for first, followers in duplicates.values():
+            regData = first["regData"]
+            trace = first.get("_trace")
+
+            for mqttResponse in followers:
+                mqttResponse["result"] = first["result"]
+                mqttResponse["regData"] = list(regData) if isinstance(regData,list) else regData
+                if "cached" in first:
+                    mqttResponse["cached"] = first["cached"]
+
+                #Reads attached while in flight were dequeued after the transmission started
+                followerTrace = mqttResponse.get("_trace")
+                if trace != None and followerTrace != None and "rsp" in trace:
+                    if trace["tx"] >= followerTrace.get("dequeued",0):
+                        followerTrace["tx"] = trace["tx"]
+                    followerTrace["rsp"] = trace["rsp"]
+
+            #Every follower is a bus transaction saved
+            stats.bridgeStats.count(counter,len(followers))
+
+    def expiryFilter(self,requests: list,expiresAt: dict) -> list:
+        pending = []
+        now = time.monotonic()
+
+        for request in requests:
+            modbusMsg, mqttResponse = request
+            expires = expiresAt.get(id(mqttResponse))
+            if modbusMsg.valid and expires != None and now >= expires:
+                mqttResponse["result"] = mqtt2modbus.mqtt2Modbus_ErrorStatus.EXPIRED.value
+                stats.bridgeStats.count("shed_expired")
+                continue
+            pending.append(request)
+
+        return pending
+
+    def healthFilter(self,requests: list) -> list:
+        pending = []
+
+        for request in requests:
+            modbusMsg, mqttResponse = request
+            if modbusMsg.valid and not self.slaveHealth.allow(modbusMsg.devAdd):
+                mqttResponse["result"] = mqtt2modbus.mqtt2Modbus_ErrorStatus.CIRCUIT_OPEN.value
+                continue
+            pending.append(request)
+
+        return pending
+
+    def cacheUpdate(self,transaction: list):
+        for modbusMsg, mqttResponse in transaction:
+            if readcache.modbusReadCache.invalidates(modbusMsg):
+                self.readCache.invalidateWrite(modbusMsg)
+
+            elif readcache.modbusReadCache.cacheable(modbusMsg) and mqttResponse["result"] == mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value:
+                self.readCache.put(modbusMsg,mqttResponse["devProfile"],mqttResponse["regData"])
+
+
+    #Profile commands with a field layout => typed "values", the registers stay in "regData" only if asked for "raw"
+    def decodeValues(self,mqttResponse: dict):
+        #Responses may be nested in a batch response, where context keys are not filtered
+        layout = mqttResponse.pop("_layout")
+        raw = mqttResponse.pop("_raw",False)
+
+        regData = mqttResponse["regData"]
+        if mqttResponse["result"] != mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value or not layout.fits(regData):
+            return
+
+        try:
+            mqttResponse["values"] = layout.decode(regData)
+        except (ValueError,OverflowError) as e:
+            debug.logging.warning("Bus %s: can not decode %s: %r",self.name,mqttResponse["uuid"],e)
+            return
+
+        if not raw:
+            del mqttResponse["regData"]
+
+    def imageUpdate(self,transaction: list):
+        ok = mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value
+
+        for modbusMsg, mqttResponse in transaction:
+            if modbusMsg.valid and modbusMsg.transactionType == 0 and mqttResponse["result"] == ok:
+                if modbusMsg.devAdd in self.registerImageFailed:
+                    continue
+                #The transaction is already on the bus => a full disk or a missing directory must not fail its requests
+                try:
+                    self.registerImage.update(modbusMsg.devAdd,modbusMsg.modfunc,modbusMsg.regAdd,mqttResponse["regData"])
+                except OSError as e:
+                    self.registerImageFailed.add(modbusMsg.devAdd)
+                    debug.logging.error("Bus %s: register image of device %s disabled: %r",self.name,modbusMsg.devAdd,e)
+
+
+#Maps requests onto buses by "devId" first and "devAdd" second.
+#A bus configured without any slaves or device ids catches every request no other bus claims.
+class modbusBusRouter:
+    def __init__(self,buses: list):
+        self.buses = buses
+        self.byDevId = {}
+        self.byDevAdd = {}
+        self.default = None
+
+        for bus in buses:
+            for devId in bus.devIds:
+                self.byDevId[devId] = bus
+            for devAdd in bus.slaves:
+                self.byDevAdd[devAdd] = bus
+            if len(bus.slaves) == 0 and len(bus.devIds) == 0 and self.default == None:
+                self.default = bus
+
+        #A lone bus serves everything
+        if len(buses) == 1:
+            self.default = buses[0]
+
+    def route(self,mqttMsg: dict) -> modbusBus | None:
+        bus = self.byDevId.get(self.routingKey(mqttMsg.get("devId")))
+        if bus == None:
+            bus = self.byDevAdd.get(self.routingKey(mqttMsg.get("devAdd")),self.default)
+
+        return bus
+
+    #Only names and addresses are looked up => lists and objects taken from a request go to the default bus,
+    #which answers them with INVALID_PARAMETER
+    @staticmethod
+    def routingKey(value):
+        return value if isinstance(value,(str,int)) else None
@@ -2,9 +2,11 @@ import serial.rs485
 import minimalmodbus
 import json
 import sys
+import collections
 from os.path import exists
 from enum import Enum
 from debug_nid import debug
+from mqtt2modbus import profiles
 
 
 class mqtt2Modbus_ErrorStatus(Enum):
@@ -17,6 +19,9 @@ class mqtt2Modbus_ErrorStatus(Enum):
     GENERAL_ERROR         = 6
     RESULT_UNKNOWN        = 7
     OK                    = 8
+    CIRCUIT_OPEN          = 9
+    EXPIRED               = 10
+    OVERLOADED            = 11
 
 class modbus_function_codes(Enum):
     READ_COILS                  = 1
@@ -29,7 +34,12 @@ class modbus_function_codes(Enum):
     WRITE_MULTIPLE_REGISTERS    = 16
 
 class modbusMsg:
+    __slots__ = ("devAdd","regAdd","regCount","modfunc","regData","valid","transactionType")
+
     def __init__(self,regAdd: int,regCount: int, modFunc: int, devAdd: int,opType: int, regDataArr,valid : bool):
+        self.set(regAdd,regCount,modFunc,devAdd,opType,regDataArr,valid)
+
+    def set(self,regAdd: int,regCount: int, modFunc: int, devAdd: int,opType: int, regDataArr,valid : bool):
         self.devAdd = devAdd
         self.regAdd = regAdd
         self.regCount = regCount
@@ -37,11 +47,32 @@ class modbusMsg:
         self.regData = regDataArr 
         self.valid   = valid
         self.transactionType = opType   
+        return self
     
     @classmethod
     def default(cls) :
         return cls(0,0,0,0,0,0,False)
 
+#Bounded free list of modbus messages => bus workers reuse them instead of allocating one per request.
+#deque append/pop are atomic, so one pool is shared by every worker without a lock.
+class modbusMsgPool:
+    def __init__(self,capacity: int = 1024):
+        self.capacity = capacity
+        self.free = collections.deque()
+
+    def acquire(self,regAdd: int,regCount: int, modFunc: int, devAdd: int,opType: int, regDataArr,valid : bool) -> modbusMsg:
+        try:
+            msg = self.free.pop()
+        except IndexError:
+            return modbusMsg(regAdd,regCount,modFunc,devAdd,opType,regDataArr,valid)
+        return msg.set(regAdd,regCount,modFunc,devAdd,opType,regDataArr,valid)
+
+    #Only release a message once nothing refers to it anymore (its response was published)
+    def release(self,msg: modbusMsg):
+        if len(self.free) < self.capacity:
+            msg.regData = None
+            self.free.append(msg)
+
 class modbusMqttMsg:
     def blankMsg():
         blank = {
@@ -76,13 +107,34 @@ class modbusMqttMsg:
         return Msg
 
 
-mqttResponse = modbusMqttMsg.blankMsg()
-modbusMsgParams = modbusMsg.default()
+#Largest register block a single FC3/FC4 read may return
+MODBUS_MAX_READ_REGISTERS = 125
+
+#Largest blocks a single FC16/FC15 write may carry
+MODBUS_MAX_WRITE_REGISTERS = 123
+MODBUS_MAX_WRITE_COILS = 1968
+
+#Messages kept for reuse by modbusMsgs
+MODBUS_MSG_POOL_SIZE = 1024
+
+modbusMsgs = modbusMsgPool(MODBUS_MSG_POOL_SIZE)
+
+def modbusSilentInterval(baudrate: int) -> float:
+    #RTU frames must be separated by at least 3.5 character times (11 bits per character).
+    #Above 19200 baud the spec fixes the interval at 1.75ms
+    if baudrate > 19200:
+        return 0.00175
+
+    return 3.5 * 11 / baudrate
 
 def modbusMsgTx(modbusHandle : minimalmodbus.Instrument,mqttMsg : dict) -> dict:
      
-     #declare mqtt response as global
-     global mqttResponse
+     #Convert and transmit a single request => kept for existing callers, see mqttMsg2ModbusRequest
+     modbusMsgParams, mqttResponse = mqttMsg2ModbusRequest(mqttMsg)
+     return modbusMsgTransact(modbusHandle,modbusMsgParams,mqttResponse)
+
+
+def modbusMsgTransact(modbusHandle : minimalmodbus.Instrument,modbusMsgParams : modbusMsg,mqttResponse : dict,errors : list = None) -> dict:
 
      #Determine if modbus message being passed as argument is valid
      if modbusMsgParams.valid != False:
@@ -93,7 +145,11 @@ def modbusMsgTx(modbusHandle : minimalmodbus.Instrument,mqttMsg : dict) -> dict:
         try:
             match modbusMsgParams.modfunc:
                 case modbus_function_codes.READ_COILS.value:
-                    mqttResponse["regData"] = modbusHandle.read_bit(modbusMsgParams.regAdd,modbusMsgParams.modfunc)
+                    #A single coil is answered with its value, several with a list
+                    if modbusMsgParams.regCount > 1:
+                        mqttResponse["regData"] = modbusHandle.read_bits(modbusMsgParams.regAdd,modbusMsgParams.regCount,modbusMsgParams.modfunc)
+                    else:
+                        mqttResponse["regData"] = modbusHandle.read_bit(modbusMsgParams.regAdd,modbusMsgParams.modfunc)
                 
                 case modbus_function_codes.READ_CONTACTS.value:
                     mqttResponse["regData"] = modbusHandle.read_bits(modbusMsgParams.regAdd,modbusMsgParams.regCount,modbusMsgParams.modfunc)
@@ -108,88 +164,324 @@ def modbusMsgTx(modbusHandle : minimalmodbus.Instrument,mqttMsg : dict) -> dict:
                     mqttResponse["regData"] = modbusHandle.write_bit(modbusMsgParams.regAdd,modbusMsgParams.regData,modbusMsgParams.modfunc)
                 
                 case modbus_function_codes.WRITE_SINGLE_REGISTER.value:
-                    mqttResponse["regData"] = modbusHandle.write_registers(modbusMsgParams.regAdd,modbusMsgParams.regData,modbusMsgParams.modfunc)
+                    regData = modbusMsgParams.regData[0] if isinstance(modbusMsgParams.regData,list) else modbusMsgParams.regData
+                    mqttResponse["regData"] = modbusHandle.write_register(modbusMsgParams.regAdd,regData,0,modbusMsgParams.modfunc)
 
                 case modbus_function_codes.WRITE_MULTIPLE_COILS.value:
-                    mqttResponse["regData"] = modbusHandle.write_registers(modbusMsgParams.regAdd,modbusMsgParams.regData,modbusMsgParams.modfunc)
+                    mqttResponse["regData"] = modbusHandle.write_bits(modbusMsgParams.regAdd,modbusMsgParams.regData)
 
                 case modbus_function_codes.WRITE_MULTIPLE_REGISTERS.value:
-                    mqttResponse["regData"] = modbusHandle.write_registers(modbusMsgParams.regAdd,modbusMsgParams.regData,modbusMsgParams.modfunc)
+                    mqttResponse["regData"] = modbusHandle.write_registers(modbusMsgParams.regAdd,modbusMsgParams.regData)
 
-        except:
+        except Exception as e:
                     mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MODBUS_IO_FAILED.value
+                    #Let the caller tell dead slaves from slaves reporting an exception
+                    if errors != None:
+                        errors.append(e)
  
      return mqttResponse
 
 
 def mqttMsg2ModbusMsg(mqttMsg: dict) -> mqtt2Modbus_ErrorStatus | modbusMsg:
 
-    global mqttResponse
-    mqttResponse = modbusMqttMsg.blankMsg()
+    #Kept for existing callers => mqttMsg2ModbusRequest also hands back the response
+    modbusMsgParams, mqttResponse = mqttMsg2ModbusRequest(mqttMsg)
+    if modbusMsgParams.valid == False:
+        return mqtt2Modbus_ErrorStatus(mqttResponse["result"])
+
+    return modbusMsgParams
 
-    global modbusMsgParams
-    modbusMsgParams = modbusMsg.default() 
+
+def mqttMsg2ModbusRequest(mqttMsg: dict, pool: modbusMsgPool = modbusMsgs) -> tuple:
+
+    #Convert a request into its (modbusMsg,response) pair without touching any shared state.
+    #Requests that can not be sent get an invalid modbusMsg and a response that already carries the error.
+    #The modbusMsg comes from pool and may be handed back with pool.release() once the response is published.
 
     #Ensure that message has all the required keys
-    if not "cmdName" in mqttMsg:
-        debug.logging.debug("\"cmdName\" key was not found")
-        mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MISSING_PARAMETER.value
-        return mqtt2Modbus_ErrorStatus.MISSING_PARAMETER
-    
-    if not "devAdd" in mqttMsg:
-        debug.logging.debug("\"devAdd\" key was not found")
-        mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MISSING_PARAMETER.value
-        return mqtt2Modbus_ErrorStatus.MISSING_PARAMETER
-        
-    if not "devProfile" in mqttMsg:
-        debug.logging.debug("\"devProfile\" key was not found")
-        mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MISSING_PARAMETER.value
-        return mqtt2Modbus_ErrorStatus.MISSING_PARAMETER
-    
-    if not "regData" in mqttMsg:
-        debug.logging.debug("\"regData\" key was not found")
-        mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MISSING_PARAMETER.value
-        return mqtt2Modbus_ErrorStatus.MISSING_PARAMETER
-    
-    if not "uuid" in mqttMsg:
-        debug.logging.debug("\"uuid\" key was not found")
-        mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MISSING_PARAMETER.value
-        return mqtt2Modbus_ErrorStatus.MISSING_PARAMETER
-    
-    if not "devId" in mqttMsg:
-        debug.logging.debug("\"devId\" key was not found")
-        mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MISSING_PARAMETER.value
-        return mqtt2Modbus_ErrorStatus.MISSING_PARAMETER
-    
+    for key in ("cmdName","devAdd","devProfile","regData","uuid","devId"):
+        if not key in mqttMsg:
+            debug.logging.debug("\"%s\" key was not found",key)
+            return (pool.acquire(0,0,0,0,0,0,False),mqttMsg2ErrorResponse(mqttMsg,mqtt2Modbus_ErrorStatus.MISSING_PARAMETER))
+
+    #Requests either carry the raw register layout or name a command of their device profile
+    command = None
+    if "modfunc" in mqttMsg and "regAdd" in mqttMsg and "regCount" in mqttMsg:
+        modfunc  = mqttMsg["modfunc"]
+        regAdd   = mqttMsg["regAdd"]
+        regCount = mqttMsg["regCount"]
+    else:
+        command = profiles.deviceProfiles.lookup(mqttMsg["devProfile"],mqttMsg["cmdName"])
+        if command == None:
+            debug.logging.debug("\"%s\" not found in device profile \"%s\"",mqttMsg["cmdName"],mqttMsg["devProfile"])
+            return (pool.acquire(0,0,0,0,0,0,False),mqttMsg2ErrorResponse(mqttMsg,mqtt2Modbus_ErrorStatus.DEVICE_PROFILE_ABSENT))
+
+        modfunc  = command.modfunc
+        regAdd   = command.regAdd
+        regCount = command.regCount
+
+    #Anything but integers would only fail on the bus worker, along with every request sharing its burst
+    for key, value in (("modfunc",modfunc),("devAdd",mqttMsg["devAdd"]),("regAdd",regAdd),("regCount",regCount)):
+        if not isinstance(value,int) or isinstance(value,bool):
+            debug.logging.debug("\"%s\" is not an integer",key)
+            return (pool.acquire(0,0,0,0,0,0,False),mqttMsg2ErrorResponse(mqttMsg,mqtt2Modbus_ErrorStatus.INVALID_PARAMETER))
+
+    #Device ids are names (or numbers) => anything else was routed to the default bus without a lookup
+    if not isinstance(mqttMsg["devId"],(str,int)):
+        debug.logging.debug("\"devId\" is not a string")
+        return (pool.acquire(0,0,0,0,0,0,False),mqttMsg2ErrorResponse(mqttMsg,mqtt2Modbus_ErrorStatus.INVALID_PARAMETER))
 
     mqttResponse = modbusMqttMsg.CreateMsg(
                                             mqttMsg["cmdName"],
                                             mqttMsg["uuid"],
                                             mqttMsg["devId"],
                                             mqttMsg["devProfile"],
-                                            mqttMsg["modfunc"],
+                                            modfunc,
                                             mqttMsg["devAdd"],
-                                            mqttMsg["regAdd"],
-                                            mqttMsg["regCount"],
+                                            regAdd,
+                                            regCount,
                                             mqttMsg["regData"],
-                                            mqtt2Modbus_ErrorStatus.RESULT_UNKNOWN
+                                            mqtt2Modbus_ErrorStatus.OK.value
                                           )
-    
-   
+
+    #Tell the client how to interpret the registers of a profile command
+    if command != None:
+        mqttResponse["dataType"] = command.dataType
+        mqttResponse["scale"]    = command.scale
+
+        #Decoded by the bus worker once the registers are in, see modbusBus.decodeValues
+        if command.layout != None:
+            mqttResponse["_layout"] = command.layout
+            mqttResponse["_raw"] = mqttMsg.get("raw") == True
+
+    copyMsgContext(mqttMsg,mqttResponse)
                 
-    #If command can be found in devices profile then extract the function and register address parameters
-    modbusMsgParams =  modbusMsg(
-                                    mqttMsg["regAdd"],
-                                    mqttMsg["regCount"],
-                                    mqttMsg["modfunc"],
+    modbusMsgParams = pool.acquire(
+                                    regAdd,
+                                    regCount,
+                                    modfunc,
                                     mqttMsg["devAdd"],
-                                    0 if mqttMsg["modfunc"] <= 4 else 1,
+                                    0 if modfunc <= 4 else 1,
                                     mqttMsg["regData"],
                                     True
-                                )
+                                  )
+
+    return (modbusMsgParams,mqttResponse)
 
-    mqttResponse["result"] = mqtt2Modbus_ErrorStatus.OK.value
-    return modbusMsgParams
+
+def mqttMsg2ErrorResponse(mqttMsg: dict, result: mqtt2Modbus_ErrorStatus) -> dict:
+
+    #Build a response for a request that will never reach the bus
+    response = modbusMqttMsg.blankMsg()
+    for key in response:
+        if key in mqttMsg:
+            response[key] = mqttMsg[key]
+
+    response["result"] = result.value
+    copyMsgContext(mqttMsg,response)
+    return response
+
+
+def copyMsgContext(mqttMsg: dict, mqttResponse: dict):
+
+    #Keys starting with "_" are bridge-internal request context (codec, reply topic, ...) => hand them to the response.
+    #Codecs never encode them.
+    for key in mqttMsg:
+        if isinstance(key,str) and key.startswith("_"):
+            mqttResponse[key] = mqttMsg[key]
+
+
+def mqttMsgs2ModbusMsgs(mqttMsgs: list, pool: modbusMsgPool = modbusMsgs) -> list:
+
+    #Convert every request and keep each modbus message paired with its own response
+    return [mqttMsg2ModbusRequest(mqttMsg,pool) for mqttMsg in mqttMsgs]
+
+
+def coalesceModbusReads(requests: list, maxGap: int = 0) -> list:
+
+    #Group (modbusMsg,response) pairs into bus transactions.
+    #FC3/FC4 reads to the same device whose register ranges overlap, touch or lie within maxGap registers
+    #of each other are merged into one transaction of at most MODBUS_MAX_READ_REGISTERS registers.
+    #Reads are only merged within runs that contain no writes, so reads never move across a write.
+    transactions = []
+    readRun = {}
+
+    def flushReads():
+        for group in readRun.values():
+            group.sort(key=lambda request: request[0].regAdd)
+
+            merged = [group[0]]
+            end = group[0][0].regAdd + group[0][0].regCount
+            for request in group[1:]:
+                msg = request[0]
+                newEnd = max(end,msg.regAdd + msg.regCount)
+                if msg.regAdd <= end + maxGap and newEnd - merged[0][0].regAdd <= MODBUS_MAX_READ_REGISTERS:
+                    merged.append(request)
+                    end = newEnd
+                else:
+                    transactions.append(merged)
+                    merged = [request]
+                    end = msg.regAdd + msg.regCount
+            transactions.append(merged)
+
+        readRun.clear()
+
+    for request in requests:
+        msg = request[0]
+        if msg.valid and msg.modfunc in (modbus_function_codes.READ_HOLDING_REGISTERS.value,modbus_function_codes.READ_INPUT_REGISTERS.value):
+            readRun.setdefault((msg.devAdd,msg.modfunc),[]).append(request)
+        elif not msg.valid or msg.transactionType == 0:
+            #Bit reads and invalid requests are never merged but do not break a run of reads either
+            transactions.append([request])
+        else:
+            flushReads()
+            transactions.append([request])
+
+    flushReads()
+    return transactions
+
+
+def modbusReadKey(modbusMsgParams: modbusMsg) -> tuple | None:
+
+    #Reads of the same registers share a key => (devAdd,modfunc,regAdd,regCount). Anything else has none.
+    if not modbusMsgParams.valid or modbusMsgParams.transactionType != 0:
+        return None
+
+    return (modbusMsgParams.devAdd,modbusMsgParams.modfunc,modbusMsgParams.regAdd,modbusMsgParams.regCount)
+
+
+def dedupModbusReads(requests: list) -> tuple:
+
+    #Split identical reads off a list of (modbusMsg,response) pairs => only the first of them has to reach the bus.
+    #Returns the requests still to send and {id(first response): (first response,[responses of its duplicates])}.
+    #A write ends the reads of its device later reads may join, so no read is answered with data from before a
+    #write it followed.
+    unique = []
+    duplicates = {}
+    firsts = {}
+
+    for request in requests:
+        msg, mqttResponse = request
+        key = modbusReadKey(msg)
+
+        if key == None:
+            if msg.valid:
+                #Broadcast writes reach every device
+                firsts = {readKey: first for readKey, first in firsts.items() if msg.devAdd != 0 and readKey[0] != msg.devAdd}
+            unique.append(request)
+            continue
+
+        first = firsts.get(key)
+        if first == None:
+            firsts[key] = mqttResponse
+            unique.append(request)
+        else:
+            duplicates.setdefault(id(first),(first,[]))[1].append(mqttResponse)
+
+    return (unique,duplicates)
+
+
+def coalesceModbusWrites(transactions: list) -> tuple:
+
+    #Merge single FC6/FC5 writes in a list of bus transactions (see coalesceModbusReads).
+    #Of several writes to the same register (or coil) only the latest goes out, writes to contiguous registers of one
+    #device become a single FC16 (FC15 for coils) transaction of at most MODBUS_MAX_WRITE_REGISTERS registers
+    #(MODBUS_MAX_WRITE_COILS coils). Writes are only merged within runs that contain no other request to their
+    #device, so nothing moves across a read or a multiple register write. Broadcast writes and writes of values
+    #that do not fit a register (or coil) are never merged, so they can not fail the writes merged with them.
+    #Returns the transactions to send and {id(latest response): (latest response,[responses it superseded])}.
+    merged = []
+    superseded = {}
+    #devAdd -> modfunc -> regAdd -> requests, oldest first
+    writeRun = {}
+
+    def flushWrites(devAdd):
+        for modfunc, writes in writeRun.pop(devAdd,{}).items():
+            limit = MODBUS_MAX_WRITE_COILS if modfunc == modbus_function_codes.WRITE_SINGLE_COIL.value else MODBUS_MAX_WRITE_REGISTERS
+            transaction = []
+
+            for regAdd in sorted(writes):
+                latest = writes[regAdd][-1]
+                if len(writes[regAdd]) > 1:
+                    superseded[id(latest[1])] = (latest[1],[request[1] for request in writes[regAdd][:-1]])
+
+                if transaction and (regAdd != transaction[-1][0].regAdd + 1 or len(transaction) == limit):
+                    merged.append(transaction)
+                    transaction = []
+                transaction.append(latest)
+
+            merged.append(transaction)
+
+    for transaction in transactions:
+        msg = transaction[0][0]
+
+        if not msg.valid:
+            merged.append(transaction)
+        elif len(transaction) == 1 and msg.devAdd != 0 and modbusWriteValue(msg) != None:
+            writeRun.setdefault(msg.devAdd,{}).setdefault(msg.modfunc,{}).setdefault(msg.regAdd,[]).append(transaction[0])
+        else:
+            #Broadcasts reach every device
+            for devAdd in list(writeRun) if msg.devAdd == 0 else [msg.devAdd]:
+                flushWrites(devAdd)
+            merged.append(transaction)
+
+    for devAdd in list(writeRun):
+        flushWrites(devAdd)
+
+    return (merged,superseded)
+
+
+def modbusWriteValue(modbusMsgParams: modbusMsg) -> int | None:
+
+    #Value of a single FC6/FC5 write that can be merged into a FC16/FC15 one, None for anything else
+    value = modbusMsgParams.regData
+    if isinstance(value,list) and len(value) == 1:
+        value = value[0]
+    if not isinstance(value,int) or isinstance(value,bool):
+        return None
+
+    match modbusMsgParams.modfunc:
+        case modbus_function_codes.WRITE_SINGLE_REGISTER.value:
+            return value if 0 <= value <= 0xFFFF else None
+        case modbus_function_codes.WRITE_SINGLE_COIL.value:
+            return value if value in (0,1) else None
+
+    return None
+
+
+def modbusCoalescedTx(modbusHandle : minimalmodbus.Instrument,transaction : list,errors : list = None,
+                      slaveExceptions : tuple = (minimalmodbus.SlaveReportedException,)) -> list:
+
+    #Single requests go out unchanged
+    if len(transaction) == 1:
+        modbusMsg, mqttResponse = transaction[0]
+        return [modbusMsgTransact(modbusHandle,modbusMsg,mqttResponse,errors)]
+
+    if transaction[0][0].transactionType == 1:
+        return modbusCoalescedWriteTx(modbusHandle,transaction,errors,slaveExceptions)
+
+    #Issue one read covering every request and split the registers back out
+    regAdd = min(request[0].regAdd for request in transaction)
+    regEnd = max(request[0].regAdd + request[0].regCount for request in transaction)
+    first = transaction[0][0]
+
+    modbusHandle.address = first.devAdd
+    try:
+        regData = modbusHandle.read_registers(regAdd,regEnd - regAdd,first.modfunc)
+        for modbusMsg, mqttResponse in transaction:
+            offset = modbusMsg.regAdd - regAdd
+            mqttResponse["regData"] = regData[offset:offset + modbusMsg.regCount]
+    except slaveExceptions:
+        #The slave rejected the merged range (a gap may cover unmapped registers) => read every block on its own
+        for modbusMsg, mqttResponse in transaction:
+            modbusMsgTransact(modbusHandle,modbusMsg,mqttResponse,errors)
+    except Exception as e:
+        for modbusMsg, mqttResponse in transaction:
+            mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MODBUS_IO_FAILED.value
+        if errors != None:
+            errors.append(e)
+
+    return [request[1] for request in transaction]
 
     
 
@@ -220,4 +512,42 @@ def mqttMsg2ModbusMsg(mqttMsg: dict) -> mqtt2Modbus_ErrorStatus | modbusMsg:
     
 
 
+def modbusCoalescedWriteTx(modbusHandle : minimalmodbus.Instrument,transaction : list,errors : list = None,
+                           slaveExceptions : tuple = (minimalmodbus.SlaveReportedException,)) -> list:
+
+    #Single writes merged by coalesceModbusWrites => one FC16/FC15 write per run of contiguous registers.
+    #Requests shed from the transaction may have split a run.
+    runs = []
+    for request in sorted(transaction,key=lambda request: request[0].regAdd):
+        if runs and request[0].regAdd == runs[-1][-1][0].regAdd + 1:
+            runs[-1].append(request)
+        else:
+            runs.append([request])
 
+    first = transaction[0][0]
+    for run in runs:
+        if len(run) == 1:
+            modbusMsgTransact(modbusHandle,run[0][0],run[0][1],errors)
+            continue
+
+        values = [modbusWriteValue(request[0]) for request in run]
+
+        modbusHandle.address = first.devAdd
+        try:
+            if first.modfunc == modbus_function_codes.WRITE_SINGLE_COIL.value:
+                modbusHandle.write_bits(run[0][0].regAdd,values)
+            else:
+                modbusHandle.write_registers(run[0][0].regAdd,values)
+            for modbusMsg, mqttResponse in run:
+                mqttResponse["regData"] = None
+        except slaveExceptions:
+            #A rejected FC16/FC15 wrote nothing => every write on its own, so only the offending one fails
+            for modbusMsg, mqttResponse in run:
+                modbusMsgTransact(modbusHandle,modbusMsg,mqttResponse,errors)
+        except Exception as e:
+            for modbusMsg, mqttResponse in run:
+                mqttResponse["result"] = mqtt2Modbus_ErrorStatus.MODBUS_IO_FAILED.value
+            if errors != None:
+                errors.append(e)
+
+    return [request[1] for request in transaction]
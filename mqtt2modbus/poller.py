@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import time
+import pyRTOS.message
+from debug_nid import debug
+
+
+#One register block polled at a fixed interval.
+#A new sample is published when any value moved by more than deadband (any change if 0), when the result code
+#changes, or when heartbeat seconds passed since the last publish (0 => no heartbeat).
+class modbusPollPoint:
+    def __init__(self,name: str,devAdd: int,modfunc: int,regAdd: int,regCount: int,interval: float,
+                 devId: str = "",devProfile: str = "",deadband: float = 0,heartbeat: float = 0):
+        self.name = name
+        self.devAdd = devAdd
+        self.devId = devId
+        self.devProfile = devProfile
+        self.modfunc = modfunc
+        self.regAdd = regAdd
+        self.regCount = regCount
+        self.interval = interval
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+
+        self.uuid = f"poll/{name}"
+        self.due = 0
+        self.inflightSince = None
+        self.lastValues = None
+        self.lastResult = None
+        self.lastPublish = 0
+
+    def request(self) -> dict:
+        return {
+                    "cmdName"   :self.name,
+                    "uuid"      :self.uuid,
+                    "devId"     :self.devId,
+                    "devProfile":self.devProfile,
+                    "modfunc"   :self.modfunc,
+                    "devAdd"    :self.devAdd,
+                    "regAdd"    :self.regAdd,
+                    "regCount"  :self.regCount,
+                    "regData"   :[],
+               }
+
+    def changed(self,values,result: int) -> bool:
+        if result != self.lastResult or self.lastValues == None:
+            return True
+
+        if self.deadband == 0 or not isinstance(values,list) or not isinstance(self.lastValues,list) or len(values) != len(self.lastValues):
+            return values != self.lastValues
+
+        return any(abs(new - old) > self.deadband for new, old in zip(values,self.lastValues))
+
+
+#Schedules the configured reads itself and publishes by exception.
+#Requests go through submit() like any other request, their responses have to be handed back via
+#responses (thread safe) and are turned into publish(point,response) calls from the poller task.
+class modbusPoller:
+    def __init__(self,points: list,submit,publish):
+        self.points = {}
+        self.submit = submit
+        self.publish = publish
+        self.responses = pyRTOS.message.MessageQueue(max(len(points),1) * 2)
+
+        #Min-heap of (due,seq,point)
+        self.schedule = []
+        self.counter = itertools.count()
+
+        now = time.monotonic()
+        for config in points:
+            point = modbusPollPoint(**config)
+            point.due = now
+            self.points[point.uuid] = point
+            heapq.heappush(self.schedule,(point.due,next(self.counter),point))
+
+    def owns(self,mqttResponse: dict) -> bool:
+        return mqttResponse.get("uuid") in self.points
+
+    #Seconds until the next poll is due
+    def nextDue(self) -> float:
+        if len(self.schedule) == 0:
+            return 60
+        return max(0,self.schedule[0][0] - time.monotonic())
+
+    def pollDue(self):
+        now = time.monotonic()
+
+        while self.schedule and self.schedule[0][0] <= now:
+            due, _, point = heapq.heappop(self.schedule)
+
+            #Never stack requests behind a slow device, but give up on responses that got lost
+            if point.inflightSince == None or now - point.inflightSince > max(5 * point.interval,10):
+                if self.submit(point.request()):
+                    point.inflightSince = now
+                else:
+                    debug.logging.debug("Failed to queue poll %s",point.name)
+
+            #Skip missed slots instead of bursting to catch up
+            point.due = due + point.interval
+            if point.due <= now:
+                point.due = now + point.interval
+            heapq.heappush(self.schedule,(point.due,next(self.counter),point))
+
+    def processResponses(self,mqttResponses: list):
+        now = time.monotonic()
+
+        for mqttResponse in mqttResponses + self.responses.recv_many():
+            point = self.points.get(mqttResponse["uuid"])
+            if point == None:
+                continue
+            point.inflightSince = None
+
+            values = mqttResponse["regData"]
+            result = mqttResponse["result"]
+            if point.changed(values,result) or (point.heartbeat > 0 and now - point.lastPublish >= point.heartbeat):
+                point.lastValues = values
+                point.lastResult = result
+                point.lastPublish = now
+                self.publish(point,mqttResponse)
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+from debug_nid import debug
+from mqtt2modbus import registerdecoder
+
+
+#Device profiles map command names onto register layouts, so requests can name a command instead of
+#carrying modfunc/regAdd/regCount themselves. Every *.json file in the profile directory is one profile:
+#
+#   {
+#       "name"    : "sdm630",                      <= optional, defaults to the file name
+#       "commands": {
+#           "voltage_l1": {"modfunc": 4, "regAdd": 0, "regCount": 2, "dataType": "float32", "scale": 1.0},
+#           "readings"  : {"modfunc": 4, "regAdd": 0, "regCount": 120, "fields": [...]},
+#           ...
+#       }
+#   }
+#
+#Commands with "fields" are answered with the decoded "values" of their registers (see registerdecoder.py),
+#requests that also want the registers themselves set "raw": true.
+
+
+#A compiled command => everything mqttMsg2ModbusRequest needs, resolved once at load time
+class profileCommand:
+    __slots__ = ("modfunc","regAdd","regCount","dataType","scale","layout")
+
+    def __init__(self,modfunc: int,regAdd: int,regCount: int = 1,dataType: str = "uint16",scale: float = 1,fields: list = None):
+        self.modfunc = int(modfunc)
+        self.regAdd = int(regAdd)
+        self.regCount = int(regCount)
+        self.dataType = dataType
+        self.scale = scale
+
+        self.layout = registerdecoder.registerLayout(fields) if fields != None else None
+        if self.layout != None and self.layout.regCount > self.regCount:
+            raise ValueError(f"Fields need {self.layout.regCount} registers, the command reads {self.regCount}")
+
+
+class deviceProfileRegistry:
+    def __init__(self):
+        self.profileDir = None
+        #path -> (mtime,profile name,{cmdName: profileCommand}), name is None for files that never compiled
+        self.files = {}
+        #(profile name,cmdName) -> profileCommand
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def lookup(self,devProfile: str,cmdName: str) -> profileCommand | None:
+        try:
+            return self.commands.get((devProfile,cmdName))
+        except TypeError:
+            #Names taken from a request may be lists or objects
+            return None
+
+    def load(self,profileDir: str):
+        self.profileDir = profileDir
+        self.files = {}
+        self.reloadIfChanged()
+
+    #Recompile new or modified profile files and drop deleted ones. Returns True if anything changed.
+    #A file that fails to compile keeps its previous version.
+    def reloadIfChanged(self) -> bool:
+        if self.profileDir == None or not os.path.isdir(self.profileDir):
+            return False
+
+        with self.lock:
+            files = {}
+            changed = False
+
+            for fileName in sorted(os.listdir(self.profileDir)):
+                if not fileName.endswith(".json"):
+                    continue
+
+                path = os.path.join(self.profileDir,fileName)
+                loaded = self.files.get(path)
+
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    #Deleted since listdir => dropped like any other deleted file
+                    continue
+
+                if loaded != None and loaded[0] == mtime:
+                    files[path] = loaded
+                    continue
+
+                try:
+                    files[path] = (mtime,) + self.compile(path)
+                    debug.logging.debug("Loaded device profile %s",path)
+                except (OSError,ValueError,TypeError,KeyError) as e:
+                    debug.logging.error("Invalid device profile %s: %r",path,e)
+                    #Keep the previous version, or remember the broken one so it is only retried once edited
+                    files[path] = (mtime,) + (loaded[1:] if loaded != None else (None,{}))
+                changed = True
+
+            if files.keys() != self.files.keys():
+                changed = True
+
+            if changed:
+                commands = {}
+                for mtime, name, profileCommands in files.values():
+                    for cmdName, command in profileCommands.items():
+                        commands[(name,cmdName)] = command
+
+                #Lookups never see a half built table
+                self.files = files
+                self.commands = commands
+
+            return changed
+
+    def compile(self,path: str) -> tuple:
+        with open(path) as profileFile:
+            profile = json.load(profileFile)
+
+        if not isinstance(profile,dict) or not isinstance(profile.get("commands"),dict):
+            raise ValueError("A profile is an object with a \"commands\" object")
+        if not all(isinstance(command,dict) for command in profile["commands"].values()):
+            raise ValueError("Every command is an object")
+
+        name = profile.get("name",os.path.splitext(os.path.basename(path))[0])
+        commands = {cmdName: profileCommand(**command) for cmdName, command in profile["commands"].items()}
+        return (name,commands)
+
+
+#Registry used by mqttMsg2ModbusRequest
+deviceProfiles = deviceProfileRegistry()
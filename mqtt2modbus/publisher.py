@@ -0,0 +1,211 @@
+import threading
+import time
+import pyRTOS
+import pyRTOS.message
+from debug_nid import debug
+from mqtt2modbus import codec
+from mqtt2modbus import stats
+
+
+#Defaults of the per topic publish settings
+MQTT_PUBLISH_DEFAULTS = {"qos": 0,"retain": False,"batchWindow": 0}
+
+
+#Outbound publish stage => bus workers and tasks hand messages to submit() and never wait for the broker.
+#Its own pyRTOS task (run()) encodes and publishes them from a bounded queue:
+#
+#   qos, retain and batchWindow per topic   => exact topic or prefix ending in "#", first match wins
+#   batchWindow > 0                         => messages to that topic (and codec) are collected for batchWindow
+#                                              seconds, or until maxBatch arrived, and published as one
+#                                              {"items": [...]} message
+#   maxInFlight                             => publishes the broker has not acknowledged yet (see acknowledge()).
+#                                              While the window is full nothing is taken off the queue, so a
+#                                              slow broker fills the queue instead of stalling the buses.
+#
+#publish is the paho client's publish(), properties(codec) returns the MQTT v5 properties of a payload (or None).
+class mqttPublisher:
+    def __init__(self,publish,capacity: int = 1024,topics: dict = None,maxInFlight: int = 256,maxBatch: int = 64,properties=None):
+        self.publish = publish
+        self.capacity = capacity
+        self.topics = topics if topics != None else {}
+        self.maxInFlight = maxInFlight
+        self.maxBatch = maxBatch
+        self.properties = properties
+
+        #(topic,message,codec name,is a response)
+        self.queue = pyRTOS.message.MessageQueue(capacity)
+
+        #Settings per topic, resolved on first use
+        self.settings = {}
+
+        #(topic,codec name) -> [due time,messages] while a batching window is open
+        self.batches = {}
+
+        #Publishes ready to go out once the in-flight window allows
+        self.outgoing = []
+
+        #mid -> qos of publishes waiting for their acknowledgement. on_publish runs on the paho thread and may
+        #acknowledge a publish before publish() returned its mid => those mids are remembered in acked.
+        self.inFlight = {}
+        self.acked = set()
+        self.lock = threading.Lock()
+        self.blocked = False
+
+        #Metrics
+        self.published = 0
+        self.batched = 0
+        self.dropped = 0
+        self.failed = 0
+        self.maxDepth = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    #Queue a message for publishing. message is a dict encoded with the codec named codecName, response marks
+    #responses to requests (they are traced and counted in the stats). Returns False if the queue is full.
+    def submit(self,topic: str,message: dict,codecName: str = "json",response: bool = False) -> bool:
+        if not self.queue.nb_send((topic,message,codecName,response)):
+            self.dropped += 1
+            debug.logging.warning("Publish queue full, dropping message to %s",topic)
+            return False
+
+        depth = len(self.queue)
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+        return True
+
+    #The queue is more than half full => the broker can not keep up
+    def congested(self) -> bool:
+        return len(self.queue) > self.capacity // 2
+
+    def topicSettings(self,topic: str) -> dict:
+        settings = self.settings.get(topic)
+        if settings == None:
+            settings = MQTT_PUBLISH_DEFAULTS
+            for pattern, patternSettings in self.topics.items():
+                if pattern == topic or (pattern.endswith("#") and topic.startswith(pattern[:-1])):
+                    settings = MQTT_PUBLISH_DEFAULTS | patternSettings
+                    break
+            self.settings[topic] = settings
+        return settings
+
+    #Called from the paho thread (on_publish) for every publish the broker acknowledged
+    def acknowledge(self,mid: int):
+        with self.lock:
+            if self.inFlight.pop(mid,None) == None:
+                self.acked.add(mid)
+            wake = self.blocked and len(self.inFlight) < self.maxInFlight
+
+        if wake:
+            pyRTOS.wake()
+
+    #Called from the paho thread (on_connect) => QoS 0 publishes lost with the old connection are never acknowledged
+    def reconnected(self):
+        with self.lock:
+            self.inFlight = {mid: qos for mid, qos in self.inFlight.items() if qos > 0}
+            self.acked.clear()
+
+    # This is a blocking condition
+    def windowOpen(self):
+        while True:
+            yield len(self.inFlight) < self.maxInFlight
+
+    #Task body => pyRTOS.add_task(pyRTOS.Task(publisher.run,name="mqtt_publish_task"))
+    def run(self,task):
+        received = []
+
+        while True:
+
+            #Take nothing off the queue while publishes are stuck behind the in-flight window
+            if len(self.outgoing) == 0:
+                for topic, message, codecName, response in received + self.queue.recv_many():
+                    self.stage(topic,message,codecName,response)
+                received = []
+
+            now = time.monotonic()
+            for key, (due, messages) in list(self.batches.items()):
+                if now >= due or len(messages) >= self.maxBatch:
+                    del self.batches[key]
+                    self.outgoing.append((key[0],messages,key[1]))
+
+            self.flush()
+
+            if len(self.outgoing) > 0:
+                self.blocked = True
+                yield [self.windowOpen()]
+                self.blocked = False
+            elif len(self.batches) > 0:
+                due = min(due for due, messages in self.batches.values())
+                yield [self.queue.recv(received),pyRTOS.timeout(max(due - time.monotonic(),0))]
+            else:
+                yield [self.queue.recv(received)]
+
+    def stage(self,topic: str,message: dict,codecName: str,response: bool):
+        if self.topicSettings(topic)["batchWindow"] <= 0:
+            self.outgoing.append((topic,[(message,response)],codecName))
+            return
+
+        key = (topic,codecName)
+        batch = self.batches.get(key)
+        if batch == None:
+            batch = self.batches[key] = [time.monotonic() + self.topicSettings(topic)["batchWindow"],[]]
+        batch[1].append((message,response))
+
+    def flush(self):
+        sent = 0
+
+        for topic, messages, codecName in self.outgoing:
+            if len(self.inFlight) >= self.maxInFlight:
+                break
+
+            #A message that can not be encoded or is refused by the client is dropped => it would fail again on every flush
+            try:
+                payloadCodec = codec.payloadCodecs[codecName]
+                if len(messages) == 1:
+                    payload = payloadCodec.encode(messages[0][0])
+                else:
+                    payload = payloadCodec.encode({"items": [codec.publicItems(message) for message, response in messages]})
+
+                settings = self.topicSettings(topic)
+                properties = self.properties(payloadCodec) if self.properties != None else None
+
+                info = self.publish(topic,payload,qos=settings["qos"],retain=settings["retain"],properties=properties)
+            except Exception as e:
+                debug.logging.error("Can not publish %d message(s) to %s: %r",len(messages),topic,e)
+                self.failed += 1
+                sent += 1
+                continue
+
+            if len(messages) > 1:
+                self.batched += 1
+            if info.rc != 0:
+                self.failed += 1
+
+            #Without a connection paho drops QoS 0 publishes but keeps QoS 1/2 ones for later
+            if info.rc == 0 or settings["qos"] > 0:
+                with self.lock:
+                    if info.mid in self.acked:
+                        self.acked.discard(info.mid)
+                    else:
+                        self.inFlight[info.mid] = settings["qos"]
+
+            self.published += 1
+            sent += 1
+
+            for message, response in messages:
+                if response:
+                    stats.traceStamp(message,"pub")
+                    stats.bridgeStats.recordResponse(message)
+
+        del self.outgoing[:sent]
+
+    def stats(self) -> dict:
+        return {
+                    "depth"    : len(self.queue),
+                    "maxDepth" : self.maxDepth,
+                    "inFlight" : len(self.inFlight),
+                    "published": self.published,
+                    "batched"  : self.batched,
+                    "dropped"  : self.dropped,
+                    "failed"   : self.failed,
+               }
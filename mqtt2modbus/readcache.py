@@ -0,0 +1,97 @@
+import time
+from collections import OrderedDict
+from mqtt2modbus import mqtt2modbus
+
+
+#TTL cache for register reads keyed by (devAdd,modfunc,regAdd,regCount).
+#The TTL comes from deviceTtl (by devAdd), then profileTtl (by devProfile), then defaultTtl; a TTL of 0 is never cached.
+#At most maxEntries reads are kept, least recently used ones are evicted first.
+#Writes invalidate every entry of the device whose register range overlaps the written range.
+#Not thread safe => every bus owns its own cache.
+class modbusReadCache:
+    def __init__(self,defaultTtl: float = 0,deviceTtl: dict = None,profileTtl: dict = None,maxEntries: int = 1024):
+        self.defaultTtl = defaultTtl
+        #Json configs carry device addresses as strings
+        self.deviceTtl = {int(devAdd): ttl for devAdd, ttl in (deviceTtl or {}).items()}
+        self.profileTtl = dict(profileTtl or {})
+        self.maxEntries = maxEntries
+
+        #key -> (expiry,regData)
+        self.entries = OrderedDict()
+        #devAdd -> keys cached for that device
+        self.byDevice = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self,devAdd: int,devProfile: str) -> float:
+        ttl = self.deviceTtl.get(devAdd)
+        if ttl == None:
+            ttl = self.profileTtl.get(devProfile,self.defaultTtl)
+        return ttl
+
+    def get(self,modbusMsg) -> list | None:
+        key = (modbusMsg.devAdd,modbusMsg.modfunc,modbusMsg.regAdd,modbusMsg.regCount)
+        entry = self.entries.get(key)
+
+        if entry == None:
+            self.misses += 1
+            return None
+
+        if entry[0] <= time.monotonic():
+            self.remove(key)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return list(entry[1]) if isinstance(entry[1],list) else entry[1]
+
+    def put(self,modbusMsg,devProfile: str,regData):
+        ttl = self.ttl(modbusMsg.devAdd,devProfile)
+        if ttl <= 0:
+            return
+
+        key = (modbusMsg.devAdd,modbusMsg.modfunc,modbusMsg.regAdd,modbusMsg.regCount)
+        self.entries[key] = (time.monotonic() + ttl,regData)
+        self.entries.move_to_end(key)
+        self.byDevice.setdefault(modbusMsg.devAdd,set()).add(key)
+
+        while len(self.entries) > self.maxEntries:
+            self.remove(next(iter(self.entries)))
+
+    def invalidateWrite(self,modbusMsg):
+        #Single writes may leave regCount at 0, multiple writes may only carry their data
+        regCount = modbusMsg.regCount
+        if isinstance(modbusMsg.regData,list):
+            regCount = max(regCount,len(modbusMsg.regData))
+        self.invalidate(modbusMsg.devAdd,modbusMsg.regAdd,regCount)
+
+    def invalidate(self,devAdd: int,regAdd: int,regCount: int):
+        keys = self.byDevice.get(devAdd)
+        if not keys:
+            return
+
+        regEnd = regAdd + max(regCount,1)
+        for key in [key for key in keys if key[2] < regEnd and regAdd < key[2] + max(key[3],1)]:
+            self.remove(key)
+
+    def remove(self,key):
+        del self.entries[key]
+        keys = self.byDevice[key[0]]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.byDevice[key[0]]
+
+    #Reads whose results may be cached
+    @staticmethod
+    def cacheable(modbusMsg) -> bool:
+        return modbusMsg.valid and modbusMsg.transactionType == 0
+
+    #Writes that invalidate cached reads
+    @staticmethod
+    def invalidates(modbusMsg) -> bool:
+        return modbusMsg.valid and modbusMsg.modfunc in (mqtt2modbus.modbus_function_codes.WRITE_SINGLE_COIL.value,
+                                                         mqtt2modbus.modbus_function_codes.WRITE_SINGLE_REGISTER.value,
+                                                         mqtt2modbus.modbus_function_codes.WRITE_MULTIPLE_COILS.value,
+                                                         mqtt2modbus.modbus_function_codes.WRITE_MULTIPLE_REGISTERS.value)
@@ -0,0 +1,178 @@
+import math
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#Typed decoding of register blocks => profile commands with a "fields" list are answered with engineering values
+#instead of raw 16 bit registers (see profiles.py):
+#
+#   "fields": [
+#       {"name": "voltage_l1", "type": "float32"},
+#       {"name": "energy", "regOffset": 342, "type": "uint32", "wordOrder": "little", "scale": 0.01},
+#       {"name": "temperature", "type": "int16", "scale": 0.1, "offset": -40},
+#       ...
+#   ]
+#
+#   regOffset   first register of the field within the block, defaults to the end of the previous field
+#   type        int16 | uint16 | int32 | uint32 | int64 | uint64 | float32 | float64 (default uint16)
+#   wordOrder   "big" => most significant register first (default), "little" => least significant first
+#   byteOrder   "big" => most significant byte of each register first (default), "little" => bytes swapped
+#   scale       value = raw * scale + offset, values of integer fields stay integers with the defaults 1 and 0
+#
+#Float fields holding NaN or infinity decode to None (json has no literal for them).
+#
+#Layouts are compiled once when the profile is loaded. With numpy every group of fields sharing a type and byte
+#layout is decoded in one vectorized pass over the block, without it every field is unpacked with struct.
+
+#type -> (struct code,registers)
+MODBUS_FIELD_TYPES = {
+    "int16"  : ("h",1),
+    "uint16" : ("H",1),
+    "int32"  : ("i",2),
+    "uint32" : ("I",2),
+    "int64"  : ("q",4),
+    "uint64" : ("Q",4),
+    "float32": ("f",2),
+    "float64": ("d",4),
+}
+
+MODBUS_FIELD_ORDERS = ("big","little")
+
+MODBUS_FLOAT_FIELD_TYPES = ("float32","float64")
+
+
+class registerField:
+    __slots__ = ("name","regOffset","type","wordOrder","byteOrder","scale","offset","registers")
+
+    def __init__(self,name: str,regOffset: int = None,type: str = "uint16",wordOrder: str = "big",byteOrder: str = "big",
+                 scale: float = 1,offset: float = 0):
+        if type not in MODBUS_FIELD_TYPES:
+            raise ValueError(f"Unknown field type \"{type}\"")
+        if wordOrder not in MODBUS_FIELD_ORDERS or byteOrder not in MODBUS_FIELD_ORDERS:
+            raise ValueError(f"Field \"{name}\": word and byte order are \"big\" or \"little\"")
+        for value in (scale,offset):
+            if not isinstance(value,(int,float)) or isinstance(value,bool):
+                raise ValueError(f"Field \"{name}\": scale and offset have to be numbers")
+
+        self.name = str(name)
+        self.regOffset = regOffset
+        self.type = type
+        self.wordOrder = wordOrder
+        self.byteOrder = byteOrder
+        self.scale = scale
+        self.offset = offset
+        self.registers = MODBUS_FIELD_TYPES[type][1]
+
+    def scaled(self) -> bool:
+        return self.scale != 1 or self.offset != 0
+
+    #Registers of the field in the order their bytes make up the value
+    def wordIndex(self) -> list:
+        words = list(range(self.regOffset,self.regOffset + self.registers))
+        return words if self.wordOrder == "big" else words[::-1]
+
+
+#Fields decoded together => same type, byte layout and scaling
+class registerFieldGroup:
+    def __init__(self,fields: list):
+        first = fields[0]
+        self.names = [field.name for field in fields]
+        self.index = numpy.array([field.wordIndex() for field in fields],dtype=numpy.intp)
+        self.wordType = numpy.dtype(">u2" if first.byteOrder == "big" else "<u2")
+        code = MODBUS_FIELD_TYPES[first.type][0]
+        self.valueType = numpy.dtype(">" + code)
+        self.floating = first.type in MODBUS_FLOAT_FIELD_TYPES
+
+        #Left out when they would not change anything
+        self.scales = None
+        self.offsets = None
+        if first.scaled():
+            if any(field.scale != 1 for field in fields):
+                self.scales = numpy.array([field.scale for field in fields],dtype=numpy.float64)
+            if any(field.offset != 0 for field in fields):
+                self.offsets = numpy.array([field.offset for field in fields],dtype=numpy.float64)
+
+    def decode(self,registers) -> list:
+        #Registers => their big endian bytes (swapped for byteOrder "little") => reinterpreted as the field type
+        values = registers[self.index].astype(self.wordType).view(self.valueType).ravel()
+        if self.scales is not None:
+            values = values * self.scales
+        if self.offsets is not None:
+            values = values + self.offsets
+        if self.floating and not numpy.isfinite(values).all():
+            return [value if math.isfinite(value) else None for value in values.tolist()]
+        return values.tolist()
+
+
+class registerLayout:
+    def __init__(self,fields: list):
+        self.fields = []
+
+        regOffset = 0
+        for config in fields:
+            field = registerField(**config)
+            if field.regOffset == None:
+                field.regOffset = regOffset
+            if not isinstance(field.regOffset,int) or field.regOffset < 0:
+                raise ValueError(f"Field \"{field.name}\": invalid regOffset {field.regOffset!r}")
+            regOffset = field.regOffset + field.registers
+            self.fields.append(field)
+
+        if len(self.fields) == 0:
+            raise ValueError("Empty field layout")
+        if len({field.name for field in self.fields}) != len(self.fields):
+            raise ValueError("Field names have to be unique")
+
+        self.names = [field.name for field in self.fields]
+        #Registers the block has to hold
+        self.regCount = max(field.regOffset + field.registers for field in self.fields)
+
+        self.groups = []
+        if numpy != None:
+            groups = {}
+            for field in self.fields:
+                key = (field.type,field.byteOrder,field.scaled())
+                groups.setdefault(key,[]).append(field)
+            self.groups = [registerFieldGroup(group) for group in groups.values()]
+            #Values come out group by group => position of every field among them
+            groupNames = [name for group in self.groups for name in group.names]
+            self.order = [groupNames.index(name) for name in self.names]
+        else:
+            self.unpackers = [
+                                (
+                                    field,
+                                    field.wordIndex(),
+                                    struct.Struct((">" if field.byteOrder == "big" else "<") + f"{field.registers}H"),
+                                    struct.Struct(">" + MODBUS_FIELD_TYPES[field.type][0]),
+                                )
+                                for field in self.fields
+                             ]
+
+    def fits(self,regData) -> bool:
+        return isinstance(regData,list) and len(regData) >= self.regCount
+
+    #Registers => {field name: value}. Raises ValueError (or OverflowError) for registers that are not 16 bit words.
+    def decode(self,regData: list) -> dict:
+        if numpy != None:
+            registers = numpy.array(regData,dtype=numpy.uint16)
+            values = []
+            for group in self.groups:
+                values += group.decode(registers)
+            return dict(zip(self.names,[values[index] for index in self.order]))
+
+        values = {}
+        for field, wordIndex, words, value in self.unpackers:
+            try:
+                decoded = value.unpack(words.pack(*[regData[index] for index in wordIndex]))[0]
+            except struct.error as e:
+                raise ValueError(e)
+            if field.scaled():
+                decoded = float(decoded) * field.scale + field.offset
+            if isinstance(decoded,float) and not math.isfinite(decoded):
+                decoded = None
+            values[field.name] = decoded
+        return values
@@ -0,0 +1,186 @@
+import array
+import mmap
+import os
+import struct
+import time
+
+
+#Shared memory image of the registers read from each device => local processes read the latest values straight
+#from a memory mapped file, without a request, a broker or any serialization.
+#
+#Every device gets one file <directory>/<devAdd>.img (the bridge uses one directory per bus). The bus worker
+#writes each completed FC1-FC4 read into it, any number of readers map it read only (see modbusRegisterImageReader).
+#
+#Layout (native byte order, all offsets fixed):
+#
+#   header      4096 bytes          => 8s magic "MBREGIMG" | I version | I devAdd | I block size | I blocks
+#   4 tables    coils (FC1), contacts (FC2), holding registers (FC3), input registers (FC4), each:
+#       seq     I x 1024            => sequence counter per block of 64 registers
+#       stamp   d x 1024            => time.time() of the last update of the block, 0 if never read
+#       words   H x 65536           => register values (bits are stored as 0/1 words)
+#
+#Consistency is a seqlock per block: the writer makes the counters of every block it touches odd, writes, then
+#makes them even again. A reader copies the values between two reads of the counters and retries if a counter
+#was odd or changed. Readers never block the bus worker and never see a half written read.
+#Files are allocated in full when they are created (about 570 kB per device) => a full filesystem fails the
+#creation with OSError instead of killing the process with SIGBUS on the first write to a sparse page.
+#Where posix_fallocate is not available the files stay sparse and that risk remains.
+
+MODBUS_IMAGE_MAGIC = b"MBREGIMG"
+MODBUS_IMAGE_VERSION = 1
+
+MODBUS_IMAGE_HEADER = struct.Struct("=8sIIII")
+MODBUS_IMAGE_HEADER_SIZE = 4096
+
+MODBUS_IMAGE_BLOCK = 64
+MODBUS_IMAGE_BLOCKS = 65536 // MODBUS_IMAGE_BLOCK
+MODBUS_IMAGE_TABLE_SIZE = MODBUS_IMAGE_BLOCKS * 4 + MODBUS_IMAGE_BLOCKS * 8 + 65536 * 2
+MODBUS_IMAGE_SIZE = MODBUS_IMAGE_HEADER_SIZE + 4 * MODBUS_IMAGE_TABLE_SIZE
+
+#Function code => table
+MODBUS_IMAGE_TABLES = {1: 0,2: 1,3: 2,4: 3}
+
+
+class modbusRegisterImageError(IOError):
+    pass
+
+
+def modbusImagePath(directory: str,devAdd: int) -> str:
+    return os.path.join(directory,f"{devAdd}.img")
+
+
+#The (seq,stamp,words) views of every table of a mapped image
+def modbusImageTables(buffer) -> list:
+    view = memoryview(buffer)
+    tables = []
+
+    for table in range(4):
+        offset = MODBUS_IMAGE_HEADER_SIZE + table * MODBUS_IMAGE_TABLE_SIZE
+        seq = view[offset:offset + MODBUS_IMAGE_BLOCKS * 4].cast("I")
+        offset += MODBUS_IMAGE_BLOCKS * 4
+        stamp = view[offset:offset + MODBUS_IMAGE_BLOCKS * 8].cast("d")
+        offset += MODBUS_IMAGE_BLOCKS * 8
+        words = view[offset:offset + 65536 * 2].cast("H")
+        tables.append((seq,stamp,words))
+
+    return tables
+
+
+#Writer side => one per bus, only ever used by its bus worker
+class modbusRegisterImage:
+    def __init__(self,directory: str):
+        self.directory = directory
+        #devAdd -> (mmap,tables)
+        self.images = {}
+        self.updates = 0
+
+        os.makedirs(directory,exist_ok=True)
+
+    def image(self,devAdd: int) -> list:
+        image = self.images.get(devAdd)
+        if image != None:
+            return image[1]
+
+        fd = os.open(modbusImagePath(self.directory,devAdd),os.O_RDWR | os.O_CREAT,0o644)
+        try:
+            #Keep the values of the last run if the file has the expected layout
+            header = os.pread(fd,MODBUS_IMAGE_HEADER.size,0)
+            expected = MODBUS_IMAGE_HEADER.pack(MODBUS_IMAGE_MAGIC,MODBUS_IMAGE_VERSION,devAdd,MODBUS_IMAGE_BLOCK,MODBUS_IMAGE_BLOCKS)
+            if header != expected or os.fstat(fd).st_size != MODBUS_IMAGE_SIZE:
+                os.ftruncate(fd,0)
+                if hasattr(os,"posix_fallocate"):
+                    os.posix_fallocate(fd,0,MODBUS_IMAGE_SIZE)
+                else:
+                    os.ftruncate(fd,MODBUS_IMAGE_SIZE)
+                os.pwrite(fd,expected,0)
+            buffer = mmap.mmap(fd,MODBUS_IMAGE_SIZE)
+        finally:
+            os.close(fd)
+
+        tables = modbusImageTables(buffer)
+        self.images[devAdd] = (buffer,tables)
+        return tables
+
+    #Store the registers of a completed read
+    def update(self,devAdd: int,modfunc: int,regAdd: int,regData):
+        table = MODBUS_IMAGE_TABLES.get(modfunc)
+        if table == None:
+            return
+
+        values = regData if isinstance(regData,list) else [regData]
+        if len(values) == 0 or regAdd + len(values) > 65536:
+            return
+
+        seq, stamp, words = self.image(devAdd)[table]
+        blocks = range(regAdd // MODBUS_IMAGE_BLOCK,(regAdd + len(values) - 1) // MODBUS_IMAGE_BLOCK + 1)
+
+        #Odd => readers of these blocks retry
+        for block in blocks:
+            seq[block] = (seq[block] + 1) & 0xFFFFFFFF
+
+        words[regAdd:regAdd + len(values)] = array.array("H",values)
+        now = time.time()
+        for block in blocks:
+            stamp[block] = now
+
+        for block in blocks:
+            seq[block] = (seq[block] + 1) & 0xFFFFFFFF
+
+        self.updates += 1
+
+    def close(self):
+        #Views have to go before the mappings can be closed
+        buffers = [image[0] for image in self.images.values()]
+        self.images = {}
+        for buffer in buffers:
+            buffer.close()
+
+
+#Reader side => maps a device's image read only, usable from any process on the same machine
+#
+#   image = modbusRegisterImageReader("/dev/shm/mqtt2modbus/bus0",1)
+#   regData, updatedAt = image.read(3,0,10)
+class modbusRegisterImageReader:
+    def __init__(self,directory: str,devAdd: int):
+        path = modbusImagePath(directory,devAdd)
+        with open(path,"rb") as imageFile:
+            self.buffer = mmap.mmap(imageFile.fileno(),0,access=mmap.ACCESS_READ)
+
+        magic, version, imageDevAdd, block, blocks = MODBUS_IMAGE_HEADER.unpack_from(self.buffer,0)
+        if magic != MODBUS_IMAGE_MAGIC or version != MODBUS_IMAGE_VERSION or len(self.buffer) != MODBUS_IMAGE_SIZE:
+            self.buffer.close()
+            raise modbusRegisterImageError(f"{path} is not a register image")
+
+        self.devAdd = imageDevAdd
+        self.tables = modbusImageTables(self.buffer)
+
+    #Returns (registers,updatedAt) => updatedAt is the time.time() of the oldest update among the blocks
+    #of the range, 0 if part of it was never read. Raises modbusRegisterImageError if the writer kept
+    #changing the range for more than retries attempts, ValueError for a function code or range the image
+    #does not hold.
+    def read(self,modfunc: int,regAdd: int,regCount: int,retries: int = 1000) -> tuple:
+        if modfunc not in MODBUS_IMAGE_TABLES:
+            raise ValueError(f"No image of function code {modfunc}")
+        if not isinstance(regAdd,int) or not isinstance(regCount,int) or regAdd < 0 or regCount <= 0 or regAdd + regCount > 65536:
+            raise ValueError(f"Invalid register range {regAdd!r}/{regCount!r}")
+
+        seq, stamp, words = self.tables[MODBUS_IMAGE_TABLES[modfunc]]
+        blocks = range(regAdd // MODBUS_IMAGE_BLOCK,(regAdd + regCount - 1) // MODBUS_IMAGE_BLOCK + 1)
+
+        for attempt in range(retries):
+            before = [seq[block] for block in blocks]
+            if any(count & 1 for count in before):
+                continue
+
+            regData = words[regAdd:regAdd + regCount].tolist()
+            updatedAt = min(stamp[block] for block in blocks)
+
+            if [seq[block] for block in blocks] == before:
+                return (regData,updatedAt)
+
+        raise modbusRegisterImageError(f"Registers {regAdd}-{regAdd + regCount - 1} of device {self.devAdd} kept changing")
+
+    def close(self):
+        #Views have to go before the mapping can be closed
+        self.tables = []
+        self.buffer.close()
@@ -0,0 +1,301 @@
+import collections
+import math
+import threading
+import time
+import pyRTOS
+from mqtt2modbus import mqtt2modbus
+from mqtt2modbus import profiles
+from mqtt2modbus import batch
+
+
+#Priority lanes, highest first. Requests pick a lane with a "priority" field (lane name or index) or the
+#"_priority" context set from their topic. Without either, writes go to "write" and everything else to "read".
+MODBUS_PRIORITY_LANES = ("urgent","write","read","bulk")
+
+MODBUS_WRITE_FUNCTION_CODES = (mqtt2modbus.modbus_function_codes.WRITE_SINGLE_COIL.value,
+                               mqtt2modbus.modbus_function_codes.WRITE_SINGLE_REGISTER.value,
+                               mqtt2modbus.modbus_function_codes.WRITE_MULTIPLE_COILS.value,
+                               mqtt2modbus.modbus_function_codes.WRITE_MULTIPLE_REGISTERS.value)
+
+MODBUS_READ_FUNCTION_CODES = (mqtt2modbus.modbus_function_codes.READ_COILS.value,
+                              mqtt2modbus.modbus_function_codes.READ_CONTACTS.value,
+                              mqtt2modbus.modbus_function_codes.READ_HOLDING_REGISTERS.value,
+                              mqtt2modbus.modbus_function_codes.READ_INPUT_REGISTERS.value)
+
+
+def isModbusWrite(mqttMsg: dict) -> bool:
+    modfunc = mqttMsg.get("modfunc")
+    if modfunc == None:
+        #Profile command => the profile knows the function code
+        command = profiles.deviceProfiles.lookup(mqttMsg.get("devProfile"),mqttMsg.get("cmdName"))
+        modfunc = command.modfunc if command != None else None
+    return modfunc in MODBUS_WRITE_FUNCTION_CODES
+
+
+#Same key as mqtt2modbus.modbusReadKey(), taken from a queued request. None for anything but reads.
+def modbusRequestReadKey(mqttMsg: dict) -> tuple | None:
+    if not isinstance(mqttMsg,dict):
+        return None
+
+    if "modfunc" in mqttMsg and "regAdd" in mqttMsg and "regCount" in mqttMsg:
+        key = (mqttMsg.get("devAdd"),mqttMsg["modfunc"],mqttMsg["regAdd"],mqttMsg["regCount"])
+    else:
+        command = profiles.deviceProfiles.lookup(mqttMsg.get("devProfile"),mqttMsg.get("cmdName"))
+        if command == None:
+            return None
+        key = (mqttMsg.get("devAdd"),command.modfunc,command.regAdd,command.regCount)
+
+    return key if key[1] in MODBUS_READ_FUNCTION_CODES else None
+
+
+#Requests (and batch envelopes) may carry "ttl" (seconds after receipt) or "deadline" (unix time). Both become a
+#time.monotonic() expiry in the "_expires" context on receipt, the earlier one wins. Requests that expire while
+#queued are answered with EXPIRED instead of being sent.
+def requestExpiry(mqttMsg: dict,receivedAt: float) -> float | None:
+    expiries = []
+
+    for key in ("ttl","deadline"):
+        value = mqttMsg.get(key)
+        if value == None:
+            continue
+        if not isinstance(value,(int,float)) or isinstance(value,bool):
+            raise ValueError(f"\"{key}\" is not a number")
+        #NaN and infinity (json allows them) would never expire or expire at once, integers beyond a float overflow
+        try:
+            finite = math.isfinite(value)
+        except OverflowError:
+            finite = False
+        if not finite:
+            raise ValueError(f"\"{key}\" is not a finite number")
+        expiries.append(receivedAt + value if key == "ttl" else receivedAt + (value - time.time()))
+
+    return min(expiries) if expiries else None
+
+
+def isExpired(entry,now: float) -> bool:
+    if isinstance(entry,batch.modbusBatchPart):
+        entry = entry.batch.envelope
+    expires = entry.get("_expires")
+    return expires != None and now >= expires
+
+
+#Drop-in replacement for pyRTOS.message.MessageQueue (same send/recv interface, safe to use from any thread)
+#that hands out requests by priority lane and, within a lane, round robin by slave address.
+#Lanes are served strictly in order, except that a lane passed over starvationLimit times in a row is
+#served once, so a flood of writes can not starve reads forever.
+#Every lane holds up to capacity entries => a flooded lane never blocks the others.
+#Entries are requests (dicts) or batch parts (see batch.py).
+class modbusRequestScheduler:
+    def __init__(self,capacity: int = 256,lanes: tuple = MODBUS_PRIORITY_LANES,starvationLimit: int = 64):
+        self.capacity = capacity
+        self.lanes = lanes
+        self.laneIndex = {name: index for index, name in enumerate(lanes)}
+        self.starvationLimit = starvationLimit
+
+        #Per lane: devAdd -> deque of entries, in round robin order
+        self.queues = [collections.OrderedDict() for lane in lanes]
+        self.depth = [0] * len(lanes)
+        self.skipped = [0] * len(lanes)
+        self.count = 0
+
+        #Per lane metrics
+        self.enqueued = [0] * len(lanes)
+        self.dropped = [0] * len(lanes)
+        self.maxDepth = [0] * len(lanes)
+
+        self.lock = threading.Condition()
+
+    def __len__(self):
+        return self.count
+
+    def lane(self,entry) -> int:
+        if isinstance(entry,batch.modbusBatchPart):
+            lane = self.requestedLane(entry.batch.envelope)
+            if lane != None:
+                return lane
+            return min(self.msgLane(command) for index, command in entry.items)
+
+        if batch.isMqttBatch(entry):
+            lane = self.requestedLane(entry)
+            if lane != None:
+                return lane
+            commands = entry["commands"] if isinstance(entry["commands"],list) else []
+            write = any(isinstance(command,dict) and isModbusWrite(command) for command in commands)
+            return self.laneIndex.get("write" if write else "read",0)
+
+        return self.msgLane(entry)
+
+    def msgLane(self,mqttMsg: dict) -> int:
+        lane = self.requestedLane(mqttMsg)
+        if lane != None:
+            return lane
+        return self.laneIndex.get("write" if isModbusWrite(mqttMsg) else "read",0)
+
+    #Lane asked for by the request itself or its topic, None if there is none (unknown lanes are ignored)
+    def requestedLane(self,mqttMsg: dict) -> int | None:
+        priority = mqttMsg.get("priority",mqttMsg.get("_priority"))
+
+        if isinstance(priority,int) and not isinstance(priority,bool) and 0 <= priority < len(self.lanes):
+            return priority
+        if isinstance(priority,str):
+            return self.laneIndex.get(priority)
+        return None
+
+    @staticmethod
+    def device(entry):
+        #Batches and malformed addresses share one round robin slot
+        devAdd = entry.get("devAdd") if isinstance(entry,dict) else None
+        return devAdd if isinstance(devAdd,int) else None
+
+    # This is a blocking condition
+    def send(self,msg):
+        sent = False
+
+        while True:
+            if not sent:
+                sent = self.nb_send(msg)
+            yield sent
+
+    def nb_send(self,msg) -> bool:
+        lane = self.lane(msg)
+        device = self.device(msg)
+
+        with self.lock:
+            if self.depth[lane] == self.capacity:
+                self.dropped[lane] += 1
+                return False
+
+            devices = self.queues[lane]
+            if device not in devices:
+                devices[device] = collections.deque()
+            devices[device].append(msg)
+
+            self.depth[lane] += 1
+            self.count += 1
+            self.enqueued[lane] += 1
+            if self.depth[lane] > self.maxDepth[lane]:
+                self.maxDepth[lane] = self.depth[lane]
+            self.lock.notify()
+
+        pyRTOS.wake()
+        return True
+
+    # This is a blocking condition.
+    # out_buffer should be a list
+    def recv(self,out_buffer):
+        received = False
+
+        while True:
+            if not received:
+                msgs = self.recv_many(1)
+                if len(msgs) > 0:
+                    out_buffer.extend(msgs)
+                    received = True
+            yield received
+
+    def nb_recv(self):
+        msgs = self.recv_many(1)
+        if len(msgs) > 0:
+            return msgs[0]
+        else:
+            return None
+
+    #Blocks the calling thread (never use this from a task) until a request is waiting or the timeout expires
+    def wait(self,timeout: float = None) -> bool:
+        with self.lock:
+            return self.lock.wait_for(lambda: self.count > 0,timeout)
+
+    #Removes and returns up to n entries (all of them if n is None) in scheduling order
+    def recv_many(self,n: int = None) -> list:
+        with self.lock:
+            wasFull = any(depth == self.capacity for depth in self.depth)
+
+            if n == None or n > self.count:
+                n = self.count
+
+            msgs = [self.popNext() for i in range(n)]
+
+        #Let senders blocked on a full lane retry
+        if wasFull and n > 0:
+            pyRTOS.wake()
+
+        return msgs
+
+    #Removes and returns the queued requests to devAdd for which match(request) is true, in queue order.
+    #Takes nothing while a write to devAdd (or a broadcast write) is queued, so no read ever moves ahead of a write.
+    def takeReads(self,devAdd: int,match) -> list:
+        taken = []
+
+        with self.lock:
+            wasFull = any(depth == self.capacity for depth in self.depth)
+
+            for devices in self.queues:
+                if any(isModbusWrite(entry) for device in (devAdd,0) for entry in devices.get(device,())):
+                    return []
+                for entry in devices.get(None,()):
+                    if isinstance(entry,batch.modbusBatchPart) and \
+                       any(command.get("devAdd") in (devAdd,0) and isModbusWrite(command) for index, command in entry.items):
+                        return []
+
+            for lane, devices in enumerate(self.queues):
+                entries = devices.get(devAdd)
+                if entries == None:
+                    continue
+
+                kept = collections.deque()
+                for entry in entries:
+                    (taken if match(entry) else kept).append(entry)
+                if len(kept) == len(entries):
+                    continue
+
+                self.depth[lane] -= len(entries) - len(kept)
+                self.count -= len(entries) - len(kept)
+                if len(kept) > 0:
+                    #Keeps the device's round robin position
+                    devices[devAdd] = kept
+                else:
+                    del devices[devAdd]
+
+        if wasFull and len(taken) > 0:
+            pyRTOS.wake()
+
+        return taken
+
+    #Caller holds the lock and made sure an entry is waiting
+    def popNext(self):
+        waiting = [index for index, depth in enumerate(self.depth) if depth > 0]
+        lane = waiting[0]
+        for index in waiting[1:]:
+            self.skipped[index] += 1
+            if self.skipped[index] > self.starvationLimit and lane == waiting[0]:
+                lane = index
+        self.skipped[lane] = 0
+
+        #Round robin => the device served goes to the back of the lane
+        devices = self.queues[lane]
+        device, entries = next(iter(devices.items()))
+        msg = entries.popleft()
+        if len(entries) > 0:
+            devices.move_to_end(device)
+        else:
+            del devices[device]
+
+        self.depth[lane] -= 1
+        self.count -= 1
+        return msg
+
+    def laneDepths(self) -> dict:
+        return dict(zip(self.lanes,self.depth))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                        lane: {
+                                "depth"   : self.depth[index],
+                                "maxDepth": self.maxDepth[index],
+                                "enqueued": self.enqueued[index],
+                                "dropped" : self.dropped[index],
+                                "devices" : len(self.queues[index]),
+                              }
+                        for index, lane in enumerate(self.lanes)
+                   }
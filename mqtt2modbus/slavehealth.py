@@ -0,0 +1,170 @@
+import time
+import minimalmodbus
+from debug_nid import debug
+from mqtt2modbus import mqtt2modbus
+from mqtt2modbus import asyncrtu
+
+
+#Raised when a slave answered with a modbus exception => the slave itself is alive
+MODBUS_SLAVE_EXCEPTIONS = (minimalmodbus.SlaveReportedException,asyncrtu.modbusSlaveError)
+
+#Raised when the slave did not answer at all => the only errors counted as a missed answer
+MODBUS_NO_RESPONSE_ERRORS = (minimalmodbus.NoResponseError,asyncrtu.modbusNoResponseError)
+
+SLAVE_CLOSED    = "closed"
+SLAVE_OPEN      = "open"
+SLAVE_HALF_OPEN = "half-open"
+
+
+def modbusWireTime(modfunc: int,regCount: int,baudrate: int) -> float:
+    #Seconds the request and response frames spend on the wire (11 bits per character)
+    match modfunc:
+        case 1 | 2:
+            request, response = 8, 5 + (regCount + 7) // 8
+        case 3 | 4:
+            request, response = 8, 5 + 2 * regCount
+        case 15:
+            request, response = 9 + (regCount + 7) // 8, 8
+        case 16:
+            request, response = 9 + 2 * regCount, 8
+        case _:
+            request, response = 8, 8
+
+    return (request + response) * 11 / baudrate
+
+
+class modbusSlaveState:
+    __slots__ = ("srtt","rttvar","backoff","failures","state","openUntil","openTime","requests","timeouts","rejected")
+
+    def __init__(self,openTime: float):
+        #Smoothed slave latency (round trip minus wire time) and its mean deviation, None until the first answer
+        self.srtt = None
+        self.rttvar = 0
+        #Doubles with every missed answer, reset by the next one
+        self.backoff = 1
+        self.failures = 0
+
+        self.state = SLAVE_CLOSED
+        self.openUntil = 0
+        self.openTime = openTime
+
+        self.requests = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+
+#Response time statistics and circuit breaker per slave address of one bus.
+#The serial timeout of every transaction is derived from the slave's smoothed latency (srtt + 4 * rttvar, like TCP)
+#plus the wire time of the frames, bounded by minTimeout and the bus timeout. Slaves without any answer yet get
+#the bus timeout.
+#failureThreshold missed answers in a row open the breaker => requests to that slave are rejected with CIRCUIT_OPEN
+#for openTime seconds. Then one probe request is let through (half-open): an answer closes the breaker, another
+#miss opens it again for twice as long (at most maxOpenTime).
+#Not thread safe => every bus owns its own.
+class modbusSlaveHealth:
+    def __init__(self,baudrate: int,maxTimeout: float,adaptiveTimeout: bool = True,minTimeout: float = 0.05,
+                 failureThreshold: int = 3,openTime: float = 5,maxOpenTime: float = 60):
+        self.baudrate = baudrate
+        self.maxTimeout = maxTimeout
+        self.adaptiveTimeout = adaptiveTimeout
+        self.minTimeout = minTimeout
+        self.failureThreshold = failureThreshold
+        self.openTime = openTime
+        self.maxOpenTime = maxOpenTime
+
+        #devAdd -> modbusSlaveState
+        self.slaves = {}
+
+    def slave(self,devAdd: int) -> modbusSlaveState:
+        slave = self.slaves.get(devAdd)
+        if slave == None:
+            slave = self.slaves[devAdd] = modbusSlaveState(self.openTime)
+        return slave
+
+    #False if requests to devAdd have to be rejected right now
+    def allow(self,devAdd: int) -> bool:
+        slave = self.slaves.get(devAdd)
+        if slave == None or slave.state == SLAVE_CLOSED:
+            return True
+
+        now = time.monotonic()
+        if now < slave.openUntil:
+            slave.rejected += 1
+            return False
+
+        #Let one probe through => a probe that never completes is replaced after another openTime
+        slave.state = SLAVE_HALF_OPEN
+        slave.openUntil = now + slave.openTime
+        return True
+
+    def timeout(self,devAdd: int,modfunc: int,regCount: int) -> float:
+        slave = self.slaves.get(devAdd)
+        if not self.adaptiveTimeout or slave == None or slave.srtt == None:
+            return self.maxTimeout
+
+        timeout = (modbusWireTime(modfunc,regCount,self.baudrate) + slave.srtt + 4 * slave.rttvar) * slave.backoff
+        return min(max(timeout,self.minTimeout),self.maxTimeout)
+
+    #Record the outcome of a transaction => errors holds the exceptions it raised.
+    #Errors that are neither a timeout nor a slave exception (bad request values, garbled responses) say nothing
+    #about the slave's health and leave its state alone.
+    def update(self,devAdd: int,modfunc: int,regCount: int,rtt: float,errors: list):
+        slave = self.slave(devAdd)
+        slave.requests += 1
+
+        if not any(isinstance(e,MODBUS_NO_RESPONSE_ERRORS) for e in errors):
+            if not all(isinstance(e,MODBUS_SLAVE_EXCEPTIONS) for e in errors):
+                return
+
+            latency = max(rtt - modbusWireTime(modfunc,regCount,self.baudrate),0)
+            if slave.srtt == None:
+                slave.srtt = latency
+                slave.rttvar = latency / 2
+            else:
+                slave.rttvar = 0.75 * slave.rttvar + 0.25 * abs(slave.srtt - latency)
+                slave.srtt = 0.875 * slave.srtt + 0.125 * latency
+
+            slave.backoff = 1
+            slave.failures = 0
+            if slave.state != SLAVE_CLOSED:
+                debug.logging.info("Slave %s answers again, closing circuit",devAdd)
+                slave.state = SLAVE_CLOSED
+                slave.openTime = self.openTime
+            return
+
+        slave.timeouts += 1
+        slave.failures += 1
+        slave.backoff = min(slave.backoff * 2,64)
+
+        if slave.state == SLAVE_HALF_OPEN:
+            slave.openTime = min(slave.openTime * 2,self.maxOpenTime)
+        elif slave.failures < self.failureThreshold:
+            return
+
+        debug.logging.info("Slave %s not answering, opening circuit for %ss",devAdd,slave.openTime)
+        slave.state = SLAVE_OPEN
+        slave.openUntil = time.monotonic() + slave.openTime
+
+    #(devAdd,modfunc,register count) of a bus transaction (see coalesceModbusReads)
+    @staticmethod
+    def layout(transaction: list) -> tuple:
+        first = transaction[0][0]
+        if len(transaction) > 1:
+            regAdd = min(request[0].regAdd for request in transaction)
+            regEnd = max(request[0].regAdd + request[0].regCount for request in transaction)
+            return (first.devAdd,first.modfunc,regEnd - regAdd)
+
+        regCount = len(first.regData) if first.transactionType == 1 and isinstance(first.regData,list) else first.regCount
+        return (first.devAdd,first.modfunc,regCount)
+
+    def stats(self) -> dict:
+        return {
+                    devAdd: {
+                                "state"   : slave.state,
+                                "srtt"    : slave.srtt,
+                                "requests": slave.requests,
+                                "timeouts": slave.timeouts,
+                                "rejected": slave.rejected,
+                            }
+                    for devAdd, slave in list(self.slaves.items())
+               }
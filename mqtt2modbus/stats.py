@@ -0,0 +1,154 @@
+import time
+import minimalmodbus
+from mqtt2modbus import mqtt2modbus
+from mqtt2modbus import asyncrtu
+
+
+#Request tracing => requests carry a "_trace" dict of stage -> time.monotonic() that their response inherits:
+#
+#   rx       received from the broker          routed   handed to a bus queue
+#   queued   put on the request queue          dequeued taken off the bus queue by the bus worker
+#   tx       serial transmission started       rsp      bus transaction finished
+#   pub      response published
+#
+#Requests without "_trace" are not timed at all.
+MODBUS_TRACE_STAGES = (
+    ("decode" ,"rx"      ,"queued"),
+    ("queue"  ,"queued"  ,"routed"),
+    ("bus_queue","routed","dequeued"),
+    ("prepare","dequeued","tx"),
+    ("bus"    ,"tx"      ,"rsp"),
+    ("publish","rsp"     ,"pub"),
+    ("total"  ,"rx"      ,"pub"),
+)
+
+#Stages also kept per slave address
+MODBUS_DEVICE_STAGES = ("bus","total")
+
+#Responses are counted by result name
+MODBUS_RESULT_NAMES = {status.value: status.name for status in mqtt2modbus.mqtt2Modbus_ErrorStatus}
+
+MODBUS_TIMEOUT_ERRORS = (minimalmodbus.NoResponseError,asyncrtu.modbusNoResponseError)
+MODBUS_CRC_ERRORS = (minimalmodbus.InvalidResponseError,asyncrtu.modbusCrcError)
+MODBUS_EXCEPTION_ERRORS = (minimalmodbus.SlaveReportedException,asyncrtu.modbusSlaveError)
+
+
+def traceStamp(mqttMsg: dict,stage: str):
+    trace = mqttMsg.get("_trace")
+    if trace != None:
+        trace[stage] = time.monotonic()
+
+
+#Fixed log2 buckets over microseconds => bucket i counts durations in [2^(i-1),2^i) us, bucket 0 everything below 1us
+class latencyHistogram:
+    __slots__ = ("counts","sum","max")
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.sum = 0
+        self.max = 0
+
+    def record(self,seconds: float):
+        us = int(seconds * 1000000)
+        bucket = us.bit_length()
+        self.counts[bucket if bucket < 32 else 31] += 1
+        self.sum += us
+        if us > self.max:
+            self.max = us
+
+    #Upper bound of the bucket holding quantile q
+    def percentile(self,q: float) -> int:
+        rank = q * sum(self.counts)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return 1 << bucket
+        return 0
+
+    def snapshot(self) -> dict:
+        last = max((bucket for bucket, count in enumerate(self.counts) if count),default=-1)
+        count = sum(self.counts)
+        return {
+                    "count"  : count,
+                    "mean_us": self.sum // count if count else 0,
+                    "p50_us" : self.percentile(0.5),
+                    "p99_us" : self.percentile(0.99),
+                    "max_us" : self.max,
+                    "buckets": self.counts[:last + 1],
+               }
+
+
+#Latency histograms per stage (and per slave address) plus event counters.
+#Updates take no locks => concurrent updates from several threads may very rarely lose a count.
+#Histograms cover the interval since the last snapshot(reset=True), counters only ever grow.
+class modbusStats:
+    def __init__(self):
+        self.stages = {stage: latencyHistogram() for stage, start, end in MODBUS_TRACE_STAGES}
+        self.devices = {}
+        self.counters = {}
+        self.since = time.monotonic()
+
+    def count(self,name: str,n: int = 1):
+        self.counters[name] = self.counters.get(name,0) + n
+
+    def deviceHistograms(self,devAdd: int) -> dict:
+        device = self.devices.get(devAdd)
+        if device == None:
+            device = self.devices[devAdd] = {stage: latencyHistogram() for stage in MODBUS_DEVICE_STAGES}
+        return device
+
+    #Record a published response
+    def recordResponse(self,mqttResponse: dict):
+        self.count(MODBUS_RESULT_NAMES.get(mqttResponse.get("result"),"UNKNOWN"))
+
+        trace = mqttResponse.get("_trace")
+        if trace == None:
+            return
+
+        stages = self.stages
+        devAdd = mqttResponse.get("devAdd")
+        device = self.deviceHistograms(devAdd) if isinstance(devAdd,int) else {}
+
+        for stage, start, end in MODBUS_TRACE_STAGES:
+            if start in trace and end in trace:
+                seconds = trace[end] - trace[start]
+                stages[stage].record(seconds)
+                if stage in device:
+                    device[stage].record(seconds)
+
+    #Count the exceptions a bus transaction raised
+    def recordErrors(self,errors: list):
+        for e in errors:
+            if isinstance(e,MODBUS_TIMEOUT_ERRORS):
+                self.count("timeouts")
+            elif isinstance(e,MODBUS_CRC_ERRORS):
+                self.count("crc_errors")
+            elif isinstance(e,MODBUS_EXCEPTION_ERRORS):
+                self.count("slave_exceptions")
+            else:
+                self.count("io_errors")
+
+    def snapshot(self,reset: bool = False) -> dict:
+        stages, devices = self.stages, self.devices
+        now = time.monotonic()
+        snapshot = {
+                        "interval": now - self.since,
+                        "counters": dict(self.counters),
+                        "stages"  : {stage: histogram.snapshot() for stage, histogram in stages.items()},
+                        "devices" : {devAdd: {stage: histogram.snapshot() for stage, histogram in list(device.items())}
+                                     for devAdd, device in list(devices.items())},
+                   }
+
+        if reset:
+            self.stages = {stage: latencyHistogram() for stage, start, end in MODBUS_TRACE_STAGES}
+            self.devices = {}
+            self.since = now
+
+        return snapshot
+
+
+#Stats of the bridge => updated by the bus workers and the publish path
+bridgeStats = modbusStats()
@@ -0,0 +1,259 @@
+import asyncio
+import struct
+import threading
+import time
+from debug_nid import debug
+from mqtt2modbus import mqtt2modbus
+from mqtt2modbus import stats
+
+
+#Modbus TCP front end => local clients (HMIs, historians) reach the RS485 slaves without going through MQTT.
+#
+#Every request frame (MBAP header + PDU) becomes a request like the ones received over MQTT and is handed to
+#submit(mqttMsg,receivedAt), so it takes the same admission control, request queue, scheduling, caching and
+#health checks. The "_reply" context of the request is called with its response, which is written back on the
+#client's connection under the transaction id of the request. Clients may pipeline up to maxPending requests,
+#responses come back as soon as they are ready (not necessarily in request order).
+#Unit ids are mapped onto slave addresses by unitMap, unmapped unit ids are used as slave addresses.
+
+#transaction id | protocol id (0) | length (unit id + PDU) | unit id
+MBAP_HEADER = struct.Struct(">HHHB")
+
+#Largest PDU of a Modbus frame
+MODBUS_MAX_PDU = 253
+
+#Modbus exception codes
+MODBUS_ILLEGAL_FUNCTION         = 0x01
+MODBUS_ILLEGAL_DATA_VALUE       = 0x03
+MODBUS_SERVER_FAILURE           = 0x04
+MODBUS_SERVER_BUSY              = 0x06
+MODBUS_GATEWAY_PATH_UNAVAILABLE = 0x0A
+MODBUS_GATEWAY_TARGET_FAILED    = 0x0B
+
+#Result of a response => exception code sent to the client. Anything else but OK is a server failure.
+MODBUS_TCP_EXCEPTIONS = {
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_CMD.value         : MODBUS_ILLEGAL_FUNCTION,
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_DEV_ADDRESS.value : MODBUS_GATEWAY_PATH_UNAVAILABLE,
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.MISSING_PARAMETER.value   : MODBUS_ILLEGAL_DATA_VALUE,
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_PARAMETER.value   : MODBUS_ILLEGAL_DATA_VALUE,
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.MODBUS_IO_FAILED.value    : MODBUS_GATEWAY_TARGET_FAILED,
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.CIRCUIT_OPEN.value        : MODBUS_GATEWAY_TARGET_FAILED,
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.EXPIRED.value             : MODBUS_SERVER_BUSY,
+    mqtt2modbus.mqtt2Modbus_ErrorStatus.OVERLOADED.value          : MODBUS_SERVER_BUSY,
+}
+
+
+class modbusTcpIllegalFunction(ValueError):
+    pass
+
+
+#Request PDU => (modfunc,regAdd,regCount,regData) as used by mqtt requests.
+#Raises modbusTcpIllegalFunction for unsupported function codes and ValueError (or struct.error) for bad values.
+def modbusTcpRequest(pdu: bytes) -> tuple:
+    modfunc = pdu[0]
+
+    match modfunc:
+        case 1 | 2:
+            regAdd, regCount = struct.unpack_from(">HH",pdu,1)
+            if not 1 <= regCount <= 2000:
+                raise ValueError(f"Can not read {regCount} bits")
+            return (modfunc,regAdd,regCount,[])
+
+        case 3 | 4:
+            regAdd, regCount = struct.unpack_from(">HH",pdu,1)
+            if not 1 <= regCount <= mqtt2modbus.MODBUS_MAX_READ_REGISTERS:
+                raise ValueError(f"Can not read {regCount} registers")
+            return (modfunc,regAdd,regCount,[])
+
+        case 5:
+            regAdd, value = struct.unpack_from(">HH",pdu,1)
+            if value not in (0x0000,0xFF00):
+                raise ValueError(f"Invalid coil value {value:#06x}")
+            return (modfunc,regAdd,1,1 if value else 0)
+
+        case 6:
+            regAdd, value = struct.unpack_from(">HH",pdu,1)
+            return (modfunc,regAdd,1,[value])
+
+        case 15:
+            regAdd, regCount, byteCount = struct.unpack_from(">HHB",pdu,1)
+            if not 1 <= regCount <= 1968 or byteCount != (regCount + 7) // 8 or len(pdu) != 6 + byteCount:
+                raise ValueError("Malformed write multiple coils request")
+            return (modfunc,regAdd,regCount,[(pdu[6 + bit // 8] >> (bit % 8)) & 1 for bit in range(regCount)])
+
+        case 16:
+            regAdd, regCount, byteCount = struct.unpack_from(">HHB",pdu,1)
+            if not 1 <= regCount <= 123 or byteCount != 2 * regCount or len(pdu) != 6 + byteCount:
+                raise ValueError("Malformed write multiple registers request")
+            return (modfunc,regAdd,regCount,list(struct.unpack_from(f">{regCount}H",pdu,6)))
+
+    raise modbusTcpIllegalFunction(f"Unsupported function code {modfunc}")
+
+
+#Response PDU for a request (modfunc,regAdd,regCount,regData) that completed with the registers in regData
+def modbusTcpResponsePdu(request: tuple,regData) -> bytes:
+    modfunc, regAdd, regCount, requestData = request
+
+    match modfunc:
+        case 1 | 2:
+            bits = regData if isinstance(regData,list) else [regData]
+            packed = bytearray((regCount + 7) // 8)
+            for bit, value in enumerate(bits[:regCount]):
+                if value:
+                    packed[bit // 8] |= 1 << (bit % 8)
+            return bytes([modfunc,len(packed)]) + packed
+
+        case 3 | 4:
+            return struct.pack(f">BB{regCount}H",modfunc,2 * regCount,*regData)
+
+        case 5:
+            return struct.pack(">BHH",modfunc,regAdd,0xFF00 if requestData else 0)
+
+        case 6:
+            return struct.pack(">BHH",modfunc,regAdd,requestData[0])
+
+    return struct.pack(">BHH",modfunc,regAdd,regCount)
+
+
+#A connected client => transaction id -> request of every request waiting for its response
+class modbusTcpClient:
+    def __init__(self,writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.peer = "%s:%s" % writer.get_extra_info("peername")[:2]
+        self.pending = {}
+        self.closed = False
+
+
+class modbusTcpServer:
+    def __init__(self,submit,host: str = "127.0.0.1",port: int = 502,unitMap: dict = None,maxClients: int = 16,
+                 maxPending: int = 16,ttl: float = None,priority=None):
+        self.submit = submit
+        self.host = host
+        self.port = port
+        #json config files can only have string keys
+        self.unitMap = {int(unit): devAdd for unit, devAdd in (unitMap or {}).items()}
+        self.maxClients = maxClients
+        self.maxPending = maxPending
+
+        #Copied into every request => "ttl" drops requests the client most likely gave up on,
+        #"priority" picks their queue lane
+        self.requestFields = {}
+        if ttl != None:
+            self.requestFields["ttl"] = ttl
+        if priority != None:
+            self.requestFields["priority"] = priority
+
+        self.loop = None
+        self.server = None
+        self.clients = set()
+
+        #Metrics
+        self.connections = 0
+        self.requests = 0
+        self.rejected = 0
+
+    #Starts listening on its own event loop thread. Raises OSError if the port is unavailable.
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever,name="modbus_tcp_server",daemon=True).start()
+        self.server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self.handle,self.host,self.port),self.loop).result()
+        debug.logging.info("Modbus TCP server listening on %s:%s",self.host,self.port)
+
+    async def handle(self,reader: asyncio.StreamReader,writer: asyncio.StreamWriter):
+        if len(self.clients) >= self.maxClients:
+            debug.logging.warning("Modbus TCP client limit reached, refusing %s",writer.get_extra_info("peername"))
+            writer.close()
+            return
+
+        client = modbusTcpClient(writer)
+        self.clients.add(client)
+        self.connections += 1
+
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_HEADER.size)
+                transactionId, protocolId, length, unit = MBAP_HEADER.unpack(header)
+                if protocolId != 0 or not 2 <= length <= MODBUS_MAX_PDU + 1:
+                    debug.logging.warning("Modbus TCP client %s sent a malformed header, closing",client.peer)
+                    break
+
+                self.request(client,transactionId,unit,await reader.readexactly(length - 1))
+
+        except (asyncio.IncompleteReadError,ConnectionError):
+            pass
+        finally:
+            client.closed = True
+            self.clients.discard(client)
+            writer.close()
+
+    def request(self,client: modbusTcpClient,transactionId: int,unit: int,pdu: bytes):
+        receivedAt = time.monotonic()
+        self.requests += 1
+
+        if len(client.pending) >= self.maxPending or transactionId in client.pending:
+            self.rejected += 1
+            self.send(client,transactionId,unit,bytes([pdu[0] | 0x80,MODBUS_SERVER_BUSY]))
+            return
+
+        try:
+            request = modbusTcpRequest(pdu)
+        except modbusTcpIllegalFunction:
+            self.send(client,transactionId,unit,bytes([pdu[0] | 0x80,MODBUS_ILLEGAL_FUNCTION]))
+            return
+        except (ValueError,struct.error):
+            self.send(client,transactionId,unit,bytes([pdu[0] | 0x80,MODBUS_ILLEGAL_DATA_VALUE]))
+            return
+
+        modfunc, regAdd, regCount, regData = request
+        client.pending[transactionId] = request
+
+        #Called from whichever thread produced the response
+        def reply(mqttResponse: dict):
+            self.loop.call_soon_threadsafe(self.respond,client,transactionId,unit,mqttResponse)
+
+        mqttMsg = {
+                    "cmdName"   :"modbus_tcp",
+                    "uuid"      :f"{client.peer}/{transactionId}",
+                    "devId"     :"",
+                    "devProfile":"",
+                    "modfunc"   :modfunc,
+                    "devAdd"    :self.unitMap.get(unit,unit),
+                    "regAdd"    :regAdd,
+                    "regCount"  :regCount,
+                    "regData"   :regData,
+                    "_reply"    :reply,
+                  } | self.requestFields
+
+        self.submit(mqttMsg,receivedAt)
+
+    def respond(self,client: modbusTcpClient,transactionId: int,unit: int,mqttResponse: dict):
+        request = client.pending.pop(transactionId,None)
+        if request == None or client.closed:
+            return
+
+        modfunc = request[0]
+        result = mqttResponse.get("result")
+        if result == mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value:
+            try:
+                pdu = modbusTcpResponsePdu(request,mqttResponse.get("regData"))
+            except (TypeError,struct.error):
+                pdu = bytes([modfunc | 0x80,MODBUS_SERVER_FAILURE])
+        else:
+            pdu = bytes([modfunc | 0x80,MODBUS_TCP_EXCEPTIONS.get(result,MODBUS_SERVER_FAILURE)])
+
+        self.send(client,transactionId,unit,pdu)
+
+        stats.traceStamp(mqttResponse,"pub")
+        stats.bridgeStats.recordResponse(mqttResponse)
+
+    def send(self,client: modbusTcpClient,transactionId: int,unit: int,pdu: bytes):
+        client.writer.write(MBAP_HEADER.pack(transactionId,0,len(pdu) + 1,unit) + pdu)
+
+    def stats(self) -> dict:
+        return {
+                    "clients"    : len(self.clients),
+                    "connections": self.connections,
+                    "requests"   : self.requests,
+                    "rejected"   : self.rejected,
+                    "pending"    : sum(len(client.pending) for client in list(self.clients)),
+               }
@@ -1,18 +1,19 @@
-import serial.rs485
 import paho.mqtt.client as mqtt
-import minimalmodbus
 import pyRTOS
 import pyRTOS.message
 import json
 #import logging
 from debug_nid import debug
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import sys
 import mqtt2modbus.mqtt2modbus
 from   dotenv import load_dotenv
 import os
+import time
 
 
-#Serial port config details
+#Serial port config details (default single bus)
 RS485_PORT = "/dev/ttyTHS1"
 RS485_BAUDRATE = 9600
 RS485_SERIAL_TIMEOUT = 1
@@ -24,138 +25,550 @@ MQTT_BROKER_PORT = 1884
 #Modbus Mqtt Topics
 MODBUS_CMD_TOPIC =  "modbus_mqtt/cmd_request"
 MODBUS_RESP_TOPIC = "modbus_mqtt/cmd_response"
-
-
-#Message Queue Size
+MODBUS_POLL_TOPIC = "modbus_mqtt/poll"
+MODBUS_STATS_TOPIC = "modbus_mqtt/stats"
+
+#Stats => per stage latency histograms (reset every interval), counters and queue/slave state are published on
+#MODBUS_STATS_TOPIC every MODBUS_STATS_INTERVAL seconds. 0 disables request tracing and stats publishing.
+MODBUS_STATS_INTERVAL = 10
+
+#Scheduler profiling => per task run/blocked/ready times, loop rate and idle fraction are logged every
+#PYRTOS_PROFILE_INTERVAL seconds and added to the stats. 0 disables profiling (no overhead).
+PYRTOS_PROFILE_INTERVAL = 0
+
+#Payload codecs per request topic => responses use the codec (and topic suffix) of their request.
+#With MQTT v5 a "content-type" (content type property or user property) selects the codec instead.
+#"msgpack" is available when the msgpack package is installed.
+MQTT_PROTOCOL = mqtt.MQTTv311
+MQTT_TOPIC_CODECS = {
+    MODBUS_CMD_TOPIC             : "json",
+    MODBUS_CMD_TOPIC + "/packed" : "packed",
+}
+
+#Priority lanes ("urgent","write","read","bulk") => requests queue by lane and round robin between slaves within a lane.
+#A request picks its lane with a "priority" field, or by the topic it was published on. Otherwise writes use
+#"write" and reads "read". Topics listed here are subscribed in addition to MQTT_TOPIC_CODECS (json payloads).
+MQTT_TOPIC_PRIORITIES = {
+    MODBUS_CMD_TOPIC + "/urgent" : "urgent",
+    MODBUS_CMD_TOPIC + "/bulk"   : "bulk",
+}
+
+
+#Outbound publishing => responses, poll samples and stats are encoded and published by their own task from a queue
+#of MQTT_PUBLISH_QUEUE_SIZE messages, so bus I/O never waits for the broker. At most MQTT_MAX_INFLIGHT publishes
+#wait for their acknowledgement (on_publish). A slow broker fills the queue and requests arriving while it is more
+#than half full are answered with OVERLOADED.
+MQTT_PUBLISH_QUEUE_SIZE = 1024
+MQTT_MAX_INFLIGHT = 256
+
+#qos, retain and batching window (seconds) per topic => exact topic or prefix ending in "#", first match wins.
+#Messages to a topic with a batching window are collected for that long (at most MQTT_MAX_BATCH of them) and
+#published as one {"items": [...]} message.
+MQTT_PUBLISH_TOPICS = {
+    MODBUS_RESP_TOPIC + "#" : {"qos": 0,"retain": False,"batchWindow": 0},
+    MODBUS_POLL_TOPIC + "#" : {"qos": 0,"retain": False,"batchWindow": 0},
+    MODBUS_STATS_TOPIC      : {"qos": 0,"retain": False,"batchWindow": 0},
+}
+MQTT_MAX_BATCH = 64
+
+
+#Device profiles => directory of *.json profiles mapping cmdName to register layouts, reloaded when files change
+DEVICE_PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"profiles")
+
+#Message Queue Size (per priority lane)
 MQTT_MSG_QUEUE_SIZE = 256
 
+#Admission control
+#Requests arriving while MODBUS_MAX_OUTSTANDING requests are queued (request queue plus every bus queue), while
+#their queue lane is full or while the publish queue is congested (see MQTT_PUBLISH_QUEUE_SIZE) are answered right
+#away with OVERLOADED. 0 => only full lanes and publish congestion reject.
+#Requests may carry "ttl" (seconds) or "deadline" (unix time) => once expired they are answered with EXPIRED
+#instead of using the bus. Both count as "shed_overloaded"/"shed_expired" in the stats.
+MODBUS_MAX_OUTSTANDING = 0
+
+#Request dispatch
+#Work conserving dispatch sends queued requests back to back and only blocks when the queue is empty.
+#When disabled, one request is handled per 100ms tick.
+MODBUS_WORK_CONSERVING = True
+#Minimum bus silence between frames in seconds (None => 3.5 character times at the bus baud rate)
+MODBUS_INTERFRAME_GAP = None
+#Max requests handled back to back before letting other tasks run
+MODBUS_MAX_BURST = 32
+
+#Read coalescing
+#Merge queued FC3/FC4 reads to the same device into one transaction when their ranges are at most
+#MODBUS_COALESCE_MAX_GAP registers apart (merged reads never exceed 125 registers). Only raise the gap for
+#slaves that answer reads of unmapped registers, others reject the merged read and every block is read again
+#on its own.
+MODBUS_READ_COALESCING = True
+MODBUS_COALESCE_MAX_GAP = 0
+
+#Read deduplication
+#Identical reads (same devAdd, modfunc, regAdd and regCount) waiting at the same time, or routed to the bus while
+#one of them is in flight, share one bus transaction. Saved transactions count as "deduplicated_reads".
+MODBUS_READ_DEDUP = True
+
+#Write coalescing
+#Of several queued FC6/FC5 writes to the same register only the latest is sent, the earlier ones get its result
+#(counted as "superseded_writes"). Contiguous single writes to one device are sent as one FC16/FC15 write, which
+#every slave on the bus has to support. A burst containing a write is held for MODBUS_WRITE_WINDOW seconds so
+#the rest of a setpoint burst can join it.
+MODBUS_WRITE_COALESCING = False
+MODBUS_WRITE_WINDOW = 0.005
+
+#Periodic polling => every point is read every "interval" seconds and published on MODBUS_POLL_TOPIC/<name>
+#only when a value moves by more than "deadband" (any change if 0), the result changes, or every "heartbeat" seconds.
+#e.g. {"name":"meter1_power","devAdd":1,"modfunc":3,"regAdd":0,"regCount":4,"interval":1.0,"deadband":0,"heartbeat":60}
+MODBUS_POLL_POINTS = []
+
+#Read cache
+#Reads repeated within their TTL (seconds) are answered without touching the bus and flagged "cached" in the response.
+#TTL lookup order: device address, device profile, default. A TTL of 0 disables caching.
+#Writes invalidate overlapping cached ranges.
+MODBUS_CACHE = {
+    "defaultTtl" : 0,
+    "deviceTtl"  : {},
+    "profileTtl" : {},
+    "maxEntries" : 1024,
+}
+
+#Register image
+#Every completed read is also written to a memory mapped file per device (<dir>/<bus name>/<devAdd>.img), so local
+#processes can read the latest values with mqtt2modbus.modbusRegisterImageReader instead of a request.
+#None disables it. A tmpfs such as /dev/shm keeps the images in memory.
+MODBUS_REGISTER_IMAGE_DIR = None
+
+#Slave health
+#Serial timeouts adapt to each slave's measured response time (never above the bus timeout). After failureThreshold
+#missed answers in a row requests to that slave fail immediately with CIRCUIT_OPEN, one probe request every
+#openTime seconds (doubling up to maxOpenTime) checks whether it answers again. None disables both.
+MODBUS_SLAVE_HEALTH = {
+    "adaptiveTimeout" : True,
+    "minTimeout"      : 0.05,
+    "failureThreshold": 3,
+    "openTime"        : 5,
+    "maxOpenTime"     : 60,
+}
+
+#Modbus TCP server => local Modbus TCP clients reach the RS485 slaves through the same request queue as mqtt
+#requests, without a broker in between. None disables it. unitMap maps unit ids onto slave addresses (unmapped
+#unit ids are used as addresses), ttl (seconds) drops requests the client most likely gave up on and priority
+#picks their queue lane.
+#e.g. {"host": "127.0.0.1","port": 502,"unitMap": {},"maxClients": 16,"maxPending": 16,"ttl": 2.0,"priority": None}
+MODBUS_TCP_SERVER = None
+
+#RS485 buses => one worker thread per bus.
+#Requests are routed by "devId" (devIds) first and "devAdd" (slaves) second. A bus without slaves and
+#devIds catches everything else. Set RS485_BUS_CONFIG in the environment to load this list from a json file.
+RS485_BUSES = [
+    {
+        "name"     : "bus0",
+        "port"     : RS485_PORT,
+        "baudrate" : RS485_BAUDRATE,
+        "timeout"  : RS485_SERIAL_TIMEOUT,
+        "slaves"   : [],
+        "devIds"   : [],
+        #"minimalmodbus" or "asyncio" => non blocking transport that ends frames on expected length
+        "transport": "minimalmodbus",
+    },
+]
+
 def on_disconnect(self, client, userdata, reason_code, properties):
     #Log error code
-    debug.logging.debug('Connection result code ' + str(reason_code))  
+    debug.logging.debug('Connection result code %s',reason_code)  
     debug.logging.debug('MQTT Client Disconnected.Attempting Reconnection...')
 
 def on_publish(client, userdata, mid, reason_code, properties):
     # reason_code and properties will only be present in MQTTv5. It's always unset in MQTTv3
-    debug.logging.debug(f"on_publish callback triggered with reason code :{reason_code}")
+    if reason_code.is_failure:
+        debug.logging.warning("Broker rejected publish %s with reason code :%s",mid,reason_code)
+    publisher.acknowledge(mid)
 
 def on_subscribe(client, userdata, mid, reason_code_list, properties):
     if reason_code_list[-1].is_failure:
-        debug.logging.debug(f"Broker rejected you subscription: {reason_code_list[-1]}")
+        debug.logging.debug("Broker rejected you subscription: %s",reason_code_list[-1])
     else:
-        debug.logging.debug(f"Broker granted the following QoS: {reason_code_list[-1].value}")
+        debug.logging.debug("Broker granted the following QoS: %s",reason_code_list[-1].value)
 
 def on_unsubscribe(client, userdata, mid, reason_code_list, properties):
     # Be careful, the reason_code_list is only present in MQTTv5.
     if len(reason_code_list) == 0 or not reason_code_list[-1].is_failure:
         debug.logging.debug("unsubscribe succeeded (if SUBACK is received in MQTTv3 it success)")
     else:
-        debug.logging.debug(f"Broker replied with failure: {reason_code_list[-1]}")
+        debug.logging.debug("Broker replied with failure: %s",reason_code_list[-1])
 
     client.disconnect()    
 
 def on_connect(client, userdata, flags, reason_code, properties):
-    debug.logging.debug(f"Connected with result code : {reason_code}")
+    debug.logging.debug("Connected with result code : %s",reason_code)
+    publisher.reconnected()
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe(MODBUS_CMD_TOPIC)
+    client.subscribe([(topic,0) for topic in MQTT_TOPIC_CODECS | MQTT_TOPIC_PRIORITIES])
+
+#Pick the payload codec of a received message
+def msg_codec(msg):
+    
+    #MQTT v5 content type wins over the topic
+    properties = getattr(msg,"properties",None)
+    if properties != None:
+        contentType = getattr(properties,"ContentType",None)
+        for key, value in getattr(properties,"UserProperty",[]):
+            if key.lower() == "content-type":
+                contentType = value
+        if contentType in mqtt2modbus.codecsByContentType:
+            return mqtt2modbus.codecsByContentType[contentType]
+
+    return mqtt2modbus.payloadCodecs[MQTT_TOPIC_CODECS.get(msg.topic,"json")]
 
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, userdata, msg):
     
+    receivedAt = time.monotonic()
+
     #Log receipt of msg
-    debug.logging.debug(f"Msg received on topic:"+msg.topic+" Payload:" +str(msg.payload))
+    debug.logging.debug("Msg received on topic:%s Payload:%s",msg.topic,msg.payload)
     
+    codec = msg_codec(msg)
     try:
-        #Convert to JSON object
-        mqttJsonMsg = json.loads(msg.payload)
+        #Decode payload
+        mqttJsonMsg = codec.decode(msg.payload)
+
+    except (TypeError,ValueError,IndexError,KeyError) as decodeErr:
+        debug.logging.error("%r",decodeErr)
+        mqtt2modbus.bridgeStats.count("decode_errors")
+        return
+
+    if not isinstance(mqttJsonMsg,dict):
+        debug.logging.error("Request is not an object")
+        mqtt2modbus.bridgeStats.count("decode_errors")
+        return
+
+    #Answer in kind => codec and response topic travel with the request
+    mqttJsonMsg["_codec"] = codec.name
+    mqttJsonMsg["_topic"] = MODBUS_RESP_TOPIC + msg.topic[len(MODBUS_CMD_TOPIC):]
+    if msg.topic in MQTT_TOPIC_PRIORITIES:
+        mqttJsonMsg["_priority"] = MQTT_TOPIC_PRIORITIES[msg.topic]
+
+    submit_request(mqttJsonMsg,receivedAt)
+
+#Queue a request received over MQTT or Modbus TCP (see mqtt2modbus.modbusTcpServer)
+def submit_request(mqttJsonMsg, receivedAt):
 
-    except TypeError as typeErr:
-        debug.logging.error(f"{typeErr}")
+    if MODBUS_STATS_INTERVAL > 0:
+        mqttJsonMsg["_trace"] = {"rx": receivedAt}
 
-    except ValueError as valueErr:
-        debug.logging.error(f"{valueErr}")
+    #Admission control => stale requests and requests we have no room for are answered right away
+    try:
+        expires = mqtt2modbus.requestExpiry(mqttJsonMsg,receivedAt)
+    except ValueError as expiryErr:
+        debug.logging.debug("%s",expiryErr)
+        shed_request(mqttJsonMsg,mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_PARAMETER)
+        return
+
+    if expires != None:
+        mqttJsonMsg["_expires"] = expires
+        if receivedAt >= expires:
+            shed_request(mqttJsonMsg,mqtt2modbus.mqtt2Modbus_ErrorStatus.EXPIRED)
+            return
+
+    #Modbus TCP responses do not go through the publish queue
+    congested = publisher.congested() and "_reply" not in mqttJsonMsg
+    if (MODBUS_MAX_OUTSTANDING > 0 and outstanding_requests() >= MODBUS_MAX_OUTSTANDING) or congested:
+        shed_request(mqttJsonMsg,mqtt2modbus.mqtt2Modbus_ErrorStatus.OVERLOADED)
+        return
 
     #Add message to queue
+    mqtt2modbus.traceStamp(mqttJsonMsg,"queued")
     if mqttMsgQueue.nb_send(mqttJsonMsg) == True:
-        debug.logging.debug(f"Msg added to queue!")
+        debug.logging.debug("Msg added to queue!")
     else :
-        debug.logging.debug(f"Failed to add msg to queue!")
+        debug.logging.warning("Failed to add msg to queue!")
+        shed_request(mqttJsonMsg,mqtt2modbus.mqtt2Modbus_ErrorStatus.OVERLOADED)
+
+#Requests waiting in the request queue and every bus queue
+def outstanding_requests():
+    return len(mqttMsgQueue) + sum(len(bus.queue) for bus in buses)
+
+#Answer a request (or batch envelope) that will not be served, so its client can back off instead of timing out
+def shed_request(mqttMsg, result):
+
+    if mqtt2modbus.isMqttBatch(mqttMsg):
+        commands = mqttMsg["commands"]
+        mqtt2modbus.modbusBatch(mqttMsg,publish_response).reject(result)
+        shed = len(commands) if isinstance(commands,list) else 1
+    else:
+        publish_response(mqtt2modbus.mqttMsg2ErrorResponse(mqttMsg,result))
+        shed = 1
+
+    if result == mqtt2modbus.mqtt2Modbus_ErrorStatus.EXPIRED:
+        mqtt2modbus.bridgeStats.count("shed_expired",shed)
+    elif result == mqtt2modbus.mqtt2Modbus_ErrorStatus.OVERLOADED:
+        mqtt2modbus.bridgeStats.count("shed_overloaded",shed)
 
 
-#Task responsible for pulling modbus requests of the queue and placing them on the bus
+#Publish a response to a modbus request => encoded and published by the publish task
+def publish_response(mqttModbusResponse):
+
+    #Modbus TCP requests are answered on their connection
+    reply = mqttModbusResponse.get("_reply")
+    if reply != None:
+        reply(mqttModbusResponse)
+        return
+    
+    #Responses to our own polls go back to the poller
+    if poller.owns(mqttModbusResponse):
+        poller.responses.nb_send(mqttModbusResponse)
+        return
+
+    #Log response => only its id, the publish task still adds to the response while the log writer formats
+    debug.logging.debug("Queueing response %s for publishing",mqttModbusResponse.get("uuid",mqttModbusResponse.get("batchId")))
+
+    publisher.submit(mqttModbusResponse.get("_topic",MODBUS_RESP_TOPIC),mqttModbusResponse,mqttModbusResponse.get("_codec","json"),response=True)
+
+#MQTT v5 clients get told how to decode
+def publish_properties(codec):
+    if MQTT_PROTOCOL != mqtt.MQTTv5:
+        return None
+
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.ContentType = codec.contentType
+    return properties
+
+#Route the commands of a batch envelope
+def modbus_batch_router(envelope):
+
+    modbusBatch = mqtt2modbus.modbusBatch(envelope,publish_response)
+    invalid = modbusBatch.validate()
+    if invalid != None:
+        debug.logging.debug("Rejecting batch %s",envelope.get('batchId'))
+        modbusBatch.reject(invalid)
+        return
+
+    mqtt2modbus.traceStamp(envelope,"routed")
+    for bus, part in modbusBatch.split(busRouter.route):
+        if bus.queue.nb_send(part) != True:
+            debug.logging.warning("Bus %s queue full, rejecting batch part!",bus.name)
+            mqtt2modbus.bridgeStats.count("shed_overloaded",len(part.items))
+            for index, command in part.items:
+                modbusBatch.complete(index,mqtt2modbus.mqttMsg2ErrorResponse(command,mqtt2modbus.mqtt2Modbus_ErrorStatus.OVERLOADED))
+
+#Task responsible for pulling modbus requests of the queue and routing them to the bus serving the device
 def modbus_manager_task(self):
+    
+    pending = []
+
     while True:
-        
-        #Pull a request of the mqtt msg queue
-        mqttMsg = mqttMsgQueue.nb_recv()
-
-        #If we have a request then attempt to place it on the bus
-        if mqttMsg != None:
-
-            #Convert mqtt request to a modbus RTU message
-            modbusMsgResult = mqtt2modbus.mqttMsg2ModbusMsg(mqttMsg)
-
-            #Transmit modbus RTU message and wait for response
-            mqttModbusResponse = mqtt2modbus.modbusMsgTx(modbus_port,mqttMsg)
-            
-            #Log response
-            debug.logging.debug(f"Attempting to publish:"+json.dumps(mqttModbusResponse))
-            
-            #publish response
-            mqttc.publish(MODBUS_RESP_TOPIC,json.dumps(mqttModbusResponse))
-        
-        #Yield for 1 secondMODBUS_RESP_TOPIC
-        yield [pyRTOS.timeout(0.1)]
+
+        mqttMsgs = pending + mqttMsgQueue.recv_many()
+        pending = []
+
+        now = time.monotonic()
+
+        for mqttMsg in mqttMsgs:
+
+            #Requests that expired while queued are answered without being routed
+            if mqtt2modbus.isExpired(mqttMsg,now):
+                shed_request(mqttMsg,mqtt2modbus.mqtt2Modbus_ErrorStatus.EXPIRED)
+                continue
+
+            #Batches are split into one part per bus and answered once every part completed
+            if mqtt2modbus.isMqttBatch(mqttMsg):
+                modbus_batch_router(mqttMsg)
+                continue
+
+            bus = busRouter.route(mqttMsg)
+
+            if bus == None:
+                debug.logging.debug("No bus serves devAdd:%s devId:%s",mqttMsg.get('devAdd'),mqttMsg.get('devId'))
+                publish_response(mqtt2modbus.mqttMsg2ErrorResponse(mqttMsg,mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_DEV_ADDRESS))
+                continue
+
+            mqtt2modbus.traceStamp(mqttMsg,"routed")
+            if bus.queue.nb_send(mqttMsg) != True:
+                debug.logging.warning("Bus %s queue full, rejecting msg!",bus.name)
+                shed_request(mqttMsg,mqtt2modbus.mqtt2Modbus_ErrorStatus.OVERLOADED)
+
+        #Block until a request arrives
+        yield [mqttMsgQueue.recv(pending)]
+
+#Publish a poll sample that changed
+def publish_poll(point, mqttModbusResponse):
+    publisher.submit(MODBUS_POLL_TOPIC + "/" + point.name,mqttModbusResponse)
+
+#Task responsible for issuing periodic polls and publishing their changes
+def modbus_poller_task(self):
+
+    mqttResponses = []
+
+    while True:
+        poller.processResponses(mqttResponses)
+        mqttResponses = []
+
+        poller.pollDue()
+
+        #Block until a poll response arrives or the next poll is due
+        yield [poller.responses.recv(mqttResponses),pyRTOS.timeout(poller.nextDue())]
+
+#Publish latency histograms, counters and the state of queues, slaves and caches
+def publish_stats():
+    snapshot = mqtt2modbus.bridgeStats.snapshot(reset=True)
+    snapshot["requestQueue"] = mqttMsgQueue.stats()
+    snapshot["publishQueue"] = publisher.stats()
+    if tcpServer != None:
+        snapshot["tcpServer"] = tcpServer.stats()
+    snapshot["buses"] = {}
+
+    for bus in buses:
+        snapshot["buses"][bus.name] = {
+                                        "queue" : bus.queue.stats(),
+                                        "slaves": bus.slaveHealth.stats() if bus.slaveHealth != None else {},
+                                        "cache" : {"hits": bus.readCache.hits,"misses": bus.readCache.misses} if bus.readCache != None else {},
+                                        "image" : {"updates": bus.registerImage.updates,"devices": len(bus.registerImage.images)} if bus.registerImage != None else {},
+                                      }
+
+    scheduler = pyRTOS.profiling_report()
+    if scheduler != None:
+        snapshot["scheduler"] = scheduler
+
+    publisher.submit(MODBUS_STATS_TOPIC,snapshot)
 
 #Task responsible for managing mqtt connection
 def mqtt_manager_task(self):
+
+    nextStats = time.monotonic() + MODBUS_STATS_INTERVAL
+
     while True:
 
         #Log every time task runs => Allows us to determine if task runs with sufficient frequency
         #logging.debug("Mqtt Manager Task Running\r\n")
-        yield [pyRTOS.timeout(3)]
-
-#Load environment variable file
-load_dotenv()
-
-#Log startup info
-debug.logging.debug("[Starting Modbus Mqtt Bridge:%s]",os.getenv('MQTT_MODBUS_BRIDGE_VERSION'))
-
-#Setting up MQTT comms
-mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-mqttc.on_connect = on_connect
-mqttc.on_message = on_message
-mqttc.on_disconnect = on_disconnect
-mqttc.on_subscribe = on_subscribe
-mqttc.on_unsubscribe = on_unsubscribe
-mqttc.on_publish = on_publish
-mqttc.connect(MQTT_BROKER_IP_ADDRESS, MQTT_BROKER_PORT, 60)
-
-#Setting up RS485 Port and Modbus comms
-#Create Serial Object and configure serial port for RS485 comms
-try:
-    rs485_serial = serial.rs485.RS485(RS485_PORT,RS485_BAUDRATE)
-    rs485_serial.rs485_mode = serial.rs485.RS485Settings(False,True)
-except IOError as e:
-    #This is a critical error -> Terminate script
-    debug.logging.error(f"{e}")
-    sys.exit()
-
-#Create and configure a "modbus instrument"
-modbus_port = minimalmodbus.Instrument(rs485_serial, 0, 'rtu', False, False)
-modbus_port.serial.baudrate = RS485_BAUDRATE
-modbus_port.serial.timeout = RS485_SERIAL_TIMEOUT
-
-#Setting up queue to hold incoming mqtt messages
-mqttMsgQueue = pyRTOS.message.MessageQueue(MQTT_MSG_QUEUE_SIZE)
-
-#Setting up tasks
-pyRTOS.add_task(pyRTOS.Task(modbus_manager_task, name="modbus_manager_task"))
-pyRTOS.add_task(pyRTOS.Task(mqtt_manager_task, name="mqtt_manager_task"))
-
-#Start paho mqtt background thread
-mqttc.loop_start()
-
-#Start RTOS
-pyRTOS.start()
 
+        #Pick up edited device profiles without a restart
+        mqtt2modbus.deviceProfiles.reloadIfChanged()
+
+        sleep = 3
+        if MODBUS_STATS_INTERVAL > 0:
+            now = time.monotonic()
+            if now >= nextStats:
+                publish_stats()
+                nextStats += MODBUS_STATS_INTERVAL
+                #Running late => skip the missed slots instead of publishing a nearly empty snapshot right away
+                if nextStats <= now:
+                    nextStats = now + MODBUS_STATS_INTERVAL
+            sleep = min(sleep,nextStats - time.monotonic())
+
+        yield [pyRTOS.timeout(max(sleep,0))]
+
+#Set up the mqtt client, buses, queues and tasks.
+#client replaces the paho client and busConfig the configured buses (the benchmarks drive the bridge this way).
+def setup(client=None, busConfig=None):
+    global mqttc, publisher, buses, busRouter, mqttMsgQueue, poller, tcpServer
+
+    #Load device profiles
+    mqtt2modbus.deviceProfiles.load(DEVICE_PROFILE_DIR)
+
+    #Setting up MQTT comms
+    mqttc = client if client != None else mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,protocol=MQTT_PROTOCOL)
+    mqttc.on_connect = on_connect
+    mqttc.on_message = on_message
+    mqttc.on_disconnect = on_disconnect
+    mqttc.on_subscribe = on_subscribe
+    mqttc.on_unsubscribe = on_unsubscribe
+    mqttc.on_publish = on_publish
+    mqttc.connect(MQTT_BROKER_IP_ADDRESS, MQTT_BROKER_PORT, 60)
+
+    #Setting up the outbound publish queue
+    publisher = mqtt2modbus.mqttPublisher(mqttc.publish,MQTT_PUBLISH_QUEUE_SIZE,MQTT_PUBLISH_TOPICS,MQTT_MAX_INFLIGHT,MQTT_MAX_BATCH,publish_properties)
+
+    #Setting up RS485 buses and Modbus comms
+    if busConfig == None:
+        busConfig = RS485_BUSES
+        if os.getenv('RS485_BUS_CONFIG') != None:
+            with open(os.getenv('RS485_BUS_CONFIG')) as busConfigFile:
+                busConfig = json.load(busConfigFile)
+
+    buses = []
+    for config in busConfig:
+        config = {
+                    "workConserving" : MODBUS_WORK_CONSERVING,
+                    "interFrameGap"  : MODBUS_INTERFRAME_GAP,
+                    "maxBurst"       : MODBUS_MAX_BURST,
+                    "readCoalescing" : MODBUS_READ_COALESCING,
+                    "coalesceMaxGap" : MODBUS_COALESCE_MAX_GAP,
+                    "readDedup"      : MODBUS_READ_DEDUP,
+                    "writeCoalescing": MODBUS_WRITE_COALESCING,
+                    "writeWindow"    : MODBUS_WRITE_WINDOW,
+                    "queueSize"      : MQTT_MSG_QUEUE_SIZE,
+                    "health"         : MODBUS_SLAVE_HEALTH,
+                    "registerImage"  : os.path.join(MODBUS_REGISTER_IMAGE_DIR,config["name"]) if MODBUS_REGISTER_IMAGE_DIR != None else None,
+                    "cache"          : MODBUS_CACHE if MODBUS_CACHE["defaultTtl"] or MODBUS_CACHE["deviceTtl"] or MODBUS_CACHE["profileTtl"] else None,
+                 } | config
+        bus = mqtt2modbus.modbusBus.fromConfig(config,publish_response)
+        try:
+            bus.open()
+        except IOError as e:
+            #This is a critical error -> Terminate script
+            debug.logging.error("%s",e)
+            sys.exit()
+        buses.append(bus)
+
+    busRouter = mqtt2modbus.modbusBusRouter(buses)
+
+    #Setting up queue to hold incoming mqtt messages => priority lanes, round robin between slaves
+    mqttMsgQueue = mqtt2modbus.modbusRequestScheduler(MQTT_MSG_QUEUE_SIZE)
+
+    #Setting up poller => poll requests take the same path as mqtt requests
+    poller = mqtt2modbus.modbusPoller(MODBUS_POLL_POINTS,mqttMsgQueue.nb_send,publish_poll)
+
+    #Setting up the Modbus TCP front end => its requests take the same path as mqtt requests
+    tcpServer = mqtt2modbus.modbusTcpServer(submit_request,**MODBUS_TCP_SERVER) if MODBUS_TCP_SERVER != None else None
+
+    #Setting up tasks
+    pyRTOS.add_task(pyRTOS.Task(modbus_manager_task, name="modbus_manager_task"))
+    pyRTOS.add_task(pyRTOS.Task(mqtt_manager_task, name="mqtt_manager_task"))
+    pyRTOS.add_task(pyRTOS.Task(publisher.run, name="mqtt_publish_task"))
+    if len(MODBUS_POLL_POINTS) > 0:
+        pyRTOS.add_task(pyRTOS.Task(modbus_poller_task, name="modbus_poller_task"))
+
+#Start the mqtt network thread and the bus workers
+def start():
+
+    #Start paho mqtt background thread
+    mqttc.loop_start()
+
+    #Start bus workers
+    for bus in buses:
+        bus.start()
+
+    #Start accepting Modbus TCP clients
+    if tcpServer != None:
+        try:
+            tcpServer.start()
+        except OSError as e:
+            #This is a critical error -> Terminate script
+            debug.logging.error("%s",e)
+            sys.exit()
+
+def main():
+
+    #Load environment variable file
+    load_dotenv()
+
+    #LOG_LEVEL may come from the environment file
+    debug.setLevel(os.getenv('LOG_LEVEL',debug.LOG_LEVEL))
+
+    #Log startup info
+    debug.logging.info("[Starting Modbus Mqtt Bridge:%s]",os.getenv('MQTT_MODBUS_BRIDGE_VERSION'))
+
+    setup()
+    start()
+
+    if PYRTOS_PROFILE_INTERVAL > 0:
+        profiler = pyRTOS.enable_profiling()
+        pyRTOS.add_service_routine(profiler.service(PYRTOS_PROFILE_INTERVAL,lambda report: debug.logging.info("Scheduler profile: %s",report)))
+
+    #Start RTOS => Event driven scheduler sleeps between timeouts instead of busy polling
+    pyRTOS.start(pyRTOS.EventScheduler())
+
+if __name__ == "__main__":
+    main()
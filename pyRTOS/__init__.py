@@ -2,3 +2,4 @@ from pyRTOS.pyRTOS import *
 from pyRTOS.message import *
 from pyRTOS.task import *
 from pyRTOS.scheduler import *
+from pyRTOS.profiler import *
@@ -1,3 +1,5 @@
+import threading
+
 import pyRTOS
 
 # Message Types
@@ -26,50 +28,89 @@ def deliver_messages(messages, tasks):
 				pass
 
 
+# Fixed capacity ring buffer.  Sending and receiving are O(1) and safe to
+# use from other threads (for example a network callback feeding a task).
+# A send from outside the scheduler thread calls pyRTOS.wake(), so a task
+# blocked on recv() is re-checked right away under EventScheduler.  Plain
+# threads consuming the queue can block on wait() instead.
 class MessageQueue(object):
 	def __init__(self, capacity=10):
 		self.capacity = capacity
-		self.buffer = []
+		self.buffer = [None] * capacity
+		self.head = 0
+		self.count = 0
+		self.lock = threading.Condition()
+
+	def __len__(self):
+		return self.count
 
 	# This is a blocking condition
 	def send(self, msg):
 		sent = False
 
 		while True:
-			if sent:
-				yield True
-			elif len(self.buffer) < self.capacity:
-				self.buffer.append(msg)
-				yield True
-			else:
-				yield False
+			if not sent:
+				sent = self.nb_send(msg)
+			yield sent
 
 	def nb_send(self, msg):
-		if len(self.buffer) < self.capacity:
-			self.buffer.append(msg)
-			return True
-		else:
-			return False
+		with self.lock:
+			if self.count == self.capacity:
+				return False
+
+			self.buffer[(self.head + self.count) % self.capacity] = msg
+			self.count += 1
+			self.lock.notify()
+
+		pyRTOS.wake()
+		return True
 
 
 	# This is a blocking condition.
 	# out_buffer should be a list
 	def recv(self, out_buffer):
 		received = False
+
 		while True:
-			if received:
-				yield True
-			elif len(self.buffer) > 0:
-				received = True
-				out_buffer.append(self.buffer.pop(0))
-				yield True
-			else:
-				yield False
-
-	
+			if not received:
+				msgs = self.recv_many(1)
+				if len(msgs) > 0:
+					out_buffer.extend(msgs)
+					received = True
+			yield received
+
 	def nb_recv(self):
-		if len(self.buffer) > 0:
-			return self.buffer.pop(0)
+		msgs = self.recv_many(1)
+		if len(msgs) > 0:
+			return msgs[0]
 		else:
 			return None
 
+	# Blocks the calling thread (never use this from a task) until the
+	# queue holds a message or the timeout expires.  Returns True if
+	# there is a message waiting.
+	def wait(self, timeout=None):
+		with self.lock:
+			return self.lock.wait_for(lambda: self.count > 0, timeout)
+
+	# Removes and returns up to n messages (all of them if n is None),
+	# oldest first
+	def recv_many(self, n=None):
+		with self.lock:
+			was_full = self.count == self.capacity
+
+			if n == None or n > self.count:
+				n = self.count
+
+			msgs = [None] * n
+			for i in range(n):
+				msgs[i] = self.buffer[self.head]
+				self.buffer[self.head] = None
+				self.head = (self.head + 1) % self.capacity
+			self.count -= n
+
+		# Let senders blocked on a full queue retry
+		if was_full and n > 0:
+			pyRTOS.wake()
+
+		return msgs
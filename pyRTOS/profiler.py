@@ -0,0 +1,178 @@
+import time
+
+import pyRTOS
+
+
+# Scheduler profiling.  Enable with pyRTOS.enable_profiling() (before or
+# after adding tasks, but before pyRTOS.start()).  Nothing is wrapped or
+# timed unless profiling is enabled, so it costs nothing otherwise.
+#
+# Per task it accounts activations, cumulative and max run time of
+# run_next(), time spent blocked (from yielding block conditions until one
+# of them became true) and ready (from then until it ran again), and the
+# number and cost of block condition checks.  Per loop it accounts
+# iterations and idle time (iterations in which no task ran, including the
+# time EventScheduler sleeps).
+
+
+class TaskStats(object):
+	__slots__ = ("name", "activations", "run_time", "max_run_time",
+	             "blocked_time", "ready_time", "checks", "check_time",
+	             "blocked_since", "ready_since")
+
+	def __init__(self, name):
+		self.name = name
+		self.activations = 0
+		self.run_time = 0
+		self.max_run_time = 0
+		self.blocked_time = 0
+		self.ready_time = 0
+		self.checks = 0
+		self.check_time = 0
+		self.blocked_since = None
+		self.ready_since = None
+
+	def report(self):
+		return {
+			"activations": self.activations,
+			"run_time": self.run_time,
+			"max_run_time": self.max_run_time,
+			"mean_run_time": self.run_time / self.activations if self.activations else 0,
+			"blocked_time": self.blocked_time,
+			"ready_time": self.ready_time,
+			"checks": self.checks,
+			"check_time": self.check_time,
+		}
+
+
+# Times every check of a block condition.  Forwards deadline, so
+# EventScheduler still keeps timeouts in its timer heap.
+class ProfiledCondition(object):
+	def __init__(self, condition, stats):
+		self.condition = condition
+		self.stats = stats
+		if hasattr(condition, "deadline"):
+			self.deadline = condition.deadline
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		start = time.perf_counter()
+		ready = next(self.condition)
+		end = time.perf_counter()
+
+		stats = self.stats
+		stats.checks += 1
+		stats.check_time += end - start
+		if ready and stats.ready_since == None:
+			stats.ready_since = end
+
+		return ready
+
+
+class Profiler(object):
+	def __init__(self):
+		self.tasks = {}
+		self.activations = 0
+		self.iterations = 0
+		self.idle_iterations = 0
+		self.idle_time = 0
+		self.started = time.perf_counter()
+
+	def attach(self, task):
+		if task in self.tasks:
+			return
+
+		stats = TaskStats(task.name if task.name != None else str(task))
+		self.tasks[task] = stats
+		run_next = task.run_next
+
+		def profiled_run_next():
+			start = time.perf_counter()
+
+			if stats.blocked_since != None:
+				ready = stats.ready_since if stats.ready_since != None else start
+				stats.blocked_time += ready - stats.blocked_since
+				stats.ready_time += start - ready
+			elif stats.ready_since != None:
+				stats.ready_time += start - stats.ready_since
+			stats.blocked_since = None
+			stats.ready_since = None
+
+			try:
+				return run_next()
+			finally:
+				end = time.perf_counter()
+				elapsed = end - start
+
+				self.activations += 1
+				stats.activations += 1
+				stats.run_time += elapsed
+				if elapsed > stats.max_run_time:
+					stats.max_run_time = elapsed
+
+				if task.state == pyRTOS.BLOCKED:
+					task.ready_conditions = [ProfiledCondition(c, stats) for c in task.ready_conditions]
+					stats.blocked_since = end
+				else:
+					stats.ready_since = end
+
+		task.run_next = profiled_run_next
+
+	# Wraps the scheduler passed to pyRTOS.start()
+	def wrap_scheduler(self, scheduler):
+		self.started = time.perf_counter()
+
+		def profiled_scheduler(tasks):
+			activations = self.activations
+			start = time.perf_counter()
+
+			messages = scheduler(tasks)
+
+			self.iterations += 1
+			if self.activations == activations:
+				self.idle_iterations += 1
+				self.idle_time += time.perf_counter() - start
+
+			return messages
+
+		return profiled_scheduler
+
+	def report(self):
+		wall = time.perf_counter() - self.started
+
+		return {
+			"wall_time": wall,
+			"iterations": self.iterations,
+			"loop_rate": self.iterations / wall if wall > 0 else 0,
+			"idle_iterations": self.idle_iterations,
+			"idle_fraction": self.idle_time / wall if wall > 0 else 0,
+			"tasks": {stats.name: stats.report() for stats in list(self.tasks.values())},
+		}
+
+	# Returns a service routine (see pyRTOS.add_service_routine()) that
+	# hands a report to dump every interval seconds.  Service routines run
+	# once per loop iteration, so under EventScheduler a dump may be late
+	# while no task is due.
+	def service(self, interval, dump=None):
+		if dump == None:
+			dump = print_report
+
+		next_dump = [time.monotonic() + interval]
+
+		def dump_service():
+			now = time.monotonic()
+			if now >= next_dump[0]:
+				next_dump[0] = now + interval
+				dump(self.report())
+
+		return dump_service
+
+
+def print_report(report):
+	print("pyRTOS: %d iterations, %.1f/s, %.1f%% idle" % (report["iterations"], report["loop_rate"], 100 * report["idle_fraction"]))
+	for name, task in report["tasks"].items():
+		print("  %-24s runs %8d  run %9.3fs  max %8.3fms  mean %8.3fms  blocked %9.3fs  ready %8.3fs  checks %8d (%.3fs)" % (
+			name, task["activations"], task["run_time"], 1000 * task["max_run_time"], 1000 * task["mean_run_time"],
+			task["blocked_time"], task["ready_time"], task["checks"], task["check_time"]))
@@ -1,3 +1,4 @@
+import threading
 import time
 
 import pyRTOS
@@ -8,6 +9,14 @@ version = 1.0
 tasks = []
 service_routines = []
 
+# Set by other threads (see wake()) when something a blocked task may be
+# waiting on has changed.  The event scheduler sleeps on this.
+wakeup = threading.Event()
+scheduler_thread = None
+
+# Set by enable_profiling()
+active_profiler = None
+
 
 def add_task(task):
 	global tasks
@@ -15,6 +24,9 @@ def add_task(task):
 	if task.thread == None:
 		task.initialize()
 
+	if active_profiler != None:
+		active_profiler.attach(task)
+
 	tasks.append(task) 
 
 	tasks.sort(key=lambda t: t.priority)
@@ -27,11 +39,16 @@ def add_service_routine(service_routine):
 
 
 def start(scheduler=None):
-	global tasks, service_routines
+	global tasks, service_routines, scheduler_thread
+
+	scheduler_thread = threading.get_ident()
 
 	if scheduler == None:
 		scheduler = pyRTOS.default_scheduler
 
+	if active_profiler != None:
+		scheduler = active_profiler.wrap_scheduler(scheduler)
+
 	run = True
 	while run:
 		for service in service_routines:
@@ -45,22 +62,51 @@ def start(scheduler=None):
 
 
 
+# Turns on scheduler profiling (see profiler.py) and returns the profiler.
+# Call before start().
+def enable_profiling():
+	global active_profiler
+
+	if active_profiler == None:
+		active_profiler = pyRTOS.Profiler()
+		for task in tasks:
+			active_profiler.attach(task)
+
+	return active_profiler
+
+# Returns the profiling report, or None if profiling is disabled
+def profiling_report():
+	if active_profiler == None:
+		return None
+
+	return active_profiler.report()
+
+
+
 # Task Block Conditions
 
 # Timeout   - Task is delayed for no less than the specified time.
-def timeout(seconds):
-		start = time.monotonic()
+#             Timeouts carry their deadline, so a scheduler that keeps
+#             a timer heap (EventScheduler) never has to poll them.
+class Timeout(object):
+	def __init__(self, deadline):
+		self.deadline = deadline
 
-		while True:
-			yield time.monotonic() - start >= seconds
+	def __iter__(self):
+		return self
 
-def timeout_ns(nanoseconds):
-		start = time.monotonic_ns()
+	def __next__(self):
+		return time.monotonic() >= self.deadline
 
-		while True:
-			yield time.monotonic_ns() - start >= nanoseconds
+def timeout(seconds):
+	return Timeout(time.monotonic() + seconds)
+
+def timeout_ns(nanoseconds):
+	return Timeout(time.monotonic() + nanoseconds / 1000000000)
 
 # Cycle Delay - Task is delayed for no less than the number OS loops specified.
+#               Under EventScheduler a loop only happens when some task
+#               runs or wake() is called.
 def delay(cycles):
 	ttl = cycles
 	while True:
@@ -86,6 +132,16 @@ def wait_for_notification(task, index=0, state=1):
 
 
 
+# Wakeup    - Called from other threads after changing state that a
+#             blocked task may be waiting on.  The event scheduler then
+#             re-checks polled block conditions instead of sleeping until
+#             the next timeout.  Calls from the scheduler thread itself are
+#             free, since the scheduler re-checks after every task run.
+def wake():
+	if threading.get_ident() != scheduler_thread:
+		wakeup.set()
+
+
 # API I/O   - I/O done by the pyRTOS API has completed.
 #             This blocking should be automatic, but API
 #             functions may want to provide a timeout
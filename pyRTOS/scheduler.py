@@ -1,3 +1,7 @@
+import heapq
+import itertools
+import time
+
 import pyRTOS
 
 
@@ -33,3 +37,104 @@ def default_scheduler(tasks):
 
 		return messages
 
+
+
+# Event driven scheduler.  Use with pyRTOS.start(pyRTOS.EventScheduler()).
+#
+# Instead of calling next() on every blocked task's conditions on every pass,
+# it keeps timeouts in a min-heap keyed by deadline and sleeps until the
+# earliest deadline or until another thread calls pyRTOS.wake().  Tasks
+# blocked only on timeouts are never polled.  Tasks blocked on other
+# conditions (queues, mutexes, messages, ...) are re-checked only after some
+# task has run or a wakeup arrived, and at their earliest timeout if the
+# condition list contains one.
+class EventScheduler(object):
+	def __init__(self):
+		self.timers = []
+		self.counter = itertools.count()
+		self.armed = {}
+		self.dirty = True
+
+	def __call__(self, tasks):
+		messages = []
+		running_task = None
+
+		now = time.monotonic()
+		while self.timers and self.timers[0][0] <= now:
+			deadline, _, task, conditions = heapq.heappop(self.timers)
+			if task.state == pyRTOS.BLOCKED and task.ready_conditions is conditions:
+				self.check(task)
+
+		if pyRTOS.wakeup.is_set():
+			pyRTOS.wakeup.clear()
+			self.dirty = True
+
+		if self.dirty:
+			self.dirty = False
+			for task in tasks:
+				if task.state == pyRTOS.BLOCKED:
+					armed = self.armed.get(task)
+					if armed == None or armed[0] is not task.ready_conditions:
+						armed = self.arm(task)
+					if armed[1]:
+						self.check(task)
+
+		for task in tasks:
+			if task.state == pyRTOS.READY:
+				if running_task == None:
+					running_task = task
+			elif task.state == pyRTOS.RUNNING:
+				if (running_task == None) or \
+				   (task.priority <= running_task.priority):
+					running_task = task
+				else:
+					task.state = pyRTOS.READY
+
+		if running_task == None:
+			self.sleep()
+			return messages
+
+		running_task.state = pyRTOS.RUNNING
+
+		try:
+			messages = running_task.run_next()
+		except StopIteration:
+			tasks.remove(running_task)
+			self.armed.pop(running_task, None)
+
+		# Whatever the task did may have satisfied someone's block condition
+		self.dirty = True
+
+		return messages
+
+	# Register a newly blocked task.  Returns (conditions, polled), where
+	# polled is False if every condition is a timer.
+	def arm(self, task):
+		conditions = task.ready_conditions
+		deadlines = [c.deadline for c in conditions if hasattr(c, "deadline")]
+
+		if len(deadlines) > 0:
+			heapq.heappush(self.timers, (min(deadlines), next(self.counter), task, conditions))
+
+		armed = (conditions, len(deadlines) < len(conditions))
+		self.armed[task] = armed
+		return armed
+
+	def check(self, task):
+		if True in map(lambda x: next(x), task.ready_conditions):
+			task.state = pyRTOS.READY
+			task.ready_conditions = []
+			self.armed.pop(task, None)
+
+	def sleep(self):
+		timeout = None
+
+		# Discard timers of tasks that were unblocked some other way
+		while self.timers:
+			deadline, _, task, conditions = self.timers[0]
+			if task.state == pyRTOS.BLOCKED and task.ready_conditions is conditions:
+				timeout = max(0, deadline - time.monotonic())
+				break
+			heapq.heappop(self.timers)
+
+		pyRTOS.wakeup.wait(timeout)
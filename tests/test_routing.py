@@ -0,0 +1,128 @@
+#End-to-end checks of request routing => the real bridge against a simulated RTU slave on a pty (benchmarks/rtusim.py),
+#with the in-process MQTT stand-in (benchmarks/mqttstub.py) instead of a broker.
+
+import json
+import multiprocessing
+import threading
+import time
+import unittest
+
+import pyRTOS
+import mqtt_modbus_bridge as bridge
+from benchmarks import mqttstub
+from benchmarks import rtusim
+from mqtt2modbus import modbusbus
+from mqtt2modbus import mqtt2modbus
+
+OK = mqtt2modbus.mqtt2Modbus_ErrorStatus.OK.value
+INVALID_PARAMETER = mqtt2modbus.mqtt2Modbus_ErrorStatus.INVALID_PARAMETER.value
+
+
+def request(uuid: str,**fields) -> dict:
+    return {
+                "cmdName"   :"read",
+                "uuid"      :uuid,
+                "devId"     :"",
+                "devProfile":"",
+                "modfunc"   :3,
+                "devAdd"    :1,
+                "regAdd"    :0,
+                "regCount"  :1,
+                "regData"   :[],
+           } | fields
+
+
+class routerTest(unittest.TestCase):
+    def setUp(self):
+        self.busA = modbusbus.modbusBus("a","/dev/null",9600,1,None,slaves=(1,),devIds=("meter",))
+        self.busB = modbusbus.modbusBus("b","/dev/null",9600,1,None,slaves=(2,))
+
+    def testRoutesByDevIdThenDevAdd(self):
+        router = modbusbus.modbusBusRouter([self.busA,self.busB])
+        self.assertIs(router.route(request("1",devId="meter",devAdd=2)),self.busA)
+        self.assertIs(router.route(request("2",devAdd=2)),self.busB)
+        self.assertIsNone(router.route(request("3",devAdd=3)))
+
+    def testUnhashableKeysGoToTheDefaultBus(self):
+        default = modbusbus.modbusBus("c","/dev/null",9600,1,None)
+        router = modbusbus.modbusBusRouter([self.busA,self.busB,default])
+        #An unusable devId still leaves the devAdd
+        self.assertIs(router.route(request("1",devId=[1],devAdd=2)),self.busB)
+        self.assertIs(router.route(request("2",devId={"a": 1},devAdd=[2])),default)
+
+        #Without a default bus nothing serves them
+        router = modbusbus.modbusBusRouter([self.busA,self.busB])
+        self.assertIsNone(router.route(request("3",devId=[1],devAdd={})))
+
+
+class bridgeRoutingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        simulator = rtusim.rtuSlaveSimulator([rtusim.rtuSlave(1)],9600)
+        port = simulator.open()
+        cls.simulatorProcess = multiprocessing.get_context("fork").Process(target=simulator.serve,daemon=True)
+        cls.simulatorProcess.start()
+
+        cls.responses = {}
+        cls.client = mqttstub.stubMqttClient(cls.onPublish)
+        bridge.setup(cls.client,[{"name": "sim","port": port,"baudrate": 9600,"timeout": 0.5,"transport": "asyncio","rs485": False}])
+        bridge.start()
+        threading.Thread(target=pyRTOS.start,args=(pyRTOS.EventScheduler(),),daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.simulatorProcess.terminate()
+
+    @classmethod
+    def onPublish(cls,topic: str,payload: bytes,properties):
+        if topic.startswith(bridge.MODBUS_RESP_TOPIC):
+            response = json.loads(payload)
+            cls.responses[response.get("uuid",response.get("batchId"))] = response
+
+    def send(self,mqttMsg: dict):
+        self.client.inject(bridge.MODBUS_CMD_TOPIC,json.dumps(mqttMsg).encode())
+
+    def response(self,key: str,timeout: float = 5) -> dict:
+        deadline = time.monotonic() + timeout
+        while key not in self.responses:
+            self.assertLess(time.monotonic(),deadline,f"No response to {key}")
+            time.sleep(0.01)
+        return self.responses[key]
+
+    def testUnhashableDevId(self):
+        self.send(request("listDevId",devId=[1]))
+        self.assertEqual(self.response("listDevId")["result"],INVALID_PARAMETER)
+
+        #The scheduler survived => later requests are still served
+        self.send(request("afterListDevId"))
+        self.assertEqual(self.response("afterListDevId")["result"],OK)
+
+    def testUnhashableDevIdInBatch(self):
+        self.send({"batchId": "dictDevId","commands": [request("batchDictDevId",devId={"a": 1}),request("batchValid")]})
+        batch = self.response("dictDevId")
+        self.assertEqual([item["result"] for item in batch["items"]],[INVALID_PARAMETER,OK])
+
+        self.send(request("afterBatch"))
+        self.assertEqual(self.response("afterBatch")["result"],OK)
+
+    def testBatchWithoutCommandList(self):
+        for batchId, commands in (("intCommands",5),("nullCommands",None),("objectCommands",{"a": 1})):
+            self.send({"batchId": batchId,"commands": commands})
+            batch = self.response(batchId)
+            self.assertEqual(batch["result"],INVALID_PARAMETER)
+            self.assertEqual(batch["items"],[])
+
+        self.send(request("afterBadBatch"))
+        self.assertEqual(self.response("afterBadBatch")["result"],OK)
+
+    def testNonFiniteTtl(self):
+        for uuid, ttl in (("nanTtl",float("nan")),("infTtl",float("inf"))):
+            self.send(request(uuid,ttl=ttl))
+            self.assertEqual(self.response(uuid)["result"],INVALID_PARAMETER)
+
+        self.send(request("finiteTtl",ttl=5))
+        self.assertEqual(self.response("finiteTtl")["result"],OK)
+
+
+if __name__ == "__main__":
+    unittest.main()